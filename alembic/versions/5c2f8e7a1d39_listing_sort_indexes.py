@@ -0,0 +1,37 @@
+"""Indexes for story listing sort orders
+
+Revision ID: 5c2f8e7a1d39
+Revises: e4d7a19b6c02
+Create Date: 2026-10-18 19:42:16.905310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c2f8e7a1d39'
+down_revision = 'e4d7a19b6c02'
+branch_labels = None
+depends_on = None
+
+# these must be the same expressions as metadb.story_sort_keys
+sort_keys = [
+    ('updated', "coalesce(updated, '')"),
+    ('words', "coalesce(words, -1)"),
+    ('title', "coalesce(title, '')"),
+    ('category', "coalesce(category, '')"),
+]
+
+
+def upgrade():
+    op.create_index('ix_story_author_id', 'story', ['author_id'])
+    for name, expr in sort_keys:
+        op.create_index(f'ix_story_{name}_key', 'story',
+                        [sa.text(expr), 'id'])
+
+
+def downgrade():
+    for name, expr in reversed(sort_keys):
+        op.drop_index(f'ix_story_{name}_key', table_name='story')
+    op.drop_index('ix_story_author_id', table_name='story')
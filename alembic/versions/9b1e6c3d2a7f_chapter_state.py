@@ -0,0 +1,58 @@
+"""Added chapter download state
+
+Revision ID: 9b1e6c3d2a7f
+Revises: 4f46e426f94e
+Create Date: 2026-10-18 10:12:41.503118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import hashlib
+from pathlib import Path
+
+
+# revision identifiers, used by Alembic.
+revision = '9b1e6c3d2a7f'
+down_revision = '4f46e426f94e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chapter', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('hash', sa.String(), nullable=True))
+        batch_op.add_column(sa.Column('size', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('fetched_at', sa.DateTime(),
+                                      nullable=True))
+
+    # Fill in the state of chapters already in the mirror, so they aren't all
+    # downloaded again on the next update.
+    conn = op.get_bind()
+    row = conn.execute(sa.text(
+        "select value from config where name = 'archive_dir'")).first()
+    if row is None:
+        return
+    mdir = Path(row[0])
+    chapters = conn.execute(sa.text(
+        "select chapter.id, chapter.num, story.download_fn, "
+        "story.download_time from chapter join story "
+        "on chapter.story_id = story.id "
+        "where story.download_fn is not null")).fetchall()
+    for cid, num, fn, dt in chapters:
+        try:
+            data = (mdir / fn / f"{num:04d}.html").read_bytes()
+        except OSError:
+            continue
+        conn.execute(
+            sa.text("update chapter set hash = :h, size = :s, "
+                    "fetched_at = :t where id = :id"),
+            {'h': hashlib.sha256(data).hexdigest(), 's': len(data),
+             't': dt, 'id': cid})
+
+
+def downgrade():
+    with op.batch_alter_table('chapter', schema=None) as batch_op:
+        batch_op.drop_column('fetched_at')
+        batch_op.drop_column('size')
+        batch_op.drop_column('hash')
@@ -0,0 +1,29 @@
+"""Unique story tag links
+
+Revision ID: c3a58e0f7d21
+Revises: 9b1e6c3d2a7f
+Create Date: 2026-10-18 14:03:52.218876
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3a58e0f7d21'
+down_revision = '9b1e6c3d2a7f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # drop any duplicate links first, keeping the earliest of each
+    op.execute(sa.text(
+        "delete from story_tags where rowid not in "
+        "(select min(rowid) from story_tags group by story_id, tag_id)"))
+    op.create_index('ix_story_tags_story_tag', 'story_tags',
+                    ['story_id', 'tag_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_story_tags_story_tag', table_name='story_tags')
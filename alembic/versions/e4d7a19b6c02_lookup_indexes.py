@@ -0,0 +1,101 @@
+"""Indexes for story, author and tag lookups
+
+Revision ID: e4d7a19b6c02
+Revises: c3a58e0f7d21
+Create Date: 2026-10-18 16:20:07.341952
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4d7a19b6c02'
+down_revision = 'c3a58e0f7d21'
+branch_labels = None
+depends_on = None
+
+# (name, table, columns) of the plain indexes on foreign keys
+fk_indexes = [
+    ('ix_fav_stories_author_id', 'fav_stories', ['author_id']),
+    ('ix_fav_stories_story_id', 'fav_stories', ['story_id']),
+    ('ix_fav_authors_author_id', 'fav_authors', ['author_id']),
+    ('ix_fav_authors_favauthor_id', 'fav_authors', ['favauthor_id']),
+    ('ix_story_tags_tag_id', 'story_tags', ['tag_id']),
+    ('ix_following_stories_story_id', 'following_stories', ['story_id']),
+    ('ix_chapter_story_id', 'chapter', ['story_id']),
+]
+
+
+def merge_duplicates(table, key, refs, drop=()):
+    """Merge rows of table that share the key columns into the one with the
+    lowest id, repointing the columns in refs (a list of (table, column)) to
+    it. Rows of the tables in drop that point at a merged row are deleted
+    instead."""
+    cols = ', '.join(key)
+    match = ' and '.join(f"t.{c} = k.{c}" for c in key)
+    op.execute(sa.text("drop table if exists merge_ids"))
+    op.execute(sa.text(
+        f"create temp table merge_ids as "
+        f"select t.id as old_id, k.keep_id from {table} t join "
+        f"(select {cols}, min(id) as keep_id from {table} group by {cols} "
+        f"having count(*) > 1) k on {match} where t.id != k.keep_id"))
+    for rt, rc in refs:
+        # or ignore, so a link that would duplicate one the kept row already
+        # has is left behind and deleted below
+        op.execute(sa.text(
+            f"update or ignore {rt} set {rc} = "
+            f"(select keep_id from merge_ids where old_id = {rc}) "
+            f"where {rc} in (select old_id from merge_ids)"))
+        op.execute(sa.text(
+            f"delete from {rt} where {rc} in (select old_id from merge_ids)"))
+    for rt, rc in drop:
+        op.execute(sa.text(
+            f"delete from {rt} where {rc} in (select old_id from merge_ids)"))
+    op.execute(sa.text(
+        f"delete from {table} where id in (select old_id from merge_ids)"))
+    op.execute(sa.text("drop table merge_ids"))
+
+
+def dedupe_links(table, cols):
+    op.execute(sa.text(
+        f"delete from {table} where rowid not in "
+        f"(select min(rowid) from {table} group by {', '.join(cols)})"))
+
+
+def upgrade():
+    # Older mirrors may have picked up duplicate rows, which the unique
+    # indexes won't allow. The duplicate of a story has its own copy of the
+    # chapter rows, so those are dropped rather than merged.
+    merge_duplicates('story', ['archive', 'site_id'],
+                     [('fav_stories', 'story_id'),
+                      ('following_stories', 'story_id'),
+                      ('story_tags', 'story_id'),
+                      ('dl_status', 'story_id')],
+                     drop=[('chapter', 'story_id')])
+    merge_duplicates('author', ['archive', 'site_id'],
+                     [('story', 'author_id'),
+                      ('fav_stories', 'author_id'),
+                      ('fav_authors', 'author_id'),
+                      ('fav_authors', 'favauthor_id'),
+                      ('dl_status', 'author_id')])
+    merge_duplicates('tag', ['name'], [('story_tags', 'tag_id')])
+    dedupe_links('fav_stories', ['author_id', 'story_id'])
+    dedupe_links('fav_authors', ['author_id', 'favauthor_id'])
+    dedupe_links('following_stories', ['story_id'])
+
+    op.create_index('ix_story_archive_site_id', 'story',
+                    ['archive', 'site_id'], unique=True)
+    op.create_index('ix_author_archive_site_id', 'author',
+                    ['archive', 'site_id'], unique=True)
+    op.create_index('ix_tag_name', 'tag', ['name'], unique=True)
+    for name, table, cols in fk_indexes:
+        op.create_index(name, table, cols)
+
+
+def downgrade():
+    for name, table, cols in reversed(fk_indexes):
+        op.drop_index(name, table_name=table)
+    op.drop_index('ix_tag_name', table_name='tag')
+    op.drop_index('ix_author_archive_site_id', table_name='author')
+    op.drop_index('ix_story_archive_site_id', table_name='story')
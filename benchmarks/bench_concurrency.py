@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Benchmark for reads against the mirror database while another process writes
+# to it, as when the web view is used during an ffdb update. For each
+# database profile, a writer process commits sync-sized batches of story
+# updates as fast as it can, while this process times web-view-sized reads
+# (a page of stories with their authors). Reads are also timed with no
+# writer, for reference. Run from the repository root:
+#
+#   python benchmarks/bench_concurrency.py [--stories 50000] [--seconds 5]
+
+import argparse, multiprocessing, random, statistics, sys, tempfile, time, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy.exc import OperationalError  # noqa: E402
+
+from ffmirror import metadb  # noqa: E402
+from ffmirror.metadb import Story, Author  # noqa: E402
+
+def build(d, profile, n_stories):
+    m = metadb.DBMirror(d, profile=profile)
+    m.connect()
+    m.create()
+    n_authors = n_stories // 10
+    with m.engine.begin() as conn:
+        conn.execute(Author.__table__.insert(), [
+            {'id': i + 1, 'name': f"Author {i}", 'archive': 'ffnet',
+             'site_id': str(i), 'in_mirror': True} for i in range(n_authors)])
+        conn.execute(Story.__table__.insert(), [
+            {'id': i + 1, 'title': f"Story {i}", 'archive': 'ffnet',
+             'site_id': str(i), 'author_id': i % n_authors + 1,
+             'words': 1000, 'chapters': 1, 'summary': 'A summary. ' * 20}
+            for i in range(n_stories)])
+    m.close()
+
+def writer(d, profile, n_stories, batch, stop, commits):
+    m = metadb.DBMirror(d, profile=profile)
+    m.connect()
+    r = random.Random(2)
+    while not stop.is_set():
+        m.ds.bulk_update_mappings(Story, [
+            {'id': r.randrange(n_stories) + 1, 'words': r.randrange(10 ** 6),
+             'summary': 'Changed. ' * 20} for i in range(batch)])
+        m.ds.commit()
+        commits.value += 1
+    m.close()
+
+def read_page(m, r, n_stories):
+    start = r.randrange(n_stories - 100)
+    return (m.ds.query(Story, Author).join(Story.author).
+            filter(Story.id > start).order_by(Story.id).limit(100).all())
+
+def time_reads(d, profile, n_stories, seconds):
+    m = metadb.DBMirror(d, profile=profile)
+    m.connect()
+    r = random.Random(1)
+    times = []
+    errors = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        try:
+            read_page(m, r, n_stories)
+        except OperationalError:
+            errors += 1
+            m.ds.rollback()
+        times.append(time.perf_counter() - start)
+        m.ds.expunge_all()
+        time.sleep(0.01)
+    m.close()
+    return times, errors
+
+def report(profile, label, times, errors, commits=None):
+    times.sort()
+    p99 = times[int(len(times) * 0.99)]
+    print(f"{profile:<8}{label:<10}{len(times):>7}"
+          f"{statistics.median(times) * 1000:>10.1f}{p99 * 1000:>10.1f}"
+          f"{times[-1] * 1000:>10.1f}{errors:>8}"
+          f"{'' if commits is None else commits:>10}")
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--stories', type=int, default=50000)
+    ap.add_argument('--seconds', type=float, default=5.0)
+    ap.add_argument('--batch', type=int, default=200)
+    args = ap.parse_args()
+    # use a directory on the same filesystem as the mirror would be, since
+    # tmpfs makes fsync free
+    base = os.environ.get('TMPDIR', '.')
+    print(f"{'profile':<8}{'writer':<10}{'reads':>7}{'p50 ms':>10}"
+          f"{'p99 ms':>10}{'max ms':>10}{'errors':>8}{'commits':>10}")
+    for profile in ['compat', 'wal']:
+        with tempfile.TemporaryDirectory(dir=base) as d:
+            build(d, profile, args.stories)
+            times, errors = time_reads(d, profile, args.stories,
+                                       args.seconds)
+            report(profile, 'idle', times, errors)
+            stop = multiprocessing.Event()
+            commits = multiprocessing.Value('i', 0)
+            p = multiprocessing.Process(target=writer, args=(
+                d, profile, args.stories, args.batch, stop, commits))
+            p.start()
+            time.sleep(0.5)
+            times, errors = time_reads(d, profile, args.stories,
+                                       args.seconds)
+            stop.set()
+            p.join()
+            report(profile, 'syncing', times, errors, commits.value)
+
+if __name__ == '__main__':
+    main()
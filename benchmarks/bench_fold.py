@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Benchmark for the text folding run on every downloaded chapter. Compares the
+# current util.fold_string_* functions against the original implementations,
+# which built their result by repeated string concatenation, on synthetic
+# chapters of increasing size. Run from the repository root:
+#
+#   python benchmarks/bench_fold.py [--sizes 1,4,16] [--repeat 3]
+#
+# Sizes are in megabytes of chapter HTML.
+
+import argparse, random, sys, time, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ffmirror import util  # noqa: E402
+
+def old_fold_string_indiscriminately(s, n=80):
+    l = s.split()
+    rv = ""
+    cl = 0
+    for i in l:
+        if cl + len(i) + 1 < n:
+            rv += ' ' + i
+            cl += len(i) + 1
+        else:
+            rv += ' \n' + i
+            cl = len(i)
+    return rv[1:]
+
+def old_fold_string_discriminately(s, n=80):
+    l = s.splitlines()
+    rv = ""
+    for i in l:
+        if len(i) < n:
+            rv += i + '\n'
+        else:
+            rv += old_fold_string_indiscriminately(i, n) + '\n'
+    return rv
+
+def make_chapter(size, seed=0):
+    """Some chapter-like HTML of about size bytes: paragraphs of words of
+    natural-ish lengths."""
+    rng = random.Random(seed)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                     for _ in range(rng.randint(1, 10)))
+             for _ in range(5000)]
+    paras = []
+    total = 0
+    while total < size:
+        p = '<p>' + ' '.join(rng.choice(words)
+                             for _ in range(rng.randint(20, 200))) + '</p>'
+        paras.append(p)
+        total += len(p) + 1
+    return '\n'.join(paras)
+
+def best_time(f, s, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f(s)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--sizes', default='1,4,16',
+                    help="chapter sizes to test, in MB")
+    ap.add_argument('--repeat', type=int, default=3)
+    args = ap.parse_args()
+
+    cases = [
+        ('indiscriminately', old_fold_string_indiscriminately,
+         util.fold_string_indiscriminately),
+        ('discriminately', old_fold_string_discriminately,
+         util.fold_string_discriminately),
+    ]
+    print(f"{'function':<18}{'size':>6}{'old MB/s':>11}{'new MB/s':>11}"
+          f"{'speedup':>9}")
+    for mb in (float(i) for i in args.sizes.split(',')):
+        s = make_chapter(int(mb * 1024 * 1024))
+        for name, old, new in cases:
+            assert old(s) == new(s)
+            to = best_time(old, s, args.repeat)
+            tn = best_time(new, s, args.repeat)
+            print(f"{name:<18}{mb:>5g}M{mb / to:>11.1f}{mb / tn:>11.1f}"
+                  f"{to / tn:>8.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# Benchmark for the web view's author index and its /list/<author> redirect.
+# Compares loading every (author, story) row and splitting them into pages in
+# Python, as the web view used to, against the author-page map in
+# webview.paging plus a query for just the authors on the page, on a
+# synthetic mirror database. Run from the repository root:
+#
+#   python benchmarks/bench_index.py [--stories 100000] [--page-size 100]
+
+import argparse, random, sys, tempfile, time, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ffmirror import metadb  # noqa: E402
+from ffmirror.metadb import Story, Author, Tag  # noqa: E402
+from ffmirror.metadb import story_tags_table  # noqa: E402
+from ffmirror.webview import paging  # noqa: E402
+
+def build(m, n_stories):
+    n_authors = n_stories // 10
+    n_tags = n_stories // 100
+    r = random.Random(1)
+    with m.engine.begin() as conn:
+        conn.execute(Author.__table__.insert(), [
+            {'id': i + 1, 'name': f"Author {r.randrange(n_authors)}",
+             'archive': 'ffnet', 'site_id': str(i), 'in_mirror': True}
+            for i in range(n_authors)])
+        conn.execute(Tag.__table__.insert(), [
+            {'id': i + 1, 'name': f"tag {i}"} for i in range(n_tags)])
+        conn.execute(Story.__table__.insert(), [
+            {'id': i + 1, 'title': f"Story {i}", 'archive': 'ffnet',
+             'site_id': str(i), 'author_id': r.randrange(n_authors) + 1,
+             'summary': 'A summary.'} for i in range(n_stories)])
+        conn.execute(story_tags_table.insert(), [
+            {'story_id': i + 1, 'tag_id': (i * 7 + k * 13) % n_tags + 1}
+            for i in range(n_stories) for k in range(3)])
+    return n_authors
+
+def sort_query(aq):
+    al = []
+    for auth, story in aq.all():
+        if len(al) == 0 or al[-1] is not auth:
+            al.append(auth)
+            auth.query_stories = []
+        auth.query_stories.append(story)
+    return al
+
+def old_pages(alist, page_size):
+    rv = []
+    cp = 0
+    for i in alist:
+        rv.append(i)
+        cp += len(i.query_stories)
+        if cp >= page_size:
+            yield rv
+            rv = []
+            cp = 0
+    yield rv
+
+def old_index(m, page, page_size):
+    query = (m.ds.query(Author, Story)
+             .options(metadb.joinedload(Story.tags))
+             .filter(Story.author_id == Author.id)
+             .filter(Author.in_mirror == True)  # noqa: E712
+             .order_by(metadb.func.lower(Author.name)))
+    return list(old_pages(sort_query(query), page_size))[page]
+
+def old_to_author(m, aid, page_size):
+    ao = m.ds.query(Author).filter_by(id=aid).one()
+    query = (m.ds.query(Author, Story)
+             .filter(Story.author_id == Author.id)
+             .filter(Author.in_mirror == True)  # noqa: E712
+             .order_by(metadb.text("lower(name)")))
+    for n, i in enumerate(old_pages(sort_query(query), page_size)):
+        if ao in i:
+            return n
+
+def new_index(m, page, page_size):
+    ap = paging.author_pages(m.ds, page_size)
+    query = (m.ds.query(Author, Story)
+             .options(metadb.selectinload(Story.tags))
+             .filter(Story.author_id == Author.id)
+             .filter(Author.in_mirror == True)  # noqa: E712
+             .order_by(metadb.func.lower(Author.name), Author.id)
+             .filter(Author.id.in_(ap.authors_on(page))))
+    return sort_query(query)
+
+def new_to_author(m, aid, page_size):
+    return paging.author_pages(m.ds, page_size).page_of[aid]
+
+def timed(m, f):
+    start = time.perf_counter()
+    f()
+    rv = time.perf_counter() - start
+    # don't let one run's loaded objects speed up the next
+    m.ds.expunge_all()
+    return rv
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--stories', type=int, default=100000)
+    ap.add_argument('--page-size', type=int, default=100)
+    args = ap.parse_args()
+    with tempfile.TemporaryDirectory() as d:
+        m = metadb.DBMirror(d)
+        m.connect()
+        m.create()
+        n_authors = build(m, args.stories)
+        ps = args.page_size
+        last = paging.author_pages(m.ds, ps).last_page
+        paging._author_pages.clear()
+        aid = n_authors // 2
+        print(f"{args.stories} stories, {n_authors} authors, "
+              f"{last + 1} pages")
+        print(f"{'request':<24}{'old s':>10}{'new s':>10}")
+        rows = [
+            ('index, page map built',
+             lambda: old_index(m, 0, ps), lambda: new_index(m, 0, ps)),
+            ('index, first page',
+             lambda: old_index(m, 0, ps), lambda: new_index(m, 0, ps)),
+            ('index, last page',
+             lambda: old_index(m, last, ps), lambda: new_index(m, last, ps)),
+            ('/list/<author>',
+             lambda: old_to_author(m, aid, ps),
+             lambda: new_to_author(m, aid, ps)),
+        ]
+        for name, old, new in rows:
+            print(f"{name:<24}{timed(m, old):>10.3f}{timed(m, new):>10.3f}")
+        m.close()
+
+if __name__ == '__main__':
+    main()
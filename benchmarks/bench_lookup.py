@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Benchmark for the database lookups the mirror makes most: stories and authors
+# by (archive, site_id), tags by name, and the association tables followed in
+# either direction. Builds a synthetic mirror database, times the lookups with
+# none of the lookup indexes, then creates the indexes declared in metadb and
+# times them again. Run from the repository root:
+#
+#   python benchmarks/bench_lookup.py [--stories 500000] [--lookups 200]
+
+import argparse, random, sys, tempfile, time, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ffmirror import metadb  # noqa: E402
+from ffmirror.metadb import (Story, Author, Tag, story_tags_table,  # noqa: E402
+                             fav_stories_table)
+
+def lookup_indexes():
+    """The indexes this benchmark measures: everything declared in the models
+    except the unique story tag index, which the bulk tag path relies on."""
+    return [i for t in metadb.Base.metadata.tables.values()
+            for i in t.indexes if i.name != 'ix_story_tags_story_tag']
+
+def build(m, n_stories):
+    n_authors = n_stories // 10
+    n_tags = n_stories // 100
+    conn = m.engine.connect()
+    for i in lookup_indexes():
+        i.drop(conn)
+    with conn.begin():
+        conn.execute(Author.__table__.insert(), [
+            {'id': i + 1, 'name': f"Author {i}", 'archive': 'ffnet',
+             'site_id': str(i), 'in_mirror': False}
+            for i in range(n_authors)])
+        conn.execute(Tag.__table__.insert(), [
+            {'id': i + 1, 'name': f"tag {i}"} for i in range(n_tags)])
+        step = 50000
+        for start in range(0, n_stories, step):
+            ids = range(start, min(start + step, n_stories))
+            conn.execute(Story.__table__.insert(), [
+                {'id': i + 1, 'title': f"Story {i}", 'archive': 'ffnet',
+                 'site_id': str(i), 'author_id': i % n_authors + 1}
+                for i in ids])
+            conn.execute(story_tags_table.insert(), [
+                {'story_id': i + 1, 'tag_id': (i * 7 + k * 13) % n_tags + 1}
+                for i in ids for k in range(3)])
+            conn.execute(fav_stories_table.insert(), [
+                {'author_id': (i * 31) % n_authors + 1, 'story_id': i + 1}
+                for i in ids])
+    conn.close()
+    return n_authors, n_tags
+
+def queries(m, n_stories, n_authors, n_tags):
+    ds = m.ds
+    return [
+        ('get_story', lambda r: m.get_story(
+            'ffnet', str(r.randrange(n_stories)))),
+        ('get_author', lambda r: m.get_author(
+            'ffnet', str(r.randrange(n_authors)))),
+        ('tag by name', lambda r: ds.query(Tag).filter_by(
+            name=f"tag {r.randrange(n_tags)}").one_or_none()),
+        ('stories with tag', lambda r: ds.query(Story.id).join(
+            story_tags_table).filter(
+                story_tags_table.c.tag_id == r.randrange(n_tags) + 1).all()),
+        ('favorites of', lambda r: ds.query(Story.id).join(
+            fav_stories_table).filter(
+                fav_stories_table.c.author_id ==
+                r.randrange(n_authors) + 1).all()),
+        ('faved by', lambda r: ds.query(fav_stories_table.c.author_id).filter(
+            fav_stories_table.c.story_id ==
+            r.randrange(n_stories) + 1).all()),
+    ]
+
+def time_queries(qs, n):
+    rv = []
+    for name, q in qs:
+        r = random.Random(1)
+        start = time.perf_counter()
+        for i in range(n):
+            q(r)
+        rv.append((name, (time.perf_counter() - start) / n))
+    return rv
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--stories', type=int, default=500000)
+    ap.add_argument('--lookups', type=int, default=200)
+    args = ap.parse_args()
+    with tempfile.TemporaryDirectory() as d:
+        m = metadb.DBMirror(d)
+        m.connect()
+        m.create()
+        start = time.perf_counter()
+        n_authors, n_tags = build(m, args.stories)
+        print(f"built {args.stories} stories, {n_authors} authors, "
+              f"{n_tags} tags in {time.perf_counter() - start:.1f}s")
+        qs = queries(m, args.stories, n_authors, n_tags)
+        before = time_queries(qs, args.lookups)
+        start = time.perf_counter()
+        conn = m.engine.connect()
+        for i in lookup_indexes():
+            i.create(conn)
+        conn.close()
+        print(f"created indexes in {time.perf_counter() - start:.1f}s")
+        after = time_queries(qs, args.lookups)
+        print(f"{'lookup':<18}{'no index':>12}{'indexed':>12}{'speedup':>10}")
+        for (name, b), (_, a) in zip(before, after):
+            print(f"{name:<18}{b * 1000:>10.3f}ms{a * 1000:>10.3f}ms"
+                  f"{b / a:>9.0f}x")
+        m.ds.close()
+
+if __name__ == '__main__':
+    main()
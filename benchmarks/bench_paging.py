@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# Benchmark for paging through the web view's story listings. Times fetching
+# a page at increasing depths of the all-stories listing, for each sort
+# order, with LIMIT/OFFSET (as the web view used to) and with the keyset
+# pagination in webview.paging, on a synthetic mirror database. Run from the
+# repository root:
+#
+#   python benchmarks/bench_paging.py [--stories 500000] [--pages 0,100,4000]
+
+import argparse, datetime, random, sys, tempfile, time, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ffmirror import metadb  # noqa: E402
+from ffmirror.metadb import Story, Author  # noqa: E402
+from ffmirror.webview import paging  # noqa: E402
+
+page_size = 100
+
+def build(m, n_stories):
+    n_authors = n_stories // 10
+    r = random.Random(1)
+    base = datetime.datetime(2010, 1, 1, tzinfo=datetime.timezone.utc)
+    with m.engine.begin() as conn:
+        conn.execute(Author.__table__.insert(), [
+            {'id': i + 1, 'name': f"Author {r.randrange(n_authors)}",
+             'archive': 'ffnet', 'site_id': str(i), 'in_mirror': True}
+            for i in range(n_authors)])
+        step = 50000
+        for start in range(0, n_stories, step):
+            conn.execute(Story.__table__.insert(), [
+                {'id': i + 1, 'title': f"Story {r.randrange(n_stories)}",
+                 'archive': 'ffnet', 'site_id': str(i),
+                 'author_id': i % n_authors + 1,
+                 'words': r.randrange(500000),
+                 'category': f"Fandom {r.randrange(500)}",
+                 'updated': base + datetime.timedelta(
+                     seconds=r.randrange(10 ** 8))}
+                for i in range(start, min(start + step, n_stories))])
+
+def listing(m):
+    return (m.ds.query(Story, Author).
+            filter(Story.author_id == Author.id).
+            filter(Author.in_mirror == True))  # noqa: E712
+
+def offset_page(m, order, page):
+    key, desc = paging.sorts[order]
+    return (listing(m).order_by(key.desc() if desc else key).
+            limit(page_size).offset(page * page_size).all())
+
+def cursor_for(m, order, page):
+    """The cursor a reader paging through would have on reaching page."""
+    if page == 0:
+        return None
+    key, desc = paging.sorts[order]
+    row = (listing(m).add_columns(key, Story.id).
+           order_by(*([key.desc(), Story.id.desc()] if desc else
+                      [key, Story.id])).
+           offset(page * page_size - 1).limit(1).one())
+    return paging.encode_cursor(order, row[-2], row[-1], False)
+
+def best(f, repeat=3):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--stories', type=int, default=500000)
+    ap.add_argument('--pages', type=str, default='0,100,4000')
+    args = ap.parse_args()
+    pages = [int(i) for i in args.pages.split(',')]
+    with tempfile.TemporaryDirectory() as d:
+        m = metadb.DBMirror(d)
+        m.connect()
+        m.create()
+        build(m, args.stories)
+        start = time.perf_counter()
+        listing(m).count()
+        print(f"full count: {(time.perf_counter() - start) * 1000:.0f}ms "
+              f"(cached after the first page load)")
+        print(f"{'sort':<10}{'page':>6}{'offset ms':>12}{'keyset ms':>12}")
+        for order in paging.sorts:
+            for page in pages:
+                c = cursor_for(m, order, page)
+                t_off = best(lambda: offset_page(m, order, page))
+                t_key = best(lambda: paging.keyset_page(
+                    listing(m), order, c, page_size))
+                print(f"{order:<10}{page:>6}{t_off * 1000:>12.0f}"
+                      f"{t_key * 1000:>12.0f}")
+        m.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# Benchmark for FFNet._get_storytext, which pulls the chapter text out of each
+# downloaded page. Compares the current extractor against the original one
+# (uncompiled regex searches, slicing the page twice) on the saved pages in
+# tests/data and on synthetic pages with chapters of increasing size. Run from
+# the repository root:
+#
+#   python benchmarks/bench_storytext.py [--sizes 0.1,1,5] [--repeat 20]
+#
+# Sizes are in megabytes of chapter text.
+
+import argparse, glob, random, re, sys, time, os
+
+root = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, root)
+
+from ffmirror.handlers.ffnet import FFNet  # noqa: E402
+
+def old_get_storytext(d):
+    o = re.search("<div[^>]*id=[\"']storytext[\"'][^>]*>", d)
+    if o is None:
+        raise Exception("Didn't find storytext")
+    d = d[o.end():]
+    o = re.search("</div>", d)
+    if o is None:
+        raise Exception("Didn't find storytext end")
+    d = d[:o.start()]
+    return d
+
+def make_page(size, seed=0):
+    """A page shaped like an FFnet chapter: some tens of KB of header markup
+    and scripts, the storytext div with about size bytes of paragraphs, then
+    a footer."""
+    rng = random.Random(seed)
+    head = ''.join(f"<div class='nav{i}'><a href='/x/{i}'>link {i}</a></div>\n"
+                   for i in range(600))
+    head += "<script>" + "var x = 1;\n" * 2000 + "</script>\n"
+    text = []
+    total = 0
+    while total < size:
+        p = '<p>' + ' '.join('word' * rng.randint(1, 3)
+                             for _ in range(rng.randint(20, 200))) + '</p>'
+        text.append(p)
+        total += len(p)
+    return (head + "<div class='storytext xcontrast_txt nocopy' "
+            "id='storytext'>" + ''.join(text) + "\n</div></div>\n" + head)
+
+def best_time(f, s, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f(s)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--sizes', default='0.1,1,5',
+                    help="synthetic chapter sizes to test, in MB")
+    ap.add_argument('--repeat', type=int, default=20)
+    args = ap.parse_args()
+
+    new = FFNet()._get_storytext
+    pages = []
+    for fn in sorted(glob.glob(os.path.join(root, 'tests', 'data',
+                                            'ffnet_*.html'))):
+        d = open(fn).read()
+        if 'storytext' in d:
+            pages.append((os.path.basename(fn), d))
+    for mb in (float(i) for i in args.sizes.split(',')):
+        pages.append((f"synthetic {mb:g}M", make_page(int(mb * 1024 * 1024))))
+
+    print(f"{'page':<22}{'size':>10}{'old ms':>10}{'new ms':>10}"
+          f"{'speedup':>9}")
+    for name, d in pages:
+        assert old_get_storytext(d) == new(d)
+        to = best_time(old_get_storytext, d, args.repeat)
+        tn = best_time(new, d, args.repeat)
+        print(f"{name:<22}{len(d):>10}{to * 1000:>10.3f}{tn * 1000:>10.3f}"
+              f"{to / tn:>8.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# Benchmark for DBMirror.sync_author on a synthetic author with many favorites.
+# Compares the set-based sync against the old story-by-story path (each
+# listing entry through _story_from_md, one get_author per unseen favorite
+# author), on a fresh mirror each: an initial sync, a resync with nothing
+# changed, and a resync with 10% of stories updated. Run from the repository
+# root:
+#
+#   python benchmarks/bench_sync.py [--favorites 5000] [--authors 1000]
+
+import argparse, datetime, re, sys, tempfile, time, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import event  # noqa: E402
+
+from ffmirror import metadb  # noqa: E402
+from ffmirror.core import DownloadModule, StoryInfo, AuthorInfo  # noqa: E402
+
+utc = datetime.timezone.utc
+
+class BenchSite(DownloadModule):
+    this_site = 'benchsite'
+    hostname = 'bench.example'
+    url_re = re.compile(r"^https://bench\.example/")
+    listing = None
+
+    def get_user_url(self, auth):
+        return ''
+
+    def get_story_url(self, story):
+        return ''
+
+    def download_metadata(self, sid):
+        raise NotImplementedError
+
+    def download_chapter(self, chapter):
+        raise NotImplementedError
+
+    def download_list(self, aid):
+        return self.listing
+
+site = metadb.site_modules['benchsite']
+
+def make_listing(n_fav, n_authors, n_auth=50, bump=0.0):
+    """A listing of n_auth authored stories and n_fav favorites by n_authors
+    other authors. Each story has a fandom tag shared with many others and
+    a tag of its own. The first bump fraction of stories have a later
+    update time."""
+    me = AuthorInfo(name='Reader', id='1', url='', site='benchsite')
+    base = datetime.datetime(2020, 1, 1, tzinfo=utc)
+
+    def story(sid, author, source, n, total):
+        updated = base + datetime.timedelta(
+            days=1 if n < bump * total else 0)
+        return StoryInfo(
+            title=f"Story {sid}", summary='A summary.',
+            category=f"Fandom {n % 20}", id=sid, reviews=0, chapters=10,
+            words=10000, characters='', source=source, author=author,
+            genre='', site='benchsite', updated=updated, published=base,
+            complete=False, story_url='',
+            tags={f"fandom {n % 20}", f"tag {sid}"})
+    auth = [story(f"a{i}", me, 'authored', i, n_auth) for i in range(n_auth)]
+    others = [AuthorInfo(name=f"Author {i}", id=str(100 + i), url='',
+                         site='benchsite') for i in range(n_authors)]
+    fav = [story(f"f{i}", others[i % n_authors], 'favorites', i, n_fav)
+           for i in range(n_fav)]
+    return auth, fav, me
+
+def legacy_sync(m, archive, aid):
+    """The story-by-story sync_author, as it was before the set-based one."""
+    ds = m.ds
+    ao = m.get_author(archive, aid)
+    auth, fav, info = site.listing
+    if not ao:
+        ao = metadb.Author(name=info.name, archive=archive, site_id=aid)
+        ds.add(ao)
+    else:
+        ao = m.cache_load_author(ao)
+    ao.md_synced = datetime.datetime.now(tz=utc)
+    si_d = {}
+    for s in ao.stories_written + ao.fav_stories:
+        si_d[s.site_id] = s
+    for sm in auth:
+        m._story_from_md(sm, ao, si_d.get(sm.id))
+    for sm in fav:
+        ms = si_d.get(sm.id)
+        fao = ms.author if ms else m.get_author(archive, sm.author.id)
+        if not fao:
+            fao = metadb.Author(name=sm.author.name, archive=archive,
+                                site_id=sm.author.id)
+            ds.add(fao)
+        so = m._story_from_md(sm, fao, ms)
+        if so not in ao.fav_stories:
+            ao.fav_stories.append(so)
+    ds.commit()
+
+def timed(m, f):
+    count = [0]
+
+    def before(*args):
+        count[0] += 1
+    event.listen(m.engine, 'before_cursor_execute', before)
+    start = time.perf_counter()
+    try:
+        f()
+    finally:
+        event.remove(m.engine, 'before_cursor_execute', before)
+    return time.perf_counter() - start, count[0]
+
+def run(name, sync, args):
+    with tempfile.TemporaryDirectory() as d:
+        m = metadb.DBMirror(d)
+        m.connect()
+        m.create()
+        for label, bump in [('initial', 0.0), ('unchanged', 0.0),
+                            ('10% updated', 0.1)]:
+            site.listing = make_listing(args.favorites, args.authors,
+                                        bump=bump)
+            t, n = timed(m, lambda: sync(m))
+            print(f"{name:<12}{label:<14}{t:>9.2f}s{n:>12}")
+        m.ds.close()
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--favorites', type=int, default=5000)
+    ap.add_argument('--authors', type=int, default=1000)
+    args = ap.parse_args()
+    print(f"{'path':<12}{'sync':<14}{'time':>10}{'statements':>12}")
+    run('set-based', lambda m: m.sync_author(('benchsite', '1')), args)
+    run('legacy', lambda m: legacy_sync(m, 'benchsite', '1'), args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+# An on-disk cache for fetched pages. Entries are stored under a directory
+# sharded by URL hash (ab/cd/abcd...), each file holding a small JSON header
+# followed by the compressed response body. Bodies are compressed with zstd if
+# the zstandard package is installed, gzip otherwise; the codec is recorded in
+# each file, so a cache can be read whichever is available (zstd entries are
+# treated as misses without zstandard).
+
+from __future__ import annotations
+
+import os, re, time, json, gzip, struct, threading, tempfile, hashlib
+from attrs import define, asdict
+
+from typing import Optional, List, Tuple, Pattern, Dict, Any, Mapping
+
+try:
+    import zstandard  # type: ignore
+except Exception:
+    zstandard = None
+
+magic = b'FFC1'
+codec_gzip = b'g'
+codec_zstd = b'z'
+
+default_dir = os.environ.get(
+    'FFMIRROR_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.ffmirror_cache'))
+
+hour = 3600.0
+day = 24 * hour
+
+# TTLs by URL class, checked in order; the first matching pattern wins. Chapter
+# pages rarely change once posted, while listing pages are how we find
+# updates, so they're kept only briefly.
+default_ttl_rules: List[Tuple[Pattern, float]] = [
+    (re.compile(r"/works/\d+/chapters/\d+"), 7 * day),
+    (re.compile(r"/s/\d+/(?!1/)\d+/"), 7 * day),
+    (re.compile(r"/(u|users)/"), 1 * hour),
+]
+
+def validators_from(headers: Mapping[str, str]) -> Dict[str, str]:
+    """Pick the cache validators out of a response's headers, for storing in an
+    entry header."""
+    rv = {}
+    if headers.get('ETag'):
+        rv['etag'] = headers['ETag']
+    if headers.get('Last-Modified'):
+        rv['last_modified'] = headers['Last-Modified']
+    return rv
+
+@define
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    revalidations: int = 0
+    evictions: int = 0
+
+    def to_dict(self) -> Dict[str, int]:
+        return asdict(self)
+
+class HTTPCache:
+    """A size-bounded on-disk cache of page bodies, keyed by URL. get() returns a
+    body if one is cached and fresh under the TTL for its URL class, and
+    put() stores one. When the cache grows past max_size bytes, the least
+    recently used entries are evicted until it's back under low_water of
+    that. Recency is tracked with file mtimes, which get() touches on every
+    hit. Hit, miss, store and eviction counts are kept in stats.
+
+    Entries keep the ETag and Last-Modified validators they were stored with
+    (put() takes them in header, as from validators_from()), so once stale
+    they can be revalidated: conditional_headers() gives the request headers
+    for that, and revalidated() marks the entry fresh again after a 304.
+
+    """
+    def __init__(self, path: Optional[str] = None,
+                 max_size: int = 1024 ** 3, default_ttl: float = 12 * hour,
+                 ttl_rules: Optional[List[Tuple[Pattern, float]]] = None,
+                 low_water: float = 0.9) -> None:
+        self.path = path if path is not None else default_dir
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.ttl_rules = (ttl_rules if ttl_rules is not None else
+                          default_ttl_rules)
+        self.low_water = low_water
+        self.stats = CacheStats()
+        self._size: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def ttl_for(self, url: str) -> float:
+        for r, ttl in self.ttl_rules:
+            if r.search(url):
+                return ttl
+        return self.default_ttl
+
+    def entry_path(self, url: str) -> str:
+        h = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.path, h[:2], h[2:4], h)
+
+    @staticmethod
+    def _encode(header: Dict[str, Any], data: bytes) -> bytes:
+        if zstandard is not None:
+            codec = codec_zstd
+            body = zstandard.ZstdCompressor().compress(data)
+        else:
+            codec = codec_gzip
+            body = gzip.compress(data, compresslevel=6)
+        hb = json.dumps(header).encode()
+        return magic + codec + struct.pack('>I', len(hb)) + hb + body
+
+    @staticmethod
+    def _decode(raw: bytes) -> Optional[Tuple[Dict[str, Any], bytes]]:
+        if raw[:4] != magic:
+            return None
+        codec = raw[4:5]
+        hl, = struct.unpack('>I', raw[5:9])
+        header = json.loads(raw[9:9 + hl])
+        body = raw[9 + hl:]
+        if codec == codec_gzip:
+            return header, gzip.decompress(body)
+        elif codec == codec_zstd and zstandard is not None:
+            return header, zstandard.ZstdDecompressor().decompress(body)
+        return None
+
+    @staticmethod
+    def _read_header(fn: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(fn, 'rb') as inp:
+                pre = inp.read(9)
+                if pre[:4] != magic:
+                    return None
+                hl, = struct.unpack('>I', pre[5:9])
+                return json.loads(inp.read(hl))
+        except Exception:
+            return None
+
+    def read_entry(self, url: str) -> Optional[Tuple[Dict[str, Any], bytes]]:
+        """Read the entry for url, fresh or not, without touching stats. Returns
+        (header, body) or None. Unreadable or corrupt entries count as
+        missing."""
+        fn = self.entry_path(url)
+        try:
+            with open(fn, 'rb') as inp:
+                return self._decode(inp.read())
+        except Exception:
+            return None
+
+    def get(self, url: str) -> Optional[bytes]:
+        e = self.read_entry(url)
+        if e is None or e[0].get('url') != url or \
+           e[0]['stored'] < time.time() - self.ttl_for(url):
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        try:
+            os.utime(self.entry_path(url))
+        except OSError:
+            pass
+        return e[1]
+
+    def conditional_headers(self, url: str) -> Dict[str, str]:
+        """Request headers that make a fetch of url conditional on the cached
+        entry, if there is one and it has validators. Empty if not."""
+        h = self._read_header(self.entry_path(url))
+        rv: Dict[str, str] = {}
+        if h is None or h.get('url') != url:
+            return rv
+        if 'etag' in h:
+            rv['If-None-Match'] = h['etag']
+        if 'last_modified' in h:
+            rv['If-Modified-Since'] = h['last_modified']
+        return rv
+
+    def revalidated(self, url: str) -> Optional[bytes]:
+        """Mark the entry for url fresh again, after the server has answered a
+        conditional request with 304 Not Modified. Returns the cached body, or
+        None if the entry is gone."""
+        e = self.read_entry(url)
+        if e is None or e[0].get('url') != url:
+            return None
+        header, data = e
+        self._write(url, data, header)
+        self.stats.revalidations += 1
+        return data
+
+    def put(self, url: str, data: bytes,
+            header: Optional[Dict[str, Any]] = None) -> None:
+        self._write(url, data, header)
+        self.stats.stores += 1
+
+    def _write(self, url: str, data: bytes,
+               header: Optional[Dict[str, Any]]) -> None:
+        h = dict(header) if header is not None else {}
+        h['url'] = url
+        h['stored'] = time.time()
+        raw = self._encode(h, data)
+        fn = self.entry_path(url)
+        d = os.path.dirname(fn)
+        os.makedirs(d, exist_ok=True)
+        try:
+            old_size = os.stat(fn).st_size
+        except OSError:
+            old_size = 0
+        # write to a temp file and rename, so readers never see a partial
+        # entry
+        fd, tmp = tempfile.mkstemp(dir=d, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.write(raw)
+            os.replace(tmp, fn)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        with self._lock:
+            if self._size is not None:
+                self._size += len(raw) - old_size
+        if self.size() > self.max_size:
+            self.evict()
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        rv = []
+        for dp, dns, fns in os.walk(self.path):
+            for f in fns:
+                fn = os.path.join(dp, f)
+                try:
+                    st = os.stat(fn)
+                except OSError:
+                    continue
+                rv.append((st.st_mtime, st.st_size, fn))
+        return rv
+
+    def size(self) -> int:
+        """The total size of the cache in bytes. This is computed by scanning the
+        cache directory the first time, then kept up to date as entries are
+        added."""
+        with self._lock:
+            if self._size is None:
+                self._size = sum(i[1] for i in self._entries())
+            return self._size
+
+    def evict(self, target: Optional[int] = None) -> int:
+        """Remove least recently used entries until the cache is no bigger than
+        target bytes (by default, low_water of max_size). Returns the number
+        of entries removed."""
+        if target is None:
+            target = int(self.max_size * self.low_water)
+        with self._lock:
+            entries = sorted(self._entries())
+            size = sum(i[1] for i in entries)
+            removed = 0
+            for mtime, fsize, fn in entries:
+                if size <= target:
+                    break
+                try:
+                    os.unlink(fn)
+                except OSError:
+                    continue
+                size -= fsize
+                removed += 1
+            self._size = size
+            self.stats.evictions += removed
+        return removed
+
+    def prune(self) -> int:
+        """Remove every entry that has expired under its TTL, then evict down to
+        max_size if still over it. Returns the number of entries removed.
+        Expired entries with an ETag or Last-Modified are kept, since they can
+        still be revalidated with a conditional request much more cheaply
+        than they could be fetched again; they go only when LRU eviction
+        reaches them.
+
+        """
+        removed = 0
+        now = time.time()
+        for mtime, fsize, fn in self._entries():
+            h = self._read_header(fn)
+            if h is None or (h['stored'] < now - self.ttl_for(h['url']) and
+                             'etag' not in h and 'last_modified' not in h):
+                try:
+                    os.unlink(fn)
+                except OSError:
+                    continue
+                removed += 1
+        with self._lock:
+            self._size = None
+            self.stats.evictions += removed
+        if self.size() > self.max_size:
+            removed += self.evict(self.max_size)
+        return removed
+
+default_cache = HTTPCache()
@@ -7,7 +7,7 @@
 # separate module APIs.
 
 import sys, argparse, os, json
-from . import util, mirror, metadb, site_modules
+from . import util, mirror, metadb, cache, site_modules
 from .core import url_res, DownloadModule
 from .util import JobStatus
 from typing import Optional
@@ -180,20 +180,34 @@ def do_cache() -> None:
     cur_mirror.make_cache()
 
 @click.group()
-def run_db_op() -> None:
-    pass
+@click.option("--parser", type=click.Choice(util.available_parsers()),
+              default=None, help="HTML parser backend to use for site pages")
+@click.option("--db-profile", type=click.Choice(list(metadb.db_profiles)),
+              default=None, help="SQLite settings for the mirror database")
+def run_db_op(parser: Optional[str], db_profile: Optional[str]) -> None:
+    if parser is not None:
+        util.set_html_parser(parser)
+    if db_profile is not None:
+        metadb.set_db_profile(db_profile)
 
 def job_progress(j: JobStatus) -> None:
+    # with several queues running, lines are prefixed with their queue, and
+    # chapters get a line each rather than overwriting one another's
+    pre = f"[{j.queue}] " if j.queue is not None else ''
     if j.type == 'author':
-        print(f"Syncing author {j.name} ({j.progress}/{j.total})")
+        print(f"{pre}Syncing author {j.name} ({j.progress}/{j.total})")
     elif j.type == 'story':
-        print(f"Downloading story '{j.name}'")
+        print(f"{pre}Downloading story '{j.name}'")
     elif j.type == 'chapter':
-        print(f"\r\x1b[2Kch.{j.progress+1}/{j.total}: {j.name}", end='')
-        if j.progress + 1 == j.total:
-            print()
+        line = f"{pre}ch.{j.progress+1}/{j.total}: {j.name}"
+        if j.queue is not None:
+            print(line)
+        else:
+            print(f"\r\x1b[2K{line}", end='')
+            if j.progress + 1 == j.total:
+                print()
     elif j.type == 'error':
-        print(f"Error: {j.name}")
+        print(f"{pre}Error: {j.name}")
         print(j.info)
 
 @run_db_op.command()
@@ -205,8 +219,11 @@ def job_progress(j: JobStatus) -> None:
               default=None)
 @click.option("-s", "--silent", type=bool, is_flag=True, default=False,
               help="Suppress progress display")
+@click.option("-r", "--refresh", type=bool, is_flag=True, default=False,
+              help="Fetch every chapter of updated stories again, not just "
+              "new ones")
 def update(author_dir: Optional[str], max_authors: Optional[int],
-           silent: bool) -> None:
+           silent: bool, refresh: bool) -> None:
     """Update the DB. If author-dir is given, update only that author."""
     mm = metadb.DBMirror('.')
     mm.connect()
@@ -220,9 +237,9 @@ def update(author_dir: Optional[str], max_authors: Optional[int],
         site, aid = metadb.get_archive_id(dn)
         ao = mm.get_author(site, aid)
         mm.sync_author(ao)
-        mm.archive_author(ao, progress=pf)
+        mm.archive_author(ao, progress=pf, refresh=refresh)
     else:
-        mm.run_update(max_authors=max_authors, progress=pf)
+        mm.run_update(max_authors=max_authors, progress=pf, refresh=refresh)
 
 @run_db_op.command()
 @click.option("-s", "--silent", type=bool, is_flag=True, default=False,
@@ -250,6 +267,14 @@ def init():
     mm.connect()
     mm.create()
 
+@run_db_op.command()
+def prune_cache():
+    """Remove expired pages that can't be revalidated from the fetch cache,
+    and trim it to size."""
+    c = cache.default_cache
+    n = c.prune()
+    print(f"Removed {n} entries; cache at {c.path} is now {c.size():,} bytes")
+
 @run_db_op.command()
 def migrate():
     """Migrate from old versions of the DB to the latest version."""
@@ -3,11 +3,11 @@
 from __future__ import annotations
 
 from typing import (Dict, List, Tuple, Pattern, Any, TextIO, Callable, Set,
-                    Optional)
+                    Optional, Iterator)
 from abc import ABCMeta, abstractmethod
 from os.path import join
 from .util import make_filename
-import attr, datetime, time
+import attr, datetime, time, itertools
 
 @attr.s(auto_attribs=True)
 class StoryInfo:
@@ -88,6 +88,9 @@ class AuthorInfo:
         return "{}-{}-{}".format(make_filename(self.name),
                                  self.site, self.id)
 
+# The is_known callback a site module's iter_list() may be given: whether all
+# of a list of stories are already in the mirror and unchanged.
+KnownCheck = Callable[[List[StoryInfo]], bool]
 
 site_modules: Dict[str, DownloadModule] = {}
 url_res: List[Tuple[Pattern, DownloadModule]] = []
@@ -105,6 +108,17 @@ class DownloadModule(metaclass=TypeRegister):
     story_url_re: Pattern
     user_url_re: Pattern
     this_site: str
+    hostname: str
+
+    @property
+    def fetch_queue(self) -> str:
+        """The name of the queue this module's fetches are made on. DBMirror's
+        update runs each queue in its own thread. Modules still share the
+        process's fetcher, rate limiter and browser pool, but their limits
+        are per host, so modules on different hosts don't wait on each other.
+
+        """
+        return self.hostname
 
     @abstractmethod
     def get_user_url(self, auth: AuthorInfo) -> str:
@@ -181,8 +195,46 @@ body {{ font-family: sans-serif }}
     def download_chapter(self, chapter: ChapterInfo) -> str:
         ...
 
+    # How many chapter fetches may be in flight at once for this site. Fetches
+    # still take their slots from the rate limiter, so raising this only helps
+    # where the site's limit allows bursts.
+    max_inflight = 1
+
+    # fetch_chapter() and extract_chapter() split download_chapter() into its
+    # network and processing halves, so that DBMirror.story_to_archive can
+    # pipeline them. The defaults do all the work in the fetch stage; site
+    # modules should override both.
+    def fetch_chapter(self, chapter: ChapterInfo) -> str:
+        """Fetch and return the raw page for a chapter."""
+        return self.download_chapter(chapter)
+
+    def extract_chapter(self, page: str) -> str:
+        """Given a page returned by fetch_chapter(), return the chapter text as
+        download_chapter() would."""
+        return page
+
     @abstractmethod
     def download_list(self, aid: str) -> Tuple[List[StoryInfo],
                                                List[StoryInfo],
                                                AuthorInfo]:
         ...
+
+    def iter_list(self, aid: str,
+                  is_known: Optional[KnownCheck] = None
+                  ) -> Tuple[AuthorInfo, Iterator[StoryInfo]]:
+        """The streaming form of download_list(): returns the author's info, and an
+        iterator over their authored and favorited stories (told apart by
+        source) that fetches and parses listing pages as it goes. The default
+        just wraps download_list(); site modules with large or paginated
+        listings should override it.
+
+        is_known, if given, says whether all of a list of stories (e.g. a
+        page of the listing) are already in the mirror and unchanged; it
+        costs one query however many there are. Modules whose listings are
+        ordered by update time may use it to stop early, once the listing
+        reaches a page of stories that are all known; they needn't use it at
+        all.
+
+        """
+        auth, fav, info = self.download_list(aid)
+        return info, itertools.chain(auth, fav)
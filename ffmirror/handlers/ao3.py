@@ -1,15 +1,56 @@
-# Site module for Archive Of Our Own.
+# Site module for Archive Of Our Own. Only the author listings are written so
+# far; story metadata and chapters aren't, so the module can't be a
+# DownloadModule yet and isn't registered in site_modules. The listings
+# return the same StoryInfo and AuthorInfo objects as registered modules do.
 
 import re
-from bs4 import BeautifulSoup  # type: ignore
+from bs4 import SoupStrainer  # type: ignore
 from bs4.element import Tag  # type: ignore
 # from urllib.parse import urljoin
 from datetime import datetime
 import html2text  # type: ignore
 
-from typing import Dict, Any, Tuple, List, Set, Optional
-
-from ..util import urlopen_retry, rectify_strings, make_filename
+from typing import Any, Tuple, List, Set, Optional, Iterator
+
+from ..util import (urlopen_many, make_filename, make_soup, class_filter,
+                    AsyncFetcher)
+from ..core import StoryInfo, AuthorInfo, KnownCheck
+
+# Listing pages are parsed only in the parts we read: the work blurbs, the
+# pagination links and the heading with the author's name.
+listing_strainer = SoupStrainer(
+    ['li', 'ol', 'h2'],
+    attrs={'class': class_filter('blurb', 'pagination', 'heading')})
+
+class _Listing(object):
+    """The state of one paginated listing being read by AO3.iter_list()."""
+    def __init__(self, url: str, source: str, first: Any,
+                 is_known: Optional[KnownCheck] = None
+                 ) -> None:
+        self.url = url
+        self.source = source
+        self.is_known = is_known
+        self.done = False
+        self.next_page = 2
+        pl = first.find('ol', class_='pagination')
+        if pl:
+            self.max_page = max(self._get_page(i['href']) for i in pl('a'))
+        else:
+            self.max_page = 1
+
+    @staticmethod
+    def _get_page(u: str) -> int:
+        o = re.search(r'page=(\d+)', u)
+        return int(o.group(1)) if o else 1
+
+    def next_urls(self, n: int) -> List[str]:
+        """URLs for the next n pages, or fewer if the listing ends sooner."""
+        end = min(self.next_page + n, self.max_page + 1)
+        rv = [self.url + '?page=' + str(i) for i in range(self.next_page, end)]
+        self.next_page = end
+        if not rv:
+            self.done = True
+        return rv
 
 def parse_int(s):
     return int(s.replace(',', ''))
@@ -21,50 +62,51 @@ class AO3(object):
     user_url = "https://{hostname}/users/{aid}/works"
     user_bookmarks_url = "https://{hostname}/users/{aid}/bookmarks"
 
-    def get_user_url(self, md: Dict[str, Any]) -> str:
-        return self.user_url.format(aid=md['authorid'], hostname=self.hostname)
+    def get_user_url(self, auth: AuthorInfo) -> str:
+        return self.user_url.format(aid=auth.id, hostname=self.hostname)
+
+    def get_story_url(self, story: StoryInfo) -> str:
+        return self.story_url.format(number=story.id, hostname=self.hostname)
 
-    def get_story_url(self, md: Dict[str, Any]) -> str:
-        return self.story_url.format(number=md['id'], hostname=self.hostname)
+    def _author_info(self, name: str, aid: str) -> AuthorInfo:
+        return AuthorInfo(
+            name=name, id=aid, site=self.this_site,
+            url=self.user_url.format(hostname=self.hostname, aid=aid),
+            dir="{}-{}-{}".format(make_filename(name), self.this_site, aid))
 
-    def _parse_html_entry(self, i: Tag) -> Optional[Dict[str, Any]]:
-        rv = {}
+    def _parse_html_entry(self, i: Tag, source: str) -> Optional[StoryInfo]:
         o = i.p
         if o is not None and 'message' in o['class']:
             return None
         hh = i.find('h4', class_='heading')
-        rv['title'] = hh.a.string
+        title = hh.a.string
         if 'series' in hh.a['href']:
             return None
         o = re.search(r'\d+', hh.a['href'])
         assert o is not None
-        rv['id'] = o.group(0)
+        sid = o.group(0)
         al = hh.find('a', rel='author')
-        rv['author'] = al.string
         o = re.match(r'/users/(\w+)/', al['href'])
         assert o is not None
-        rv['authorid'] = o.group(1)
-        fandoms = [l.string for l in i.find('h5', class_='fandoms')
+        author = self._author_info(al.string, o.group(1))
+        fandoms = [str(l.string) for l in i.find('h5', class_='fandoms')
                    ('a', class_='tag')]
-        rv['category'] = ' & '.join(fandoms)
-        rv['updated'] = int(datetime.
-                            strptime(i.find('div', class_='header').
-                                     find('p', class_='datetime').string,
-                                     "%d %b %Y").timestamp())
-        rv['tags'] = set(fandoms)
+        # the listing only gives the date of the last update
+        updated = datetime.strptime(i.find('div', class_='header').
+                                    find('p', class_='datetime').string,
+                                    "%d %b %Y")
+        tags = set(fandoms)
 
         rt = i.find('ul', class_='required-tags')
         rating = rt.find('span', class_='rating').get_text().strip().lower()
-        rv['tags'].add(f"rating: {rating}")
+        tags.add(f"rating: {rating}")
         rels = rt.find('span', class_='category')['title'].split(', ')
-        rv['tags'].update([f"relationships: {l}" for l in rels])
-        rv['complete'] = ('complete-yes' in rt.find('span', class_='iswip')
-                          ['class'])
+        tags.update([f"relationships: {l}" for l in rels])
+        complete = 'complete-yes' in rt.find('span', class_='iswip')['class']
 
         tl = i.find('ul', class_='tags')
         for t in tl('li'):
-            ts = t.find('a', class_='tag').string
-            rv['tags'].add(ts)
+            tags.add(str(t.find('a', class_='tag').string))
 
         ht = html2text.HTML2Text()
         ht.ignore_links = True
@@ -72,82 +114,123 @@ class AO3(object):
         ht.body_width = 0
         se = i.find('blockquote', class_='summary')
         se.name = 'div'
-        rv['summary'] = ht.handle(str(se))
+        summary = ht.handle(str(se))
         se = i.find('dl', class_='stats')
-        rv['language'] = se.find('dd', class_='language').string
-        rv['words'] = parse_int(se.find('dd', class_='words').string)
-        rv['chapters'] = parse_int(se.find('dd', class_='chapters').string.
-                                   split('/')[0])
+        words = parse_int(se.find('dd', class_='words').string)
+        chapters = parse_int(se.find('dd', class_='chapters').string.
+                             split('/')[0])
         try:
-            rv['reviews'] = parse_int(se.find('dd', class_='comments').
-                                      get_text().strip())
+            reviews = parse_int(se.find('dd', class_='comments').
+                                get_text().strip())
         except Exception:
-            rv['reviews'] = 0
-        return rectify_strings(rv)
-
-    def download_list(self, number: str) -> Tuple[List[Dict[str, Any]],
-                                                  List[Dict[str, Any]],
-                                                  Dict[str, Any]]:
-        """Despite the name, "number" is just the string username from the URL."""
+            reviews = 0
+        rv = StoryInfo(
+            title=title, summary=summary, category=' & '.join(fandoms),
+            id=sid, reviews=reviews, chapters=chapters, words=words,
+            characters='', source=source, author=author, genre='',
+            site=self.this_site, updated=updated, published=updated,
+            complete=complete, story_url='', tags=tags)
+        rv.story_url = self.get_story_url(rv)
+        return rv
+
+    # How many pages of each listing to request at once. Pages are still
+    # fetched through the shared per-host limiter, so this doesn't speed up
+    # the request rate; it lets requests overlap each other's latency.
+    page_window = 4
+
+    def _fetch_pages(self, urls: List[str], fetcher: AsyncFetcher
+                     ) -> List[Any]:
+        """Fetch and parse several listing pages concurrently."""
+        rv = []
+        for u, r in zip(urls, urlopen_many(urls, fetcher=fetcher)):
+            if r is None:
+                raise Exception(f"Couldn't fetch {u}")
+            rv.append(make_soup(r.read(), parse_only=listing_strainer))
+        return rv
+
+    def _parse_page(self, soup: Any, source: str) -> Iterator[StoryInfo]:
+        for i in soup('li', class_='blurb'):
+            try:
+                r = self._parse_html_entry(i, source)
+                if r is not None:
+                    yield r
+            except Exception:
+                print(i)
+                raise
+
+    def iter_list(self, number: str,
+                  is_known: Optional[KnownCheck] = None
+                  ) -> Tuple[AuthorInfo, Iterator[StoryInfo]]:
+        """The streaming form of download_list(): returns the author's info, and an
+        iterator over their works and bookmarks, with source set to
+        'authored' or 'favorites'. The first pages of both listings are
+        fetched together, and then the rest page_window pages of each at a
+        time as the iterator reaches them, so works and bookmarks entries come
+        interleaved. The fetcher's threads are shut down once the iterator is
+        exhausted or closed.
+
+        Works are listed most recently updated first, so if is_known is
+        given, it's called with each page of works, and the works listing
+        stops after the first page for which it's true (i.e. every story on
+        it is already known and unchanged). Bookmarks are listed by date
+        bookmarked, so they're always read in full.
+
+        """
         url = self.user_url.format(hostname=self.hostname, aid=number)
-        data = urlopen_retry(url)
-        assert data is not None
-        soup = BeautifulSoup(data.read(), 'html5lib')
-
-        def download_with_pages(url):
-            rv = []
-            page = urlopen_retry(url).read()
-            soup = BeautifulSoup(page, 'html5lib')
-
-            def make_page(n):
-                return url + '?page=' + str(n)
-
-            def get_page(u):
-                if 'page=' not in u:
-                    return 1
-                else:
-                    return int(re.search(r'page=(\d+)', u).group(1))
-
-            pl = soup.find('ol', class_='pagination')
-            if pl:
-                max_page = max(get_page(i['href']) for i in pl('a'))
-            else:
-                max_page = 1
-
-            def parse_page(soup):
-                e = soup.find('div', id='main').find('ol', class_='index')
-                for i in e('li', class_='blurb'):
-                    try:
-                        r = self._parse_html_entry(i)
-                        if r is not None:
-                            rv.append(r)
-                    except Exception:
-                        print(i)
-                        raise
-
-            parse_page(soup)
-            for i in range(2, max_page + 1):
-                u = make_page(i)
-                s = BeautifulSoup(urlopen_retry(u).read(), 'html5lib')
-                parse_page(s)
-
-            return rv
-
-        auth = download_with_pages(url)
         fav_url = self.user_bookmarks_url.format(hostname=self.hostname,
                                                  aid=number)
-        fav = download_with_pages(fav_url)
-
-        aname = (soup.find('div', id='main').find('h2', class_='heading').
-                 string.split(' Works by ')[1].strip())
-        author_dir = "{}-{}-{}".format(make_filename(aname), self.this_site,
-                                       number)
-        info = { 'author': aname, 'authorid': number, 'site': self.this_site,
-                 'author_url': url, 'author_dir': author_dir }
+        fetcher = AsyncFetcher(host_concurrency=self.page_window)
+        try:
+            first, fav_first = self._fetch_pages([url, fav_url], fetcher)
+            aname = None
+            for h in first('h2', class_='heading'):
+                if ' Works by ' in h.get_text():
+                    aname = h.get_text().split(' Works by ')[1].strip()
+                    break
+            assert aname is not None
+        except BaseException:
+            fetcher.close()
+            raise
+        info = self._author_info(aname, number)
+
+        def entries() -> Iterator[StoryInfo]:
+            listings = [_Listing(url, 'authored', first, is_known),
+                        _Listing(fav_url, 'favorites', fav_first)]
+            pages = list(zip(listings, [first, fav_first]))
+            try:
+                while pages:
+                    for l, soup in pages:
+                        if l.done:
+                            continue
+                        page = list(self._parse_page(soup, l.source))
+                        yield from page
+                        if (l.is_known is not None and page and
+                            l.is_known(page)):  # noqa: E129
+                            l.done = True
+                    batch = [(l, u) for l in listings if not l.done
+                             for u in l.next_urls(self.page_window)]
+                    if not batch:
+                        break
+                    soups = self._fetch_pages([u for l, u in batch], fetcher)
+                    pages = [(l, s) for (l, u), s in zip(batch, soups)]
+            finally:
+                fetcher.close()
+        return info, entries()
+
+    def download_list(
+            self, number: str,
+            is_known: Optional[KnownCheck] = None
+    ) -> Tuple[List[StoryInfo], List[StoryInfo], AuthorInfo]:
+        """Despite the name, "number" is just the string username from the URL."""
+        info, entries = self.iter_list(number, is_known)
+        auth: List[StoryInfo] = []
+        fav: List[StoryInfo] = []
+        for r in entries:
+            (auth if r.source == 'authored' else fav).append(r)
         return auth, fav, info
 
-    def get_tags_for(self, md: Dict[str, Any]) -> Set[str]:
-        return md['tags']
+    def get_tags_for(self, md: StoryInfo) -> Set[str]:
+        return md.tags
 
     def download_metadata(self, number):
         url = self.story_url.format(hostname=self.hostname, number=number)
@@ -10,7 +10,7 @@ from bs4 import BeautifulSoup  # type: ignore
 from bs4.element import Tag  # type: ignore
 from datetime import datetime
 
-from typing import Set, List, Tuple
+from typing import Set, List, Tuple, Iterator, Optional
 
 try:
     from selenium.webdriver.support.wait import WebDriverWait
@@ -18,9 +18,10 @@ try:
 except ModuleNotFoundError:
     WebDriverWait = None
 
-from ..util import (make_filename, BrowserFetcher,
+from ..util import (make_filename, make_soup, HybridFetcher,
                     fold_string_indiscriminately)
-from ..core import DownloadModule, StoryInfo, AuthorInfo, ChapterInfo
+from ..core import (DownloadModule, StoryInfo, AuthorInfo, ChapterInfo,
+                    KnownCheck)
 
 def cat_to_tagset(category: str) -> Set[str]:
     """Takes a category string, splits by crossover if necessary, returns a set of
@@ -35,9 +36,36 @@ def cat_to_tagset(category: str) -> Set[str]:
         rv.add(i.lower().replace(",", ""))
     return rv
 
+# The start tag of the div holding a chapter's text.
+storytext_start_re = re.compile(r"<div[^>]*id=[\"']storytext[\"'][^>]*>")
+storytext_end_re = re.compile(r"</div>")
+
+# The start of a story entry on a profile page.
+listing_start_re = re.compile(r"<div[^>]*\bz-list\b")
+
+def listing_entries(page: str) -> Iterator[Tag]:
+    """Parse the story entries out of a profile page one at a time. Profile pages
+    can hold thousands of favorites, and nearly all of the page is entries,
+    so rather than building a tree for the whole page this cuts the HTML at
+    the start of each entry and parses each piece on its own; only one
+    entry's tree is held at a time.
+
+    """
+    starts = [o.start() for o in listing_start_re.finditer(page)]
+    for n, st in enumerate(starts):
+        end = starts[n + 1] if n + 1 < len(starts) else len(page)
+        e = make_soup(page[st:end]).find('div', class_='z-list')
+        if e is not None:
+            yield e
+
 def ffnet_visible(driver):
     return driver.find_element(By.ID, "name_login")
 
+def ffnet_page_ok(html: str) -> bool:
+    """The plain-HTTP counterpart of ffnet_visible: check that a page is the real
+    site and not a challenge."""
+    return 'name_login' in html
+
 # A site module needs to implement the following:
 #  - get_user_url(self, md):
 #    given a story metadata object, return a canonical link for the author
@@ -50,6 +78,9 @@ def ffnet_visible(driver):
 #  - download_list(self, aid):
 #    given author ID, download a list of stories as metadata (metadata entries
 #    may be incomplete)
+#  - iter_list(self, aid) (optional):
+#    as download_list, but return author info and an iterator over stories,
+#    for listings too big to materialize at once
 class FFNet(DownloadModule):
     hostname = "www.fanfiction.net"
     this_site = "ffnet"
@@ -86,7 +117,10 @@ class FFNet(DownloadModule):
                             ))]
         rv: List[ChapterInfo] = []
         for n, oe in enumerate(se.find_all('option')):
-            o = re.match(r"\d+. (.*)", oe.string)
+            # FFnet doesn't close its <option> tags, so depending on the parser
+            # the following options may be nested in this one; the title is
+            # the first string either way
+            o = re.match(r"\d+. (.*)", oe.find(string=True))
             assert o is not None
             val = o.group(1)
             rv.append(
@@ -110,15 +144,16 @@ class FFNet(DownloadModule):
 
     def _get_storytext(self, d: str) -> str:
         """Takes a page of HTML, extracts the storytext, returns it."""
-        o = re.search("<div[^>]*id=[\"']storytext[\"'][^>]*>", d)
+        o = storytext_start_re.search(d)
         if o is None:
             raise Exception("Didn't find storytext")
-        d = d[o.end():]
-        o = re.search("</div>", d)
-        if o is None:
+        # the storytext has no nested divs, so it ends at the first </div>;
+        # searching on from the start tag means the page is only copied once,
+        # for the result
+        e = storytext_end_re.search(d, o.end())
+        if e is None:
             raise Exception("Didn't find storytext end")
-        d = d[:o.start()]
-        return d
+        return d[o.end():e.start()]
 
     def _get_metadata(self, soup: BeautifulSoup) -> StoryInfo:
         """Given a BeautifulSoup of an FFnet page, extract a metadata entry. Somewhat
@@ -195,11 +230,13 @@ class FFNet(DownloadModule):
         return storyinf
 
     @property
-    def fetcher(self) -> BrowserFetcher:
+    def fetcher(self) -> HybridFetcher:
+        # the browser is used only to pass Cloudflare; pages are then fetched
+        # over plain HTTP with its cookies until challenged again
         try:
             return self._fetcher
         except AttributeError:
-            self._fetcher = BrowserFetcher(ffnet_visible)
+            self._fetcher = HybridFetcher(ffnet_visible, ffnet_page_ok)
             return self._fetcher
 
     def download_metadata(self, number: str) -> Tuple[StoryInfo,
@@ -212,17 +249,22 @@ class FFNet(DownloadModule):
         url = self.story_url.format(hostname=self.hostname, number=number,
                                     chapter=1)
         data = self.fetcher.get_html(url)
-        soup = BeautifulSoup(data, 'html5lib')
+        soup = make_soup(data)
         md = self._get_metadata(soup)
         toc = self._get_contents(soup, number)
         return md, toc
 
-    def download_chapter(self, chapter: ChapterInfo) -> str:
-        data = self.fetcher.get_html(chapter.url)
-        text = self._get_storytext(data)
+    def fetch_chapter(self, chapter: ChapterInfo) -> str:
+        return self.fetcher.get_html(chapter.url)
+
+    def extract_chapter(self, page: str) -> str:
+        text = self._get_storytext(page)
         text = fold_string_indiscriminately(text)
         return text
 
+    def download_chapter(self, chapter: ChapterInfo) -> str:
+        return self.extract_chapter(self.fetch_chapter(chapter))
+
     # Functions related to dealing with user listings
 
     def _parse_entry(self, elem: Tag) -> StoryInfo:
@@ -287,40 +329,59 @@ class FFNet(DownloadModule):
         )
         return storyinfo
 
-    def download_list(self, number: str) -> Tuple[List[StoryInfo],
-                                                  List[StoryInfo],
-                                                  AuthorInfo]:
-        """Given a user ID, download lists of the stories they've written and favorited
-        and return them. The lists are returned as a tuple of (authored,
-        faved). Each entry is a dictionary containing metadata.
+    def iter_list(self, number: str,
+                  is_known: Optional[KnownCheck] = None
+                  ) -> Tuple[AuthorInfo, Iterator[StoryInfo]]:
+        """Given a user ID, fetch their profile and return their info and an iterator
+        over the stories they've written and favorited, parsed one at a time
+        as the iterator is consumed. The whole listing is one page, so
+        is_known isn't used.
 
         """
+        url = self.user_url.format(hostname=self.hostname, number=number)
         try:
-            url = self.user_url.format(hostname=self.hostname, number=number)
             page = self.fetcher.get_html(url)
-            soup = BeautifulSoup(page, 'html5lib')
-            author = (soup.find('div', id='content_wrapper_inner').span.string.
+            # the author's name is in the header above the story lists,
+            # which is parsed separately from the entries
+            o = listing_start_re.search(page)
+            head = make_soup(page[:o.start()] if o else page)
+            author = (head.find('div', id='content_wrapper_inner').span.string.
                       strip())
-            auth: List[StoryInfo] = []
-            fav: List[StoryInfo] = []
-            author_dir = "{}-{}-{}".format(make_filename(author),
-                                           self.this_site,
-                                           number)
-            for i in soup.find_all('div', class_='z-list'):
+        except Exception:
+            print(url)
+            raise
+        author_dir = "{}-{}-{}".format(make_filename(author), self.this_site,
+                                       number)
+        info = AuthorInfo(name=author, id=number, site=self.this_site,
+                          url=url, dir=author_dir)
+
+        def entries() -> Iterator[StoryInfo]:
+            for i in listing_entries(page):
                 a = self._parse_entry(i)
-                if a.source == 'favorites':
-                    fav.append(a)
-                elif a.source == 'authored':
+                if a.source == 'authored':
                     a.author.name = author
                     a.author.id = number
                     a.author.dir = author_dir
                     a.author.url = url
-                    auth.append(a)
-            info = AuthorInfo(name=author, id=number, site=self.this_site,
-                              url=url, dir=author_dir)
-        except Exception:
-            print(url)
-            raise
+                yield a
+        return info, entries()
+
+    def download_list(self, number: str) -> Tuple[List[StoryInfo],
+                                                  List[StoryInfo],
+                                                  AuthorInfo]:
+        """Given a user ID, download lists of the stories they've written and favorited
+        and return them. The lists are returned as a tuple of (authored,
+        faved). Each entry is a dictionary containing metadata.
+
+        """
+        info, entries = self.iter_list(number)
+        auth: List[StoryInfo] = []
+        fav: List[StoryInfo] = []
+        for a in entries:
+            if a.source == 'favorites':
+                fav.append(a)
+            elif a.source == 'authored':
+                auth.append(a)
         return auth, fav, info
 
     def compare_mds(self, r: StoryInfo, cr: StoryInfo) -> bool:
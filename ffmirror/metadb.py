@@ -9,43 +9,83 @@ from .util import JobStatus
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import (sessionmaker, relationship,  # noqa: F401
-                            joinedload, exc)
+                            joinedload, selectinload, exc,
+                            scoped_session)
 from sqlalchemy import types
 from sqlalchemy.orm.relationships import RelationshipProperty
-from sqlalchemy import create_engine, text, func  # noqa: F401
+from sqlalchemy import create_engine, text, func, event  # noqa: F401
+from sqlalchemy import type_coerce, literal_column
+from sqlalchemy.pool import QueuePool
 from sqlalchemy import Column, Integer, String, ForeignKey
-from sqlalchemy import Table, DateTime, Boolean, Interval
+from sqlalchemy import Table, DateTime, Boolean, Interval, Index
 from sqlalchemy.engine.base import Engine
 
 from pathlib import Path
 
-from typing import Union, Tuple, Optional, List, cast, Set, Iterator, Callable
+from typing import (Union, Tuple, Optional, List, cast, Set, Iterator,
+                    Callable, Dict, Any)
 
-import datetime, os, traceback, re
+import datetime, os, traceback, re, threading, itertools, hashlib
+import concurrent.futures
 utc = datetime.timezone.utc
 
 db_file = 'db_test.sqlite'
 
+# SQLite settings for the mirror database, applied as pragmas to every
+# connection as it's opened. In 'wal' mode readers (the web view) don't block
+# on a writer (a running update) or it on them, and commits don't fsync
+# every time; 'compat' is SQLite's own defaults, for filesystems WAL doesn't
+# work on, such as network shares. The profile is chosen per DBMirror, or
+# for the whole process with FFMIRROR_DB_PROFILE or set_db_profile().
+db_profiles: Dict[str, Dict[str, Any]] = {
+    'wal': {'busy_timeout': 30000, 'journal_mode': 'wal',
+            'synchronous': 'normal', 'mmap_size': 256 * 1024 ** 2,
+            'cache_size': -64 * 1024},
+    'compat': {'busy_timeout': 5000, 'journal_mode': 'delete',
+               'synchronous': 'full', 'mmap_size': 0, 'cache_size': -2000},
+}
+
+def set_db_profile(name: str) -> None:
+    global db_profile
+    if name not in db_profiles:
+        raise ValueError(f"Database profile '{name}' not known (have "
+                         f"{', '.join(db_profiles)})")
+    db_profile = name
+
+db_profile = 'wal'
+if os.environ.get('FFMIRROR_DB_PROFILE'):
+    set_db_profile(os.environ['FFMIRROR_DB_PROFILE'])
+
 Base = declarative_base()
 
 fav_stories_table = Table('fav_stories', Base.metadata,
                           Column('author_id', Integer,
                                  ForeignKey('author.id')),
-                          Column('story_id', Integer, ForeignKey('story.id')))
+                          Column('story_id', Integer, ForeignKey('story.id')),
+                          Index('ix_fav_stories_author_id', 'author_id'),
+                          Index('ix_fav_stories_story_id', 'story_id'))
 
 fav_authors_table = Table('fav_authors', Base.metadata,
                           Column('author_id', Integer,
                                  ForeignKey('author.id')),
                           Column('favauthor_id', Integer,
-                                 ForeignKey('author.id')))
+                                 ForeignKey('author.id')),
+                          Index('ix_fav_authors_author_id', 'author_id'),
+                          Index('ix_fav_authors_favauthor_id',
+                                'favauthor_id'))
 
 story_tags_table = Table('story_tags', Base.metadata,
                          Column('story_id', Integer, ForeignKey('story.id')),
-                         Column('tag_id', Integer, ForeignKey('tag.id')))
+                         Column('tag_id', Integer, ForeignKey('tag.id')),
+                         Index('ix_story_tags_story_tag', 'story_id',
+                               'tag_id', unique=True),
+                         Index('ix_story_tags_tag_id', 'tag_id'))
 
 following_stories_table = Table('following_stories', Base.metadata,
                                 Column('story_id', Integer,
-                                       ForeignKey('story.id')))
+                                       ForeignKey('story.id')),
+                                Index('ix_following_stories_story_id',
+                                      'story_id'))
 
 class TimeStamp(types.TypeDecorator):
     """A replacement for DateTime(timezone=True) for use with sqlite. This handles
@@ -62,18 +102,26 @@ class TimeStamp(types.TypeDecorator):
     impl = types.DateTime
     cache_ok = True
 
-    def process_bind_param(self, value: datetime.datetime, dialect):
+    def process_bind_param(self, value: Optional[datetime.datetime], dialect):
+        if value is None:
+            return None
         if value.tzinfo is None:
             raise ValueError("TimeStamp only supports TZ-aware datetimes")
         return value.astimezone(utc)
 
-    def process_result_value(self, value: datetime.datetime, dialect):
+    def process_result_value(self, value: Optional[datetime.datetime],
+                             dialect):
+        if value is None:
+            return None
         if value.tzinfo is None:
             return value.replace(tzinfo=utc)
         return value
 
 class Author(Base):
     __tablename__ = 'author'
+    __table_args__ = (
+        Index('ix_author_archive_site_id', 'archive', 'site_id', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
@@ -116,6 +164,10 @@ class Author(Base):
 
 class Story(Base):
     __tablename__ = 'story'
+    __table_args__ = (
+        Index('ix_story_archive_site_id', 'archive', 'site_id', unique=True),
+        Index('ix_story_author_id', 'author_id'),
+    )
 
     id = Column(Integer, primary_key=True)
     title = Column(String)
@@ -173,18 +225,67 @@ class Story(Base):
         return "<Story '{}' by '{}' id='{}'>".format(
             self.title, self.author.name, self.site_id)
 
+# Keys that story listings are sorted on (see webview.paging). NULLs are
+# replaced with a value that sorts them where SQLite would put them, so every
+# story has a key that can be compared; timestamps are sorted as their stored
+# text. Each key is indexed along with the story ID, so a page of a listing
+# is a short index scan. The replacement values are literals rather than
+# bound parameters, since SQLite only uses an index on an expression for the
+# very same expression.
+story_sort_keys = {
+    'updated': func.coalesce(type_coerce(Story.updated, String),
+                             literal_column("''")),
+    'words': func.coalesce(Story.words, literal_column('-1')),
+    'title': func.coalesce(Story.title, literal_column("''")),
+    'category': func.coalesce(Story.category, literal_column("''")),
+}
+Index('ix_story_updated_key', story_sort_keys['updated'], Story.id)
+Index('ix_story_words_key', story_sort_keys['words'], Story.id)
+Index('ix_story_title_key', story_sort_keys['title'], Story.id)
+Index('ix_story_category_key', story_sort_keys['category'], Story.id)
+
 class Chapter(Base):
     __tablename__ = 'chapter'
+    __table_args__ = (
+        Index('ix_chapter_story_id', 'story_id'),
+    )
 
     id = Column(Integer, primary_key=True)
     title = Column(String)
     num = Column(Integer)
     story_id = Column(Integer, ForeignKey('story.id'))
 
+    # the state of the chapter's file in the mirror; all null if it hasn't
+    # been downloaded
+    hash = Column(String)  # sha256 of the file contents
+    size = Column(Integer)
+    fetched_at = Column(TimeStamp)
+
     story = relationship('Story', back_populates='all_chapters')
 
+    def filename(self) -> str:
+        return f"{self.num:04d}.html"
+
+    def is_stored(self, st_dir: Path, verify: bool = False) -> bool:
+        """Check whether the chapter's file in st_dir is the one recorded as
+        downloaded. This compares sizes, or with verify also content hashes."""
+        if self.fetched_at is None:
+            return False
+        fp = st_dir / self.filename()
+        try:
+            if fp.stat().st_size != self.size:
+                return False
+            if verify:
+                return hashlib.sha256(fp.read_bytes()).hexdigest() == self.hash
+        except OSError:
+            return False
+        return True
+
 class Tag(Base):
     __tablename__ = 'tag'
+    __table_args__ = (
+        Index('ix_tag_name', 'name', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
@@ -214,12 +315,16 @@ class DownloadStatus(Base):
     value = Column(String)
 
 class DBMirror(object):
-    def __init__(self, mdir: str, debug: bool = False) -> None:
+    def __init__(self, mdir: str, debug: bool = False,
+                 profile: Optional[str] = None) -> None:
         self.engine: Optional[Engine] = None
-        self.Session: Optional[sessionmaker] = None
+        self.Session: Optional[Union[sessionmaker, scoped_session]] = None
         self.mdir = os.path.abspath(mdir)
         self.db_file = os.path.join(self.mdir, 'ffmeta.sqlite')
         self.debug = debug
+        if profile is not None and profile not in db_profiles:
+            raise ValueError(f"Database profile '{profile}' not known")
+        self.profile = profile
         self._last_ao = None
 
     def __enter__(self) -> DBMirror:
@@ -228,11 +333,31 @@ class DBMirror(object):
 
     def __exit__(self, exc_type, exc_value, traceback) -> None:
         # any method which changes the DB will call ds.commit() on its own
+        self.close()
+
+    def close(self) -> None:
+        """Close the session and the engine's pooled connections. Mirrors made
+        with fork() share the engine, so should only close their session."""
         self.ds.close()
+        if self.engine is not None:
+            self.engine.dispose()
 
     def connect(self) -> None:
+        # connections are pooled rather than opened per session, so the
+        # pragmas are only run once per connection and the page cache
+        # survives between sessions; sessions on other threads (see fork())
+        # may get a connection first opened on this one
         self.engine = create_engine('sqlite:///{}'.format(self.db_file),
-                                    echo=self.debug)
+                                    echo=self.debug, poolclass=QueuePool,
+                                    connect_args={'check_same_thread': False})
+        pragmas = db_profiles[self.profile or db_profile]
+
+        def set_pragmas(dbapi_conn, record):
+            cur = dbapi_conn.cursor()
+            for k, v in pragmas.items():
+                cur.execute(f"pragma {k} = {v}")
+            cur.close()
+        event.listen(self.engine, 'connect', set_pragmas)
         self.Session = sessionmaker(bind=self.engine)
         self.ds = self.Session()
 
@@ -262,27 +387,66 @@ class DBMirror(object):
     def get_config(self, name: str) -> str:
         return self.ds.query(Config).filter_by(name=name).first().value
 
-    def _handle_tags_for(self, md: StoryInfo) -> None:
+    def _link_tags(self, story_tags: Dict[int, Set[str]]) -> None:
+        """Add tags to stories in bulk, given a dict from story database IDs to tag
+        names. Tags that do not exist will be created. This takes a fixed
+        number of statements however many stories and tags there are: one to
+        look up the existing tags, one to create the missing ones (and one to
+        get their IDs), and one to link them to the stories, ignoring links
+        already there. This method does not call ds.commit(); a caller MUST
+        do so.
+
+        """
+        ds = self.ds
+        names = set().union(*story_tags.values())
+        if not names:
+            return
+        tag_ids = dict(ds.query(Tag.name, Tag.id).filter(Tag.name.in_(names)))
+        missing = names - tag_ids.keys()
+        if missing:
+            # OR IGNORE, as another session may have created some of them
+            # since the lookup; their IDs are picked up below all the same
+            ds.execute(Tag.__table__.insert().prefix_with('OR IGNORE'),
+                       [{'name': t} for t in sorted(missing)])
+            tag_ids.update(ds.query(Tag.name, Tag.id).
+                           filter(Tag.name.in_(missing)))
+        ds.execute(story_tags_table.insert().prefix_with('OR IGNORE'),
+                   [{'story_id': sid, 'tag_id': tag_ids[t]}
+                    for sid, ts in story_tags.items() for t in ts])
+
+    def _handle_tags_for(self, md: StoryInfo, so: Optional[Story] = None
+                         ) -> None:
         """Takes a story metadata object, fetches its tags via its respective site
         module, then adds them to that story in the database. Tags that do not
-        exist will be created. Requires that the story object already exist.
-        This method does not call ds.commit(); a caller MUST do so.
+        exist will be created. Requires that the story object already exist;
+        so is the Story, if the caller has it to hand. This method does not
+        call ds.commit(); a caller MUST do so.
 
         """
-        ds = self.ds
-        so = self.get_story(md.site, md.id)
-        for t in md.tags:
-            to = ds.query(Tag).filter_by(name=t).first()
-            if not to:
-                to = Tag(name=t)
-                ds.add(to)
-            if so not in to.stories:
-                to.stories.append(so)
+        if so is None:
+            so = self.get_story(md.site, md.id)
+        if not md.tags:
+            return
+        if so.id is None:
+            self.ds.flush()
+        self._link_tags({so.id: set(md.tags)})
+        # the links were made behind the ORM's back
+        self.ds.expire(so, ['tags'])
 
     def _check_update(self, so: Story, s: StoryInfo) -> bool:
         return (so.words != s.words or so.chapters != s.chapters or
                 so.updated != s.updated)
 
+    @staticmethod
+    def _story_fields(s: StoryInfo) -> Dict[str, Any]:
+        """The Story columns that are updated from a metadata object."""
+        return {
+            'title': s.title, 'words': s.words, 'chapters': s.chapters,
+            'category': s.category, 'summary': s.summary,
+            'characters': s.characters, 'complete': s.complete,
+            'genre': s.genre, 'published': s.published, 'updated': s.updated,
+        }
+
     def _story_from_md(self, s: StoryInfo, ao: Author,
                        eso: Story = None):
         """Gets or creates a Story object from an ffmirror metadata dictionary. If it
@@ -300,23 +464,125 @@ class DBMirror(object):
             so = Story(archive=s.site, site_id=s.id)
             ds.add(so)
         if self._check_update(so, s):
-            so.title = s.title
-            so.words = s.words
-            so.chapters = s.chapters
-            so.category = s.category
-            so.summary = s.summary
-            so.characters = s.characters
-            so.complete = s.complete
-            so.genre = s.genre
-            so.published = s.published
-            so.updated = s.updated
-            self._handle_tags_for(s)
+            for k, v in self._story_fields(s).items():
+                setattr(so, k, v)
+            self._handle_tags_for(s, so)
             so.author = ao
         return so
 
+    def _known_stories(self, archive: str, site_ids: List[str]
+                       ) -> Dict[str, Any]:
+        """Look up which of the given stories are in the mirror, with one IN
+        query. Returns a dict from site ID to a row with the story's database
+        ID and the columns _check_update() compares."""
+        return {r.site_id: r for r in self.ds.query(
+            Story.id, Story.site_id, Story.words, Story.chapters,
+            Story.updated).filter(
+                (Story.archive == archive) & Story.site_id.in_(site_ids))}
+
+    def _sync_batch(self, ao: Author, batch: List[StoryInfo],
+                    fav_ids: Set[int]) -> None:
+        """Add or update a batch of stories from ao's listing. fav_ids holds the
+        database IDs of ao's favorite stories, and is updated with any new
+        ones. This method does not call ds.commit(); a caller MUST do so.
+
+        This works on sets rather than story by story: the batch's stories and
+        the authors of its favorites are each looked up with one IN query,
+        and new authors, new stories, changed stories, tags and favorites are
+        each written with one bulk statement (plus a query for the IDs of new
+        rows), whatever the size of the batch. Since the writes bypass the
+        ORM, Story and Author objects already loaded in the session may be
+        stale until the commit.
+
+        """
+        ds = self.ds
+        archive = ao.archive
+        # a story may be listed twice (e.g. an author's own favorite); the
+        # last entry wins, as it would if they were handled in turn
+        entries = {sm.id: sm for sm in batch}
+        known = self._known_stories(archive, list(entries))
+
+        # authors of new favorites, creating those we haven't seen
+        fav_authors = {sm.author.id: sm.author.name
+                       for sm in entries.values()
+                       if sm.source == 'favorites' and sm.id not in known}
+        author_ids = {ao.site_id: ao.id}
+        if fav_authors:
+            author_ids.update(ds.query(Author.site_id, Author.id).filter(
+                (Author.archive == archive) &
+                Author.site_id.in_(list(fav_authors))))
+            new_authors = [{'name': fav_authors[i], 'archive': archive,
+                            'site_id': i, 'in_mirror': False}
+                           for i in fav_authors if i not in author_ids]
+            if new_authors:
+                # another session (e.g. another update queue) may have added
+                # some since the lookup; theirs are used instead
+                ds.execute(Author.__table__.insert().prefix_with('OR IGNORE'),
+                           new_authors)
+                author_ids.update(ds.query(Author.site_id, Author.id).filter(
+                    (Author.archive == archive) &
+                    Author.site_id.in_([a['site_id'] for a in new_authors])))
+
+        new_stories = []
+        changed = []
+        for sm in entries.values():
+            row = known.get(sm.id)
+            if row is None:
+                f = self._story_fields(sm)
+                aid = (sm.author.id if sm.source == 'favorites'
+                       else ao.site_id)
+                f.update(archive=archive, site_id=sm.id,
+                         author_id=author_ids[aid])
+                new_stories.append(f)
+            elif self._check_update(row, sm):
+                f = self._story_fields(sm)
+                f['id'] = row.id
+                if sm.source != 'favorites':
+                    f['author_id'] = ao.id
+                changed.append((sm.id, f))
+        story_ids = {sid: r.id for sid, r in known.items()}
+        if new_stories:
+            ds.execute(Story.__table__.insert().prefix_with('OR IGNORE'),
+                       new_stories)
+            story_ids.update(ds.query(Story.site_id, Story.id).filter(
+                (Story.archive == archive) &
+                Story.site_id.in_([f['site_id'] for f in new_stories])))
+        if changed:
+            ds.bulk_update_mappings(Story, [f for sid, f in changed])
+
+        # as in _story_from_md, tags are only added for new or changed
+        # stories
+        updated = ([f['site_id'] for f in new_stories] +
+                   [sid for sid, f in changed])
+        self._link_tags({story_ids[sid]: set(entries[sid].tags)
+                         for sid in updated})
+
+        # the favorites collection isn't loaded, so as not to hold every
+        # favorite in memory; new ones are inserted directly
+        rows = []
+        for sm in entries.values():
+            if sm.source != 'favorites':
+                continue
+            i = story_ids[sm.id]
+            if i not in fav_ids:
+                fav_ids.add(i)
+                rows.append({'author_id': ao.id, 'story_id': i})
+        if rows:
+            ds.execute(fav_stories_table.insert(), rows)
+
     def sync_author(
             self, ido: Union[Author, Tuple[str, str]],
-            progress: Optional[Callable[[JobStatus], None]] = None) -> None:
+            progress: Optional[Callable[[JobStatus], None]] = None,
+            batch_size: int = 200) -> None:
+        """Bring the database in line with an author's listing on their site: the
+        stories they've written and favorited are added or updated, and new
+        favorites recorded. The listing is streamed from the site module's
+        iter_list() and handled batch_size stories at a time, each batch
+        committed as it's done, so memory use stays flat however long the
+        listing is and other sessions see stories as they arrive. md_synced is
+        set only once the whole listing is through.
+
+        """
         ds = self.ds
         if isinstance(ido, Author):
             ao = ido
@@ -325,77 +591,168 @@ class DBMirror(object):
             archive, aid = ido
             ao = self.get_author(archive, aid)
         mod = site_modules[archive]
+
+        def is_known(page: List[StoryInfo]) -> bool:
+            known = self._known_stories(archive, [sm.id for sm in page])
+            return all(sm.id in known and
+                       not self._check_update(known[sm.id], sm)
+                       for sm in page)
+
         try:
-            auth, fav, info = mod.download_list(aid)
+            info, entries = mod.iter_list(aid, is_known)
+            if not ao:
+                ao = Author(name=info.name, archive=archive, site_id=aid)
+                ao.sync_int = datetime.timedelta(days=1)
+                ds.add(ao)
+                ds.flush()
+            fav_ids = set(
+                i for i, in ds.query(fav_stories_table.c.story_id).filter(
+                    fav_stories_table.c.author_id == ao.id))
+            while True:
+                batch = list(itertools.islice(entries, batch_size))
+                if not batch:
+                    break
+                self._sync_batch(ao, batch, fav_ids)
+                ds.commit()
         except Exception:
+            ds.rollback()
             err_str = traceback.format_exc()
             if progress is not None:
                 progress(JobStatus(
-                    type='error', name=ao.name, progress=None, total=None,
-                    info=err_str))
+                    type='error', name=ao.name if ao else aid, progress=None,
+                    total=None, info=err_str))
             raise
-        if not ao:
-            ao = Author(name=info.name, archive=archive, site_id=aid)
-            ao.sync_int = datetime.timedelta(days=1)
-            ds.add(ao)
-        else:
-            ao = self.cache_load_author(ao)
         ao.md_synced = datetime.datetime.now(tz=utc)
-        si_d = {}
-        for s in ao.stories_written + ao.fav_stories:
-            si_d[s.site_id] = s
-        for sm in auth:
-            so = self._story_from_md(sm, ao, si_d.get(sm.id))
-        for sm in fav:
-            ms = si_d.get(sm.id)
-            fao = ms.author if ms else self.get_author(archive, sm.author.id)
-            if not fao:
-                fao = Author(name=sm.author.name, archive=archive,
-                             site_id=sm.author.id)
-                ds.add(fao)
-            so = self._story_from_md(sm, fao, ms)
-            if so not in ao.fav_stories:
-                ao.fav_stories.append(so)
         ds.commit()
 
     def _set_chapters(self, s: Story, toc: List[ChapterInfo]) -> None:
+        """Make the story's chapter rows match toc. Chapters whose title has
+        changed are marked as not downloaded, and rows past the end of toc are
+        deleted."""
         n_chapters = len(s.all_chapters)
         for n, i in enumerate(toc):
             if n < n_chapters:
-                s.all_chapters[n].title = i.title
+                c = s.all_chapters[n]
+                if c.title != i.title:
+                    c.title = i.title
+                    c.fetched_at = None
             else:
                 c = Chapter(title=i.title, num=n)
                 s.all_chapters.append(c)
+        for c in s.all_chapters[len(toc):]:
+            self.ds.delete(c)
+        del s.all_chapters[len(toc):]
 
     def story_to_archive(
             self, st: Story,
             progress: Optional[Callable[[JobStatus], None]] = None,
-            commit: bool = True) -> None:
+            commit: bool = True, max_inflight: Optional[int] = None,
+            refresh: bool = False, verify: bool = False) -> None:
+        """Download a story's chapters into the mirror. Chapters are fetched on a
+        pool of up to max_inflight threads (by default, the site module's
+        max_inflight), which is still held to the per-host rate limit; text
+        extraction runs on its own thread as pages arrive, and each chapter is
+        written to disk here as soon as it and all those before it are done.
+
+        Only chapters that aren't already in the mirror are fetched: a chapter
+        is kept if its row records it as downloaded and its file still matches
+        the recorded size (or hash, with verify), and its title hasn't changed.
+        So an update that appends chapters fetches only the new ones (and the
+        last one already there, since authors often edit the chapter before
+        a new one), and an interrupted download picks up where it stopped,
+        since each chapter's state is committed as it's written (if commit is
+        set). If the story has been updated since it was downloaded but has
+        no new or renamed chapters, a chapter's text must have been edited,
+        so every chapter is fetched again, as with refresh. Either way, files
+        whose contents are unchanged aren't rewritten.
+
+        download_fn is only set once every chapter is written, so a story
+        whose download failed partway isn't shown as present.
+
+        """
         mod = site_modules[st.archive]
         md, toc = mod.download_metadata(st.site_id)
         # if rfn is None:
         rfn = md.get_mirror_filename()
         st_dir = Path(os.path.join(self.mdir, rfn))
         st_dir.mkdir(exist_ok=True, parents=True)
+        if st.download_fn is not None and st.download_fn != rfn:
+            # the story's been renamed, so what's on disk is elsewhere
+            for c in st.all_chapters:
+                c.fetched_at = None
 
         self._set_chapters(st, toc)
-
-        for n, c in enumerate(toc):
-            if progress is not None:
-                progress(JobStatus(
-                    type='chapter', name=c.title, progress=n,
-                    total=st.chapters))
-            chap_data = mod.download_chapter(c)
-            fn = f"{n:04d}.html"
-            (st_dir / fn).write_text(chap_data)
+        chapters = st.all_chapters
+        stored = [c.is_stored(st_dir, verify) for c in chapters]
+        stale = (st.download_time is not None and st.updated is not None and
+                 st.download_time < st.updated)
+        if stale and all(stored):
+            refresh = True
+        elif stale and any(stored):
+            # the chapters stored run from the start of the story, bar
+            # renamed ones; refetch the last before the new ones
+            last = max(n for n, i in enumerate(stored) if i)
+            stored[last] = False
+        todo = [n for n, i in enumerate(stored) if refresh or not i]
+        # chapter files past the end of the story, if it's lost chapters
+        for fp in st_dir.glob('*.html'):
+            if fp.stem.isdigit() and int(fp.stem) >= len(chapters):
+                fp.unlink()
+
+        if max_inflight is None:
+            max_inflight = mod.max_inflight
+        fetch_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_inflight, thread_name_prefix='ffmirror-chapter')
+        extract_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        def extract(f: concurrent.futures.Future) -> str:
+            return mod.extract_chapter(f.result())
+
+        pages: List[Optional[concurrent.futures.Future]] = [
+            fetch_pool.submit(mod.fetch_chapter, toc[n]) for n in todo]
+        texts: List[Optional[concurrent.futures.Future]] = [
+            extract_pool.submit(extract, f) for f in pages]
+        try:
+            for i, n in enumerate(todo):
+                tf = texts[i]
+                assert tf is not None
+                chap_data = tf.result().encode()
+                # drop finished futures so pages don't pile up in memory
+                pages[i] = texts[i] = None
+                c = chapters[n]
+                h = hashlib.sha256(chap_data).hexdigest()
+                fp = st_dir / c.filename()
+                if not (h == c.hash and c.is_stored(st_dir)):
+                    # write to a temp file and rename, so an interrupted write
+                    # can't leave a partial chapter
+                    tmp = fp.with_suffix('.tmp')
+                    tmp.write_bytes(chap_data)
+                    os.replace(tmp, fp)
+                c.hash = h
+                c.size = len(chap_data)
+                c.fetched_at = datetime.datetime.now(tz=utc)
+                if commit:
+                    self.ds.commit()
+                if progress is not None:
+                    progress(JobStatus(
+                        type='chapter', name=c.title, progress=i,
+                        total=len(todo)))
+        finally:
+            for f in pages:
+                if f is not None:
+                    f.cancel()
+            fetch_pool.shutdown(wait=True)
+            extract_pool.shutdown(wait=True)
         st.download_fn = rfn
         st.download_time = datetime.datetime.now(tz=utc)
         if commit:
             self.ds.commit()
 
     def archive_author(self, ao: Author,
-                       progress: Optional[Callable[[JobStatus], None]] = None
-                       ) -> None:
+                       progress: Optional[Callable[[JobStatus], None]] = None,
+                       refresh: bool = False) -> None:
+        """Download the author's stories that are new or updated since they were
+        last downloaded. refresh is passed to story_to_archive()."""
         ds = self.ds
         ao.in_mirror = True
         q = ds.query(Story).filter((Story.author == ao) &
@@ -409,34 +766,132 @@ class DBMirror(object):
                     progress(JobStatus(
                         type='story', name=i.title, progress=n,
                         total=count))
-                self.story_to_archive(i, progress=progress)
+                self.story_to_archive(i, progress=progress, refresh=refresh)
             except Exception as e:
                 if progress is not None:
                     err_str = traceback.format_exc()
                     progress(JobStatus(
                         type='error', name=type(e).__name__, info=err_str))
+        # commit even if nothing was archived, so as not to hold the write
+        # lock against other sessions
+        ds.commit()
 
-    def run_update(self, progress: Optional[Callable[[JobStatus], None]] = None,
-                   max_authors: Optional[int] = None) -> None:
-        ds = self.ds
-        aq = (ds.query(Author).filter(Author.in_mirror == True).  # noqa: E712
-              order_by(Author.md_synced.asc()))
-        ta = aq.count()
-        for n, i in enumerate(aq.all()):
-            if max_authors is not None and n >= max_authors:
-                break
+    def fork(self) -> DBMirror:
+        """Get a new DBMirror sharing this one's engine, but with its own session. This
+        is for use from another thread, since sessions can't be shared between
+        threads.
+
+        """
+        rv = DBMirror(self.mdir, debug=self.debug, profile=self.profile)
+        rv.engine = self.engine
+        rv.Session = self.Session
+        assert self.Session is not None
+        rv.ds = self.Session()
+        return rv
+
+    def _update_queue(self, author_ids: List[int],
+                      progress: Optional[Callable[[JobStatus], None]],
+                      count: Callable[[], int], total: int,
+                      refresh: bool = False) -> None:
+        for aid in author_ids:
+            ao = self.ds.query(Author).filter_by(id=aid).one()
             if progress is not None:
-                t = max_authors if max_authors is not None else ta
                 progress(JobStatus(
-                    type='author', name=i.name, progress=n + 1, total=t))
+                    type='author', name=ao.name, progress=count(),
+                    total=total))
             try:
-                self.sync_author(i, progress=progress)
-                self.archive_author(i, progress=progress)
+                self.sync_author(ao, progress=progress)
+                self.archive_author(ao, progress=progress, refresh=refresh)
             except Exception:
                 # we ignore exceptions here so as to continue with the sync
                 # attempt; any exception in the underlying function will be
                 # logged already via progress, so don't bother here
-                pass
+                self.ds.rollback()
+
+    def run_update(self, progress: Optional[Callable[[JobStatus], None]] = None,
+                   max_authors: Optional[int] = None,
+                   concurrent: bool = True, refresh: bool = False) -> None:
+        """Sync and archive every author in the mirror, least recently synced first.
+        Authors are split into queues by the fetch queue of their site module;
+        if concurrent is set, the queues are run simultaneously, each in its
+        own thread with its own session, so the update takes about as long as
+        the slowest site rather than the sum of all of them. progress is then
+        called with the queue set on each JobStatus, and never from two
+        threads at once. refresh is passed to story_to_archive().
+
+        """
+        ds = self.ds
+        aq = (ds.query(Author).filter(Author.in_mirror == True).  # noqa: E712
+              order_by(Author.md_synced.asc()))
+        authors = aq.all()
+        if max_authors is not None:
+            authors = authors[:max_authors]
+        total = len(authors)
+        queues: Dict[str, List[int]] = {}
+        for a in authors:
+            q = site_modules[a.archive].fetch_queue
+            queues.setdefault(q, []).append(a.id)
+
+        counter = itertools.count(1)
+        count_lock = threading.Lock()
+
+        def count() -> int:
+            with count_lock:
+                return next(counter)
+
+        if not concurrent or len(queues) <= 1:
+            for ids in queues.values():
+                self._update_queue(ids, progress, count, total, refresh)
+            return
+
+        # one queue runs on this thread and the rest in workers
+        ql = list(queues.items())
+        progress_lock = threading.Lock()
+
+        def queue_progress(name: str
+                           ) -> Optional[Callable[[JobStatus], None]]:
+            # calls from the queues are serialized and tagged with the queue,
+            # so the callback needn't be thread-safe and can tell them apart
+            if progress is None:
+                return None
+            pf = progress
+
+            def rv(j: JobStatus) -> None:
+                j.queue = name
+                with progress_lock:
+                    pf(j)
+            return rv
+
+        # an exception escaping a worker is kept to be raised here, rather
+        # than dying with its thread
+        errors: List[BaseException] = []
+
+        def worker(name: str, ids: List[int]) -> None:
+            m = self.fork()
+            try:
+                m._update_queue(ids, queue_progress(name), count, total,
+                                refresh)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                m.ds.close()
+
+        workers = []
+        for name, ids in ql[1:]:
+            t = threading.Thread(target=worker, args=(name, ids),
+                                 name=f"ffmirror-update-{name}")
+            t.start()
+            workers.append(t)
+        try:
+            self._update_queue(ql[0][1], queue_progress(ql[0][0]), count,
+                               total, refresh)
+        finally:
+            for t in workers:
+                t.join()
+            # the worker sessions made changes this one hasn't seen
+            ds.expire_all()
+        if errors:
+            raise errors[0]
 
 def extract_chapters(stp: Path) -> Iterator[Tuple[str, str]]:
     with stp.open('r') as stf:
@@ -473,9 +928,12 @@ def update_chapters(db_path: Path) -> None:
             dp = db_path / dbn
             dp.mkdir(exist_ok=True, parents=True)
             for n, t in enumerate(extract_chapters(fp)):
-                fn = f"{n:04d}.html"
-                (dp / fn).write_text(t[1])
                 c = Chapter(title=t[0], num=n)
+                data = t[1].encode()
+                (dp / c.filename()).write_bytes(data)
+                c.hash = hashlib.sha256(data).hexdigest()
+                c.size = len(data)
+                c.fetched_at = s.download_time
                 s.all_chapters.append(c)
             s.download_fn = dbn
             m.ds.commit()
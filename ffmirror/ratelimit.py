@@ -0,0 +1,293 @@
+# Rate limiting for fetches. All fetchers (plain HTTP, async and browser) draw
+# their fetch slots from a limiter, so that fetches to one host respect a
+# minimum delay no matter which fetcher issued them, while fetches to
+# different hosts don't wait on each other.
+
+from __future__ import annotations
+
+import time, threading, asyncio, sqlite3, os, random, email.utils
+import datetime
+
+from typing import Dict, Tuple, Optional, Callable
+
+class RateLimiter:
+    """An in-process per-host rate limiter. Fetch slots for each host are
+    handed out at least delay seconds apart (or 1/rate, for hosts given their
+    own rate with set_limit()). reserve() claims the next slot and returns
+    how long the caller must wait for it; wait() and wait_async() do the
+    waiting for sync and async callers respectively. defer() pushes a host's
+    next slot back, for when the site asks us to slow down. All methods are
+    thread-safe.
+
+    configure() sets a host's limit as set_limit() does, and also records it
+    in configured as the fastest the host may be fetched from; an
+    AdaptiveController won't speed the host up past it.
+
+    """
+    def __init__(self, delay: float = 2.0) -> None:
+        self.delay = delay
+        self.next_slot: Dict[str, float] = {}
+        self.host_limits: Dict[str, Tuple[float, int]] = {}
+        self.configured: Dict[str, Tuple[float, int]] = {}
+        self._lock = threading.Lock()
+
+    def set_limit(self, host: str, rate: float, burst: int = 1) -> None:
+        self.host_limits[host] = (rate, burst)
+
+    def configure(self, host: str, rate: float, burst: int = 1) -> None:
+        self.configured[host] = (rate, burst)
+        self.set_limit(host, rate, burst)
+
+    def get_limit(self, host: str) -> Tuple[float, int]:
+        """Get the (rate, burst) pair for a host. Plain RateLimiters don't allow
+        bursts."""
+        return self.host_limits.get(host, (1.0 / self.delay, 1))
+
+    def reserve(self, host: str) -> float:
+        rate, _ = self.get_limit(host)
+        with self._lock:
+            now = time.time()
+            slot = max(now, self.next_slot.get(host, 0.0))
+            self.next_slot[host] = slot + 1.0 / rate
+            return slot - now
+
+    def defer(self, host: str, delay: float) -> None:
+        """Make sure no slot for host is handed out for the next delay seconds."""
+        with self._lock:
+            until = time.time() + delay
+            self.next_slot[host] = max(self.next_slot.get(host, 0.0), until)
+
+    def wait(self, host: str) -> None:
+        delay = self.reserve(host)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self, host: str) -> None:
+        delay = self.reserve(host)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+default_db = os.environ.get(
+    'FFMIRROR_RATELIMIT_DB',
+    os.path.join(os.path.expanduser('~'), '.ffmirror_ratelimit.sqlite'))
+
+class TokenBucketLimiter(RateLimiter):
+    """A per-host token bucket limiter whose state is kept in an SQLite database,
+    so that every ffmirror process on the machine (the ffdb CLI, the webview
+    workers) draws from a single budget per host.
+
+    Each host's bucket refills at rate tokens per second up to burst tokens,
+    and each fetch takes one token. When the bucket is empty the token count
+    goes negative, which reserves a future slot for the caller; reserve()
+    returns how long it must wait for that slot. Rate and burst can be set per
+    host with set_limit(); hosts not configured use the defaults given here.
+
+    """
+    def __init__(self, path: Optional[str] = None, rate: float = 0.5,
+                 burst: int = 1) -> None:
+        super().__init__(1.0 / rate)
+        self.path = path if path is not None else default_db
+        self.rate = rate
+        self.burst = burst
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def get_limit(self, host: str) -> Tuple[float, int]:
+        return self.host_limits.get(host, (self.rate, self.burst))
+
+    def _connect(self) -> sqlite3.Connection:
+        # called with self._lock held
+        if self._conn is None:
+            d = os.path.dirname(self.path)
+            if d:
+                os.makedirs(d, exist_ok=True)
+            # autocommit mode, so that we control locking with BEGIN
+            # IMMEDIATE ourselves
+            self._conn = sqlite3.connect(self.path, timeout=60,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            self._conn.execute(
+                "create table if not exists bucket "
+                "(host text primary key, tokens real, updated real)")
+        return self._conn
+
+    def _update(self, host: str,
+                change: Callable[[float, float, int], float]) -> float:
+        """Apply change to the host's bucket in a single locked transaction. change
+        is given the refilled token count, the rate and the burst size, and
+        returns the new token count, which is also returned here.
+
+        """
+        rate, burst = self.get_limit(host)
+        with self._lock:
+            conn = self._connect()
+            # BEGIN IMMEDIATE takes the database write lock, serializing the
+            # read-modify-write against other processes
+            conn.execute("begin immediate")
+            try:
+                now = time.time()
+                row = conn.execute(
+                    "select tokens, updated from bucket where host = ?",
+                    (host,)).fetchone()
+                if row is None:
+                    tokens = float(burst)
+                else:
+                    tokens = min(float(burst),
+                                 row[0] + (now - row[1]) * rate)
+                tokens = change(tokens, rate, burst)
+                conn.execute(
+                    "insert or replace into bucket (host, tokens, updated) "
+                    "values (?, ?, ?)", (host, tokens, now))
+            except BaseException:
+                conn.execute("rollback")
+                raise
+            conn.execute("commit")
+        return tokens
+
+    def reserve(self, host: str) -> float:
+        tokens = self._update(host, lambda t, r, b: t - 1.0)
+        if tokens >= 0:
+            return 0.0
+        return -tokens / self.get_limit(host)[0]
+
+    def defer(self, host: str, delay: float) -> None:
+        # a bucket that's -delay * rate tokens in debt won't hand out a slot
+        # for delay seconds; this is seen by every process using the file
+        self._update(host, lambda t, r, b: min(t, -delay * r))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+# Fetch limits for the sites ffmirror knows, as host: (rate, burst), with rate
+# in fetches per second. AO3 is allowed a burst so that its listing pages,
+# which are requested several at a time, can overlap. Hosts not listed get
+# the limiter's defaults. FFMIRROR_HOST_LIMITS overrides these.
+default_host_limits: Dict[str, Tuple[float, int]] = {
+    'www.fanfiction.net': (1.0, 1),
+    'www.fictionpress.com': (1.0, 1),
+    'archiveofourown.org': (0.5, 4),
+}
+
+def parse_host_limits(spec: str) -> Dict[str, Tuple[float, int]]:
+    """Parse host limits given as comma-separated host=rate or host=rate/burst
+    entries, e.g. "archiveofourown.org=0.5/4,www.fanfiction.net=0.25".
+    Raises ValueError if they're malformed."""
+    rv = {}
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, sep, limit = entry.partition('=')
+        rate_s, _, burst_s = limit.partition('/')
+        try:
+            rate, burst = float(rate_s), int(burst_s) if burst_s else 1
+        except ValueError:
+            rate, burst = 0.0, 0
+        if not sep or not host.strip() or not rate > 0 or burst < 1:
+            raise ValueError(f"Bad host limit '{entry}' (want host=rate or "
+                             "host=rate/burst, with a positive rate)")
+        rv[host.strip()] = (rate, burst)
+    return rv
+
+def configure_host_limits(limiter: RateLimiter,
+                          limits: Dict[str, Tuple[float, int]]) -> None:
+    for host, (rate, burst) in limits.items():
+        limiter.configure(host, rate, burst)
+
+shared_limiter = TokenBucketLimiter()
+configure_host_limits(shared_limiter, default_host_limits)
+if os.environ.get('FFMIRROR_HOST_LIMITS'):
+    configure_host_limits(shared_limiter, parse_host_limits(
+        os.environ['FFMIRROR_HOST_LIMITS']))
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header, which is either a number of seconds or an HTTP
+    date, into a number of seconds from now. Returns None if the header is
+    missing or unparseable.
+
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    return max(0.0, (when - now).total_seconds())
+
+# Statuses that mean the site wants us to slow down (or is briefly broken),
+# so the request is worth retrying after a wait.
+throttle_statuses = {429, 503}
+retry_statuses = throttle_statuses | {500, 502, 504}
+
+class AdaptiveController:
+    """Tunes a limiter's per-host rate from the responses the host sends back.
+    On throttling (429 or 503, or a request that fails outright) the delay
+    between fetches is multiplied by backoff_factor, up to max_delay, and the
+    host is paused for its Retry-After time if it gave one. Slow responses
+    (over slow_latency seconds) also lengthen the delay, more gently. After
+    every healthy_after consecutive healthy responses, the delay is shortened
+    by speedup_factor, down to min_delay. So long syncs run about as fast as
+    the site tolerates. Hosts with a configured limit in the limiter are never
+    sped up past it, and keep their configured burst.
+
+    retry_delay() gives the wait before retrying a failed fetch: exponential
+    backoff from base_delay with jitter, or the site's Retry-After if that's
+    longer.
+
+    """
+    def __init__(self, limiter: RateLimiter, min_delay: float = 1.0,
+                 max_delay: float = 120.0, backoff_factor: float = 2.0,
+                 speedup_factor: float = 0.9, healthy_after: int = 10,
+                 slow_latency: float = 10.0) -> None:
+        self.limiter = limiter
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.backoff_factor = backoff_factor
+        self.speedup_factor = speedup_factor
+        self.healthy_after = healthy_after
+        self.slow_latency = slow_latency
+        self.streak: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _scale_delay(self, host: str, factor: float) -> None:
+        rate, burst = self.limiter.get_limit(host)
+        conf = self.limiter.configured.get(host)
+        min_delay = 1.0 / conf[0] if conf is not None else self.min_delay
+        delay = min(self.max_delay, max(min_delay, factor / rate))
+        self.limiter.set_limit(host, 1.0 / delay, burst)
+
+    def record(self, host: str, status: Optional[int], latency: float,
+               retry_after: Optional[float] = None) -> None:
+        """Record the outcome of a fetch. status is None if the request failed
+        without a response."""
+        with self._lock:
+            if status is None or status in throttle_statuses:
+                self.streak[host] = 0
+                self._scale_delay(host, self.backoff_factor)
+                if retry_after is not None:
+                    self.limiter.defer(host, min(retry_after,
+                                                 self.max_delay))
+            elif latency > self.slow_latency:
+                self.streak[host] = 0
+                self._scale_delay(host, 1.25)
+            else:
+                self.streak[host] = self.streak.get(host, 0) + 1
+                if self.streak[host] >= self.healthy_after:
+                    self.streak[host] = 0
+                    self._scale_delay(host, self.speedup_factor)
+
+    def retry_delay(self, attempt: int, base_delay: float = 1.0,
+                    retry_after: Optional[float] = None) -> float:
+        d = min(self.max_delay, base_delay * 2 ** attempt)
+        d = d / 2 + random.uniform(0, d / 2)
+        if retry_after is not None:
+            d = max(d, min(retry_after, self.max_delay))
+        return d
@@ -3,53 +3,67 @@
 from __future__ import annotations
 
 import time, urllib.request, urllib.error, re, hashlib, os, json
-import urllib.parse, requests, atexit, sys, signal
+import urllib.parse, requests, atexit, threading, asyncio
+import concurrent.futures, functools, contextlib
+import requests.adapters
 try:
     import cloudscraper
 except Exception:
     cloudscraper = None
-from bs4 import NavigableString  # type: ignore
+from bs4 import (BeautifulSoup, NavigableString,  # type: ignore
+                 SoupStrainer)
+from bs4.builder import builder_registry  # type: ignore
 from attrs import define, asdict
-from typing import Dict, Optional, Any, Callable
+from typing import (Dict, Optional, Any, Callable, Tuple, List, Iterable,
+                    Iterator, Set, TypeVar)
+
+from .cache import HTTPCache, default_cache, validators_from
+from .ratelimit import (RateLimiter, AdaptiveController, shared_limiter,
+                        parse_retry_after, retry_statuses)
 
 try:
     from selenium import webdriver
-    from selenium.webdriver.common.by import By
     import undetected_chromedriver.v2 as uc
     from selenium.webdriver.support.wait import WebDriverWait
 except Exception:
     webdriver = None
 
+T = TypeVar('T')
+
 def fold_string_indiscriminately(s: str, n: int = 80) -> str:
     """Folds a string (insert line-breaks where appropriate, to format
     on a display of no more than n columns) indiscriminately, meaning
     lose all existing whitespace formatting. This is the equivalent of
     doing an Emacs fill-paragraph on the string in question, though it
     doesn't break around double linefeeds like that function does."""
-    l = s.split()
-    rv = ""
+    # pieces are joined once at the end, so this is linear in the length of
+    # s; the first piece has a spurious leading space
+    rv: List[str] = []
+    add = rv.append
     cl = 0
-    for i in l:
-        if cl + len(i) + 1 < n:
-            rv += ' ' + i
-            cl += len(i) + 1
+    for i in s.split():
+        li = len(i)
+        if cl + li + 1 < n:
+            add(' ')
+            cl += li + 1
         else:
-            rv += ' \n' + i
-            cl = len(i)
-    return rv[1:]  # remove extraneous leading space
+            add(' \n')
+            cl = li
+        add(i)
+    return ''.join(rv)[1:]
 
 def fold_string_discriminately(s: str, n: int = 80) -> str:
     """Folds a string discriminately, that is, preserving existing
     hard line breaks in the original. This is the equivalent of
     passing the string to fold -s."""
-    l = s.splitlines()
-    rv = ""
-    for i in l:
+    rv = []
+    for i in s.splitlines():
         if len(i) < n:
-            rv += i + '\n'
+            rv.append(i)
         else:
-            rv += fold_string_indiscriminately(i, n) + '\n'
-    return rv
+            rv.append(fold_string_indiscriminately(i, n))
+        rv.append('\n')
+    return ''.join(rv)
 
 def make_filename(title: str) -> str:
     title = title.lower().replace(" ", "_")
@@ -58,6 +72,56 @@ def make_filename(title: str) -> str:
 def url_hash(url: str) -> str:
     return hashlib.sha256(url.encode()).hexdigest()
 
+# The BeautifulSoup tree builders site modules may parse pages with, fastest
+# first. lxml and html5lib are only available if installed; html.parser is
+# part of the standard library. The default is the fastest available, unless
+# overridden with FFMIRROR_PARSER or set_html_parser().
+parser_backends = ['lxml', 'html.parser', 'html5lib']
+
+def available_parsers() -> List[str]:
+    return [i for i in parser_backends if builder_registry.lookup(i)]
+
+def set_html_parser(name: str) -> None:
+    global html_parser
+    if name not in available_parsers():
+        raise ValueError(f"HTML parser '{name}' not available (have "
+                         f"{', '.join(available_parsers())})")
+    html_parser = name
+
+html_parser = available_parsers()[0]
+if os.environ.get('FFMIRROR_PARSER'):
+    set_html_parser(os.environ['FFMIRROR_PARSER'])
+
+def make_soup(markup: Any, parser: Optional[str] = None,
+              parse_only: Optional[SoupStrainer] = None) -> BeautifulSoup:
+    """Parse a page with the configured parser backend (or with parser, if
+    given). All site modules should parse through this.
+
+    If parse_only is given, only the tags it matches (and their contents) are
+    put in the tree, which saves time and memory on big pages. html5lib
+    can't do this and parses the whole page regardless, so callers must find
+    things the same way in either case.
+
+    """
+    parser = parser or html_parser
+    if parser == 'html5lib':
+        parse_only = None
+    return BeautifulSoup(markup, parser, parse_only=parse_only)
+
+def class_filter(*classes: str) -> Callable[[Any], bool]:
+    """An attribute filter for a SoupStrainer, matching tags with any of the
+    given classes. (The class_ argument won't do for this, since a strainer
+    sees the unsplit class attribute, which may hold several.)"""
+    cs = set(classes)
+
+    def match(value: Any) -> bool:
+        if value is None:
+            return False
+        if isinstance(value, str):
+            value = value.split()
+        return not cs.isdisjoint(value)
+    return match
+
 class FakeRequest:
     def __init__(self, d: bytes) -> None:
         self.data = d
@@ -65,173 +129,452 @@ class FakeRequest:
     def read(self) -> bytes:
         return self.data
 
+user_agent = ("Mozilla/5.0 (X11; Fedora; Linux x86_64; rv:76.0) "
+              "Gecko/20100101 Firefox/76.0")
+
 class NetworkFetcher:
-    def __init__(self, time_delay: float = 2.0):
-        self.last_fetch: Dict[str, float] = {}
-        self.delay = time_delay
+    """Fetches pages over plain HTTP, imposing a per-host delay between
+    requests. Each host gets its own long-lived requests.Session (or
+    cloudscraper session), so connections are kept alive and pooled and
+    cookies persist across fetches. pool_connections and pool_maxsize are
+    passed through to the underlying urllib3 pool. Fetch slots come from
+    limiter, which may be shared with other fetchers.
 
-    def do_fetch(self, url: str, timeout: int = 30,
-                 use_cloudscraper: bool = False) -> bytes:
-        headers = { "User-Agent":
-                    # "Mozilla/5.0 (X11; Ubuntu; Linux i686; rv:21.0) "
-                    # "Gecko/20100101 Firefox/21.0" }
-                    "Mozilla/5.0 (X11; Fedora; Linux x86_64; rv:76.0) "
-                    "Gecko/20100101 Firefox/76.0" }
-        host = urllib.parse.urlsplit(url).netloc
-        if host not in self.last_fetch:
-            self.last_fetch[host] = 0
-        wait = time.time() - self.last_fetch[host]
-        if wait < self.delay:
-            time.sleep(self.delay - wait)
-        self.last_fetch[host] = time.time()
+    """
+    def __init__(self, time_delay: Optional[float] = None,
+                 pool_connections: int = 4, pool_maxsize: int = 8,
+                 limiter: Optional[RateLimiter] = None):
+        if limiter is not None:
+            self.limiter = limiter
+        elif time_delay is not None:
+            self.limiter = RateLimiter(time_delay)
+        else:
+            self.limiter = shared_limiter
+        # a delay given here is a floor; the controller only slows down from
+        # it, never speeds up past it
+        if time_delay is not None:
+            self.controller = AdaptiveController(self.limiter,
+                                                 min_delay=time_delay)
+        else:
+            self.controller = AdaptiveController(self.limiter)
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.sessions: Dict[Tuple[str, bool], requests.Session] = {}
+        self._lock = threading.Lock()
 
+    def _make_session(self, use_cloudscraper: bool) -> requests.Session:
         if use_cloudscraper:
             if cloudscraper is None:
                 raise ValueError("cloudscraper not supported")
-            fetcher = cloudscraper.create_scraper(
+            # cloudscraper mounts its own TLS adapter on https://, which we
+            # leave alone; it sets its own user agent as well
+            return cloudscraper.create_scraper(
                 browser={
                     'browser': 'firefox',
                     'platform': 'windows',
                     'mobile': False,
                     'desktop': True,
                 })
-            headers = {}
-        else:
-            fetcher = requests
-        r = fetcher.get(url, headers=headers, timeout=timeout)
+        s = requests.Session()
+        s.headers['User-Agent'] = user_agent
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize)
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
+        return s
+
+    def get_session(self, host: str,
+                    use_cloudscraper: bool = False) -> requests.Session:
+        """Get the session for the given host, creating it if necessary. The
+        session is reused for every later fetch to that host.
+
+        """
+        key = (host, use_cloudscraper)
+        with self._lock:
+            if key not in self.sessions:
+                self.sessions[key] = self._make_session(use_cloudscraper)
+            return self.sessions[key]
+
+    def import_browser_session(self, host: str,
+                               cookies: List[Dict[str, Any]],
+                               ua: str) -> None:
+        """Copy cookies and user agent from a browser into the session for host, so
+        that plain requests carry the browser's clearance."""
+        s = self.get_session(host)
+        s.headers['User-Agent'] = ua
+        for c in cookies:
+            s.cookies.set(c['name'], c['value'], domain=c.get('domain', ''),
+                          path=c.get('path', '/'))
+
+    def close(self) -> None:
+        with self._lock:
+            for s in self.sessions.values():
+                s.close()
+            self.sessions.clear()
+
+    def request_now(self, url: str, timeout: int = 30,
+                    use_cloudscraper: bool = False,
+                    headers: Optional[Dict[str, str]] = None
+                    ) -> requests.Response:
+        """Request a URL immediately, without waiting on the rate limiter, and
+        return the response. Callers must have taken a slot from the limiter
+        themselves. Raises HTTPError for error statuses; a 304 is returned
+        like any other success.
+
+        """
+        host = urllib.parse.urlsplit(url).netloc
+        session = self.get_session(host, use_cloudscraper)
+        start = time.monotonic()
+        try:
+            r = session.get(url, timeout=timeout, headers=headers)
+        except requests.exceptions.RequestException:
+            self.controller.record(host, None, time.monotonic() - start)
+            raise
+        self.controller.record(
+            host, r.status_code, time.monotonic() - start,
+            parse_retry_after(r.headers.get('Retry-After')))
         r.raise_for_status()
 
+        return r
+
+    def fetch_now(self, url: str, timeout: int = 30,
+                  use_cloudscraper: bool = False) -> bytes:
+        return self.request_now(url, timeout, use_cloudscraper).content
+
+    def do_request(self, url: str, timeout: int = 30,
+                   use_cloudscraper: bool = False,
+                   headers: Optional[Dict[str, str]] = None
+                   ) -> requests.Response:
+        host = urllib.parse.urlsplit(url).netloc
+        self.limiter.wait(host)
+        return self.request_now(url, timeout, use_cloudscraper, headers)
+
+    def do_fetch(self, url: str, timeout: int = 30,
+                 use_cloudscraper: bool = False) -> bytes:
+        return self.do_request(url, timeout, use_cloudscraper).content
+
+default_fetcher = NetworkFetcher()
+
+class AsyncFetcher:
+    """An asyncio front end to a NetworkFetcher. Fetches to different hosts
+    run concurrently; fetches to the same host are limited to
+    host_concurrency in flight at once, and still take their slots from the
+    NetworkFetcher's rate limiter, so the per-host delay is honored across
+    sync and async callers alike. The blocking requests calls run on a
+    thread pool.
+
+    """
+    def __init__(self, fetcher: Optional[NetworkFetcher] = None,
+                 host_concurrency: int = 1, max_workers: int = 8) -> None:
+        self.fetcher = fetcher if fetcher is not None else default_fetcher
+        self.host_concurrency = host_concurrency
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='ffmirror-fetch')
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._sems: Dict[str, asyncio.Semaphore] = {}
+
+    def _host_semaphore(self, host: str) -> asyncio.Semaphore:
+        # semaphores belong to an event loop, so start over if the sync
+        # facade has been called again with a fresh one
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._sems = {}
+        if host not in self._sems:
+            self._sems[host] = asyncio.Semaphore(self.host_concurrency)
+        return self._sems[host]
+
+    async def request(self, url: str, timeout: int = 30,
+                      use_cloudscraper: bool = False,
+                      headers: Optional[Dict[str, str]] = None
+                      ) -> requests.Response:
+        host = urllib.parse.urlsplit(url).netloc
+        async with self._host_semaphore(host):
+            await self.fetcher.limiter.wait_async(host)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.executor, functools.partial(
+                    self.fetcher.request_now, url, timeout, use_cloudscraper,
+                    headers))
+
+    async def fetch(self, url: str, timeout: int = 30,
+                    use_cloudscraper: bool = False) -> bytes:
+        r = await self.request(url, timeout, use_cloudscraper)
         return r.content
 
-def urlopen_retry(url: str, tries: int = 3, delay: float = 1.0,
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
+
+def _retry_wait(fetcher: NetworkFetcher, e: Exception, attempt: int,
+                tries: int, delay: float) -> float:
+    """Decide whether a failed fetch should be retried. Returns how long to wait
+    before the retry, or reraises e if it shouldn't be. Connection failures
+    and timeouts are retried, as are HTTP errors that mean the site is
+    throttling us or briefly unavailable; other HTTP errors (e.g. 404) are
+    not.
+
+    """
+    retry_after = None
+    if isinstance(e, requests.exceptions.HTTPError):
+        if e.response is None or e.response.status_code not in retry_statuses:
+            raise e
+        retry_after = parse_retry_after(e.response.headers.get('Retry-After'))
+    if attempt == tries - 1:
+        raise e
+    return fetcher.controller.retry_delay(attempt, delay, retry_after)
+
+def _cache_response(cache: Optional[HTTPCache], url: str,
+                    r: requests.Response) -> Optional[FakeRequest]:
+    """Turn a response into a FakeRequest, storing it in cache along with its
+    validators. For a 304, the cached body is returned and its entry marked
+    fresh again; if the entry has gone missing since the conditional request
+    was made, returns None.
+
+    """
+    if r.status_code == 304:
+        if cache is None:
+            return None
+        data = cache.revalidated(url)
+        return FakeRequest(data) if data is not None else None
+    if cache is not None:
+        cache.put(url, r.content, validators_from(r.headers))
+    return FakeRequest(r.content)
+
+retry_exceptions = (urllib.error.URLError, requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout, requests.exceptions.HTTPError)
+
+def urlopen_retry(url: str, tries: int = 5, delay: float = 1.0,
                   timeout: int = 30,
-                  cache_dir: str = '/home/tom/.ffmirror_cache',
-                  fetcher: NetworkFetcher =
-                  NetworkFetcher(),
+                  cache: Optional[HTTPCache] = default_cache,
+                  fetcher: NetworkFetcher = default_fetcher,
                   use_cloudscraper: bool = False) -> Optional[FakeRequest]:
     """Open a URL, with retries on failure. Spoofs user agent to look like Firefox,
-    since FFnet 403s the urllib UA."""
-    fn = None
-    if cache_dir is not None:
-        uh = url_hash(url)
-        fn = os.path.join(cache_dir, uh)
-        if os.path.exists(fn) and os.stat(fn).st_mtime > time.time() - 43200:
-            try:
-                with open(fn) as inp:
-                    r = json.load(inp)
-                return FakeRequest(r['data'].encode())
-            except Exception:
-                pass
+    since FFnet 403s the urllib UA. Retries back off exponentially from
+    delay, or wait as long as the site's Retry-After asks. Responses are
+    stored in and served from cache, unless it's None; once a cached page
+    goes stale, it's revalidated with a conditional request, so an unchanged
+    page costs only a 304."""
+    headers = {}
+    if cache is not None:
+        cached = cache.get(url)
+        if cached is not None:
+            return FakeRequest(cached)
+        headers = cache.conditional_headers(url)
     for i in range(tries):
         try:
             # r = open_func(req, timeout=timeout)
-            data = fetcher.do_fetch(url, timeout,
-                                    use_cloudscraper=use_cloudscraper)
-        except urllib.error.URLError as e:
-            if i == tries - 1:
-                raise e
-            time.sleep(delay)
+            r = fetcher.do_request(url, timeout,
+                                   use_cloudscraper=use_cloudscraper,
+                                   headers=headers)
+        except retry_exceptions as e:
+            time.sleep(_retry_wait(fetcher, e, i, tries, delay))
         else:
-            if fn is not None:
-                try:
-                    o = { 'data': data.decode() }
-                except UnicodeDecodeError:
-                    print(url)
-                    print(repr(data))
-                    raise
-                with open(fn, 'w') as out:
-                    json.dump(o, out)
-                return FakeRequest(o['data'].encode())
-            return FakeRequest(data)
+            rv = _cache_response(cache, url, r)
+            if rv is not None:
+                return rv
+            headers = {}
     return None
 
+async def urlopen_retry_async(
+        url: str, fetcher: AsyncFetcher, tries: int = 5, delay: float = 1.0,
+        timeout: int = 30, cache: Optional[HTTPCache] = default_cache,
+        use_cloudscraper: bool = False) -> Optional[FakeRequest]:
+    """The asyncio version of urlopen_retry, fetching through the given
+    AsyncFetcher."""
+    headers = {}
+    if cache is not None:
+        cached = cache.get(url)
+        if cached is not None:
+            return FakeRequest(cached)
+        headers = cache.conditional_headers(url)
+    for i in range(tries):
+        try:
+            r = await fetcher.request(url, timeout,
+                                      use_cloudscraper=use_cloudscraper,
+                                      headers=headers)
+        except retry_exceptions as e:
+            await asyncio.sleep(_retry_wait(fetcher.fetcher, e, i, tries,
+                                            delay))
+        else:
+            rv = _cache_response(cache, url, r)
+            if rv is not None:
+                return rv
+            headers = {}
+    return None
+
+def urlopen_many(urls: Iterable[str],
+                 fetcher: Optional[AsyncFetcher] = None,
+                 **kwargs: Any) -> List[Optional[FakeRequest]]:
+    """Synchronous facade for fetching several URLs at once. Returns results in
+    the same order as urls. Fetches to different hosts proceed concurrently,
+    subject to the per-host limits of the fetcher; keyword arguments are as
+    for urlopen_retry.
+
+    """
+    af = fetcher if fetcher is not None else AsyncFetcher()
+
+    async def run() -> List[Optional[FakeRequest]]:
+        return await asyncio.gather(*(urlopen_retry_async(u, af, **kwargs)
+                                      for u in urls))
+
+    try:
+        return asyncio.run(run())
+    finally:
+        if fetcher is None:
+            af.close()
+
 def rectify_strings(d: Dict[str, Any]) -> Dict[str, Any]:
     for i in d:
         if isinstance(d[i], NavigableString):
             d[i] = str(d[i])
     return d
 
-global_driver = None
-hooks_set = False
-
-def set_hooks():
-    global hooks_set
+class BrowserWorker:
+    """One browser in a BrowserPool. The driver is started on first use, and can be
+    replaced with restart() if it wedges, without disturbing the pool's other
+    workers.
 
-    def quit_driver():
-        global global_driver
-        if global_driver is None:
+    """
+    def __init__(self, pool: BrowserPool) -> None:
+        self.pool = pool
+        self._driver: Any = None
+
+    @property
+    def driver(self) -> Any:
+        if self._driver is None:
+            self._driver = self.pool.start_driver()
+        return self._driver
+
+    def quit(self) -> None:
+        if self._driver is None:
             return
         try:
-            global_driver.quit()
+            self._driver.quit()
         except Exception:
             pass
+        self._driver = None
 
-    def exh(t, v, tb):
-        quit_driver()
-        return sys.__excepthook__(t, v, tb)
-
-    # ideally we might set excepthook here in order to handle non-normal exits;
-    # I leave it unset for easier debugging of issues involving the browser
-    # sys.excepthook = exh
-
-    atexit.register(quit_driver)
+    def restart(self) -> Any:
+        self.quit()
+        return self.driver
 
-    hooks_set = True
+class BrowserPool:
+    """A bounded pool of size browser workers. worker() checks one out for the
+    duration of a with block, waiting if all are in use. Drivers are headless
+    unless headless is False.
 
-def get_webdriver():
-    """Get a webdriver. If Selenium is not available or no driver can be created,
-    return None; in this case, ffmirror will fall back on direct HTTP requests
-    (not all sites supported).
+    """
+    def __init__(self, size: int = 2, headless: bool = True) -> None:
+        self.size = size
+        self.headless = headless
+        self.workers = [BrowserWorker(self) for i in range(size)]
+        self._idle = list(self.workers)
+        self._cond = threading.Condition()
+        # undetected_chromedriver patches the driver binary when it starts, so
+        # only start one at a time
+        self._start_lock = threading.Lock()
+
+    def start_driver(self) -> Any:
+        opts = uc.ChromeOptions()
+        if self.headless:
+            opts.add_argument('--headless=new')
+        with self._start_lock:
+            return uc.Chrome(options=opts)
+
+    @contextlib.contextmanager
+    def worker(self) -> Iterator[BrowserWorker]:
+        with self._cond:
+            while not self._idle:
+                self._cond.wait()
+            w = self._idle.pop()
+        try:
+            yield w
+        finally:
+            with self._cond:
+                self._idle.append(w)
+                self._cond.notify()
+
+    def close(self) -> None:
+        for w in self.workers:
+            w.quit()
+
+browser_pool_size = int(os.environ.get('FFMIRROR_BROWSERS', '2'))
+browser_headless = os.environ.get('FFMIRROR_HEADLESS', '1') != '0'
+global_pool: Optional[BrowserPool] = None
+pool_lock = threading.Lock()
+
+def get_browser_pool() -> Optional[BrowserPool]:
+    """Get the process-wide browser pool, sized by $FFMIRROR_BROWSERS (default 2)
+    and headless unless $FFMIRROR_HEADLESS is 0. If Selenium is not
+    available, return None; in this case, ffmirror will fall back on direct
+    HTTP requests (not all sites supported).
 
     """
     if webdriver is None:
         return None
 
-    if not hooks_set:
-        set_hooks()
-
-    global global_driver
-
-    if global_driver is None:
-        global_driver = uc.Chrome()
-
-    return global_driver
-
-def restart_webdriver():
-    global global_driver
-    if global_driver is None:
-        return None
-
-    global_driver.quit()
-    global_driver = None
-
-    return get_webdriver()
-
-class TimeoutException(BaseException):
+    global global_pool
+    with pool_lock:
+        if global_pool is None:
+            global_pool = BrowserPool(browser_pool_size, browser_headless)
+            # ideally we might also quit the browsers from sys.excepthook, to
+            # handle non-normal exits; I leave it unset for easier debugging
+            # of issues involving the browser
+            atexit.register(global_pool.close)
+    return global_pool
+
+class TimeoutException(Exception):
     pass
 
-def sigalrm_handler(signum, frame):
-    raise TimeoutException()
+class Watchdog:
+    """A per-call timeout that works from any thread. Used as a context manager
+    around a blocking call: if the block hasn't exited within timeout
+    seconds, on_expire is called from a timer thread and fired is set.
+    on_expire should do something that makes the blocked call fail, such as
+    quitting the browser it's waiting on.
 
-signal.signal(signal.SIGALRM, sigalrm_handler)
+    """
+    def __init__(self, timeout: float, on_expire: Callable[[], None]) -> None:
+        self.timeout = timeout
+        self.on_expire = on_expire
+        self.fired = False
+        self._timer: Optional[threading.Timer] = None
+
+    def _expire(self) -> None:
+        self.fired = True
+        self.on_expire()
+
+    def __enter__(self) -> Watchdog:
+        self._timer = threading.Timer(self.timeout, self._expire)
+        self._timer.daemon = True
+        self._timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        assert self._timer is not None
+        self._timer.cancel()
 
 class BrowserFetcher:
-    """A class to handle using the browser driver to fetch pages. Contains a
-    reference to the global driver, and imposes a global delay on all
-    fetches. The get_html() method simply downloads a page and returns the HTML
-    contents from the DOM; more sophisticated applications may manipulate the
-    driver attribute directly. Any manual driver manipulation must call
-    wait_for_delay() between fetches in order to respect the rate limit.
+    """A class to handle using browser drivers to fetch pages. Drivers are checked
+    out from the process-wide browser pool for each fetch, so fetchers for
+    different hosts (or different job queues) can run side by side, and
+    fetch slots come from the shared rate limiter, so browser fetches count
+    against the same per-host budget as plain HTTP fetches. The get_html()
+    method simply downloads a page and returns its HTML; more sophisticated
+    applications may check a worker out of self.pool themselves. Any manual
+    driver manipulation must call wait_for_delay() before each fetch in order
+    to respect the rate limit.
 
     """
-    fetch_delay = 2.0
-    last_fetch = 0.0
+    limiter: RateLimiter = shared_limiter
     # Timeout used for waiting until the site displays
     display_timeout = 10
     # Timeout for handling buggy webdriver
     restart_timeout = 20
 
-    def __init__(self, test: Any = None) -> None:
+    def __init__(self, test: Any = None,
+                 pool: Optional[BrowserPool] = None) -> None:
         # test is a webdriver wait function; it takes a driver as its only
         # argument, and returns True if the site has finished loading
 
@@ -241,39 +584,134 @@ class BrowserFetcher:
         else:
             self.test = test
 
-        self.driver = get_webdriver()
+        self.pool = pool if pool is not None else get_browser_pool()
 
     @classmethod
-    def wait_for_delay(cls) -> None:
-        now = time.time()
-        since_last = now - cls.last_fetch
-        if since_last < cls.fetch_delay:
-            time.sleep(cls.fetch_delay - since_last)
-        cls.update_last_fetch()
+    def wait_for_delay(cls, url: str) -> None:
+        cls.limiter.wait(urllib.parse.urlsplit(url).netloc)
+
+    def _fetch(self, url: str, tries: int,
+               extract: Callable[[Any], T]) -> T:
+        """Load url in a pooled browser, wait for it to display, then return
+        extract(driver)."""
+        self.wait_for_delay(url)
+        assert self.pool is not None
+        with self.pool.worker() as worker:
+            while True:
+                r: Optional[T] = None
+                # if the driver wedges, the watchdog quits it, which makes the
+                # blocked call fail; we then retry on a fresh driver
+                with Watchdog(self.restart_timeout, worker.quit) as wd:
+                    try:
+                        driver = worker.driver
+                        driver.get(url)
+                        WebDriverWait(driver,
+                                      timeout=self.display_timeout).until(
+                                          self.test)
+                        r = extract(driver)
+                    except Exception:
+                        if not wd.fired:
+                            raise
+                if r is not None:
+                    break
+                worker.quit()
+                tries -= 1
+                if tries <= 0:
+                    raise TimeoutException(
+                        f"browser timed out fetching {url}")
+        return r
 
-    @classmethod
-    def update_last_fetch(cls) -> None:
-        cls.last_fetch = time.time()
+    def get_html(self, url: str, tries: int = 3) -> str:
+        return self._fetch(url, tries, lambda d: d.page_source)
+
+    def get_clearance(self, url: str, tries: int = 3
+                      ) -> Tuple[str, List[Dict[str, Any]], str]:
+        """Fetch a page as get_html() does, also returning the browser's cookies and
+        user agent once the page has displayed. Once past a Cloudflare check,
+        these can be used to make further requests without the browser."""
+        return self._fetch(url, tries, lambda d: (
+            d.page_source, d.get_cookies(),
+            d.execute_script("return navigator.userAgent")))
+
+def is_challenge(r: requests.Response) -> bool:
+    """Check whether a response is a Cloudflare challenge rather than the page we
+    asked for."""
+    if r.headers.get('cf-mitigated') == 'challenge':
+        return True
+    if r.status_code in (403, 503) and 'cloudflare' in \
+       r.headers.get('Server', '').lower():
+        return True
+    return False
+
+def response_text(r: requests.Response) -> str:
+    # requests assumes ISO-8859-1 for text/html with no charset given, but
+    # the sites we deal with are all UTF-8
+    if 'charset' in r.headers.get('Content-Type', ''):
+        return r.text
+    return r.content.decode('utf-8', errors='replace')
+
+class HybridFetcher:
+    """Fetches pages over plain HTTP where possible, using the browser only to get
+    past Cloudflare. The first fetch from a host goes through the browser;
+    its cookies (including the Cloudflare clearance) and user agent are then
+    copied into the NetworkFetcher's pooled session for that host, and later
+    fetches are made with that session. If a plain fetch gets challenged
+    again, or page_ok rejects what came back, the page is refetched with the
+    browser and the session's clearance renewed. If no browser is available,
+    all fetches are plain HTTP.
+
+    Plain fetches that fail are retried as urlopen_retry does, up to tries
+    times, backing off from delay or waiting out the site's Retry-After.
+
+    Provides get_html() like BrowserFetcher, so site modules can use either.
+
+    """
+    def __init__(self, test: Any = None,
+                 page_ok: Optional[Callable[[str], bool]] = None,
+                 network: Optional[NetworkFetcher] = None,
+                 browser: Optional[BrowserFetcher] = None,
+                 delay: float = 1.0) -> None:
+        self.network = network if network is not None else default_fetcher
+        self.browser = browser if browser is not None else BrowserFetcher(test)
+        self.page_ok = page_ok if page_ok is not None else lambda s: True
+        self.delay = delay
+        self.cleared: Set[str] = set()
+
+    def _clear(self, url: str, tries: int) -> str:
+        host = urllib.parse.urlsplit(url).netloc
+        page, cookies, ua = self.browser.get_clearance(url, tries)
+        self.network.import_browser_session(host, cookies, ua)
+        self.cleared.add(host)
+        return page
 
     def get_html(self, url: str, tries: int = 3) -> str:
-        self.wait_for_delay()
-        while True:
-            signal.alarm(self.restart_timeout)
-            try:
-                self.driver.get(url)
-                WebDriverWait(self.driver, timeout=10).until(self.test)
-                el = self.driver.find_element(By.TAG_NAME, "html")
-                r = el.get_attribute("outerHTML")
-                self.update_last_fetch()
-            except TimeoutException:
-                self.driver = restart_webdriver()
-                tries -= 1
-                if tries <= 0:
-                    raise
-            else:
-                signal.alarm(0)
+        host = urllib.parse.urlsplit(url).netloc
+        have_browser = self.browser.pool is not None
+        if host in self.cleared or not have_browser:
+            for i in range(tries):
+                try:
+                    r = self.network.do_request(url)
+                except retry_exceptions as e:
+                    # a challenge goes to the browser rather than being
+                    # retried; anything else is retried or reraised
+                    if (have_browser and
+                        isinstance(e, requests.exceptions.HTTPError) and
+                        e.response is not None and
+                        is_challenge(e.response)):  # noqa: E129
+                        break
+                    time.sleep(_retry_wait(self.network, e, i, tries,
+                                           self.delay))
+                    continue
+                if is_challenge(r):
+                    if not have_browser:
+                        raise ValueError(f"challenged fetching {url}")
+                else:
+                    text = response_text(r)
+                    if self.page_ok(text) or not have_browser:
+                        return text
                 break
-        return r
+            self.cleared.discard(host)
+        return self._clear(url, tries)
 
 @define
 class JobStatus:
@@ -282,6 +720,8 @@ class JobStatus:
     progress: Optional[int] = None
     total: Optional[int] = None
     info: Optional[str] = None
+    # the fetch queue the job is on, when several run at once
+    queue: Optional[str] = None
 
     def to_json(self) -> str:
         return json.dumps(asdict(self))
@@ -2,17 +2,19 @@
 
 import ffmirror.metadb as metadb
 # import ffmirror
-import os
+import os, threading
 from pathlib import Path
+from typing import Optional
 
 from itertools import chain
 from operator import attrgetter
 
-from flask import (Flask, g, render_template, url_for, request, abort,
-                   redirect, session)
+from flask import (Flask, g, render_template, stream_template, url_for,
+                   request, abort, redirect, session)
 
 class DefaultConfig:
     PAGE_THRES = 100
+    DB_PROFILE = None  # one of metadb.db_profiles; None for the default
 
 app = Flask(__name__, instance_relative_config=True)
 app.secret_key = "dev"
@@ -21,7 +23,7 @@ app.config.from_envvar("FFMIRROR_CONFIG")
 if 'FF_DIR' not in app.config:
     raise Exception("Must provide FFMIRROR_CONFIG that sets FF_DIR")
 
-from . import tasks  # noqa: E402
+from . import tasks, paging  # noqa: E402
 
 def template_function(func):
     app.jinja_env.globals[func.__name__] = func
@@ -34,6 +36,13 @@ def page_url(pagenum):
     args['page'] = pagenum
     return url_for(request.endpoint, **args)
 
+@template_function
+def cursor_url(cursor):
+    args = request.view_args.copy()
+    args.update(request.args)
+    args['cursor'] = cursor
+    return url_for(request.endpoint, **args)
+
 @template_function
 def find_story(site, sid):
     ind = g.mirror.get_index(check=False)
@@ -63,15 +72,49 @@ def sort_by(slist, order):
 def stories_present(slist):
     return [i for i in slist if i.download_fn is not None]
 
+_mirror: Optional[metadb.DBMirror] = None
+_mirror_pid: Optional[int] = None
+_mirror_lock = threading.Lock()
+
+def _reset_mirror_lock() -> None:
+    # a forked child gets the lock as it was, possibly held by a thread that
+    # doesn't exist there
+    global _mirror_lock
+    _mirror_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):  # not on Windows
+    os.register_at_fork(after_in_child=_reset_mirror_lock)
+
+def process_mirror() -> metadb.DBMirror:
+    """The mirror whose engine (and so connection pool) is shared by every
+    request this process serves. It's made on first use in each process, so
+    pre-forking servers don't share SQLite connections between workers. Its
+    Session is a scoped_session, giving each request thread its own
+    session. The first requests may arrive on several threads at once, so
+    it's made under a lock, lest each make its own engine.
+
+    """
+    global _mirror, _mirror_pid
+    if _mirror is None or _mirror_pid != os.getpid():
+        with _mirror_lock:
+            if _mirror is None or _mirror_pid != os.getpid():
+                m = metadb.DBMirror(app.config['FF_DIR'],
+                                    debug=app.config['DEBUG'],
+                                    profile=app.config['DB_PROFILE'])
+                m.connect()
+                m.Session = metadb.scoped_session(m.Session)
+                _mirror, _mirror_pid = m, os.getpid()
+    return _mirror
+
 @app.before_request
 def req_setup():
-    g.mirror = metadb.DBMirror(app.config['FF_DIR'], debug=app.config['DEBUG'])
-    g.mirror.connect()
+    g.mirror = process_mirror().fork()
     app.config['FAV_DIR'] = os.path.join(app.config['FF_DIR'], '.favs')
 
 @app.teardown_appcontext
 def req_teardown(ex):
-    g.mirror.ds.close()
+    if 'mirror' in g:
+        process_mirror().Session.remove()
 
 def sort_query(aq):
     al = []
@@ -82,50 +125,24 @@ def sort_query(aq):
         auth.query_stories.append(story)
     return al
 
-def query_pages(alist):
-    """A generator that returns pages (type [metadb.Author]) for the given
-    query.
-
-    """
-    rv = []
-    cp = 0
-    page_thres = app.config['PAGE_THRES']
-    for i in alist:
-        rv.append(i)
-        cp += len(i.query_stories)
-        if cp >= page_thres:
-            yield rv
-            rv = []
-            cp = 0
-    yield rv
-
-@template_function
-def get_page(ind, alist):
-    """This function returns a page (list of metadb.Author) given its index. Second
-    return value is a boolean stating whether requested page is the last one.
-
-    """
-    if ind == -1:
-        return alist, True
-    pl = list(query_pages(alist))
-    return pl[ind], ind >= len(pl) - 1
-
-@template_function
-def find_author(ao, alist):
-    for n, i in enumerate(query_pages(alist)):
-        if ao in i:
-            return n
-    return None
-
+@app.route('/index')
 def index():
     pagenum = int(request.args.get('page', 0))
+    ap = paging.author_pages(g.mirror.ds, app.config['PAGE_THRES'])
+    if pagenum < -1 or pagenum > ap.last_page:
+        abort(404)
     query = (g.mirror.ds.query(metadb.Author, metadb.Story)
-             .options(metadb.joinedload(metadb.Story.tags))
+             .options(metadb.selectinload(metadb.Story.tags))
              .filter(metadb.Story.author_id == metadb.Author.id)
              .filter(metadb.Author.in_mirror == True)  # noqa: E712
-             .order_by(metadb.func.lower(metadb.Author.name)))
+             .order_by(metadb.func.lower(metadb.Author.name),
+                       metadb.Author.id))
+    # page -1 is every author on one page
+    if pagenum != -1:
+        query = query.filter(metadb.Author.id.in_(ap.authors_on(pagenum)))
     return render_template('main_index.html', pagenum=pagenum,
-                           alist=sort_query(query), tag=None)
+                           authors=ap.entries, cpage=sort_query(query),
+                           last_page=pagenum in (-1, ap.last_page), tag=None)
 
 @app.route('/')
 def frontpage():
@@ -142,26 +159,29 @@ def all_authors():
 
 @app.route('/list/<author>')
 def to_author(author):
+    ap = paging.author_pages(g.mirror.ds, app.config['PAGE_THRES'])
     try:
-        ao = g.mirror.ds.query(metadb.Author).filter_by(id=author).one()
-    except metadb.exc.NoResultFound:
+        page = ap.page_of[int(author)]
+    except (ValueError, KeyError):
         abort(404)
-    query = (g.mirror.ds.query(metadb.Author, metadb.Story)
-             .filter(metadb.Story.author_id == metadb.Author.id)
-             .filter(metadb.Author.in_mirror == True)  # noqa: E712
-             .order_by(metadb.text("lower(name)")))
-    page = find_author(ao, sort_query(query))
-    if page is not None:
-        return redirect(url_for('index', page=page) + '#' + author)
-    abort(404)
-
-@app.route('/story/<storyid>')
-def story(storyid):
-    # if not filepath.endswith('.html'):
-    #     abort(404)
+    return redirect(url_for('index', page=page) + '#' + author)
+
+def chapter_texts(sd, chapters):
+    """Yield (chapter, text) for each chapter, reading each file only as it's
+    reached, so a streamed story never has more than one chapter in
+    memory."""
+    for c in chapters:
+        yield c, (sd / c.filename()).read_text()
+
+@app.route('/story/<storyid>', defaults={'first': None, 'last': None})
+@app.route('/story/<storyid>/<int:first>', defaults={'last': None})
+@app.route('/story/<storyid>/<int:first>-<int:last>')
+def story(storyid, first, last):
+    """Show a story, or just chapter first of it, or chapters first to last.
+    The page is streamed, reading chapter files as they're sent."""
     try:
         story = (g.mirror.ds.query(metadb.Story).
-                 options(metadb.joinedload(metadb.Story.all_chapters)).
+                 options(metadb.selectinload(metadb.Story.all_chapters)).
                  filter_by(id=storyid).one())
     except metadb.exc.NoResultFound:
         abort(404)
@@ -171,30 +191,53 @@ def story(storyid):
     sd = md / story.download_fn
     if not sd.is_dir():
         abort(404)
-    for c in story.all_chapters:
-        fp = sd / f"{c.num:04d}.html"
-        c.chapter_text = fp.read_text()
-    return render_template('view_story.html', story=story)
+    chapters = story.all_chapters
+    if first is not None:
+        if last is None:
+            last = first
+        chapters = [c for c in chapters if first <= c.num <= last]
+        if not chapters or last < first:
+            abort(404)
+    # once the response has started it's too late to send a 404, so check
+    # the files are all there first
+    if not all((sd / c.filename()).is_file() for c in chapters):
+        abort(404)
+    return stream_template('view_story.html', story=story,
+                           shown=set(c.num for c in chapters),
+                           whole=first is None, first=first, last=last,
+                           chapters=chapter_texts(sd, chapters))
     # return send_from_directory(app.config['FF_DIR'], filepath,
     #                            mimetype='text/html')
 
+def story_listing(query, total_name):
+    """Render a page of a listing of (Story, Author) rows, at the position given
+    by the cursor in the request args."""
+    order = request.args.get('sort', 'updated')
+    if order not in paging.sorts:
+        abort(400)
+    total = paging.cached_count(total_name, query)
+    try:
+        page = paging.keyset_page(
+            query.options(metadb.selectinload(metadb.Story.tags)), order,
+            request.args.get('cursor'), app.config['PAGE_THRES'])
+    except ValueError:
+        abort(400)
+    return render_template('all_stories.html', listing=page.rows,
+                           prev_cursor=page.prev_cursor,
+                           next_cursor=page.next_cursor, total=total)
+
 @app.route('/tag/<path:tagname>')
 def tag(tagname):
-    order = request.args.get('sort', 'updated')
-    page = int(request.args.get('page', 0))
-    page_count = app.config['PAGE_THRES']
-    to = g.mirror.ds.query(metadb.Tag).filter_by(name=tagname).one()
+    try:
+        to = g.mirror.ds.query(metadb.Tag).filter_by(name=tagname).one()
+    except metadb.exc.NoResultFound:
+        abort(404)
     query = (g.mirror.ds.query(metadb.Story, metadb.Author)
-             .options(metadb.joinedload(metadb.Story.tags))
-             .filter(metadb.Story.tags.contains(to))
+             .join(metadb.story_tags_table)
+             .filter(metadb.story_tags_table.c.tag_id == to.id)
              .filter(metadb.Story.author_id == metadb.Author.id)
              .filter(metadb.Author.in_mirror == True))  # noqa: E712
-    num_stories = query.count()
-    last_page = num_stories // page_count
-    sl = (query.order_by(sorts[order]).
-          limit(page_count).offset(page * page_count).all())
-    return render_template('all_stories.html', listing=sl, page=page,
-                           last_page=last_page)
+    return story_listing(query, ('tag', to.id))
     # return render_template('main_index.html', pagenum=pagenum,
     #                        alist=sort_query(query), tag=tagname)
 
@@ -251,29 +294,12 @@ def wait_for_fav(task_id):
     #       f"(author {author_url})")
 
 
-sorts = {
-    'title': metadb.Story.title, 'author': metadb.Author.name,
-    'category': metadb.Story.category, 'words': metadb.Story.words.desc(),
-    'updated': metadb.Story.updated.desc()
-}
-
 @app.route('/all_stories')
 def all_stories():
-    order = request.args.get('sort', 'updated')
-    page_count = app.config['PAGE_THRES']
-    page = int(request.args.get('page', 0))
-    num_stories = (g.mirror.ds.query(metadb.Story, metadb.Author).
-                   filter(metadb.Story.author_id == metadb.Author.id).
-                   filter(metadb.Author.in_mirror == True).count())
-    all_stories = (g.mirror.ds.query(metadb.Story, metadb.Author).
-                   options(metadb.joinedload(metadb.Story.tags)).
-                   filter(metadb.Story.author_id == metadb.Author.id).
-                   filter(metadb.Author.in_mirror == True))  # noqa: E712
-    last_page = num_stories // page_count
-    sl = (all_stories.order_by(sorts[order]).
-          limit(page_count).offset(page * page_count).all())
-    return render_template('all_stories.html', listing=sl, page=page,
-                           last_page=last_page)
+    query = (g.mirror.ds.query(metadb.Story, metadb.Author).
+             filter(metadb.Story.author_id == metadb.Author.id).
+             filter(metadb.Author.in_mirror == True))  # noqa: E712
+    return story_listing(query, 'all_stories')
 
 @app.route("/refresh_test")
 def refresh_test():
@@ -0,0 +1,176 @@
+# Keyset pagination for the story listings in the web view. Rather than
+# skipping OFFSET rows to reach a page, each page is fetched by seeking past
+# the sort key of the last story on the page before, so a page deep in a
+# listing costs no more than the first one. Positions are passed around as
+# opaque cursors. Listing totals are counted once and cached for a while,
+# rather than on every page load.
+
+import base64, json, time
+
+from sqlalchemy import func, literal_column, and_, or_
+from sqlalchemy.orm import Query
+
+from typing import Dict, Tuple, Optional, List, Any, Union, NamedTuple
+
+from ..metadb import Story, Author, story_sort_keys
+
+Key = Union[str, int]
+
+# The sort orders for story listings, as (key, descending). Every key is
+# combined with the story ID, so that stories with equal keys still have a
+# fixed order. The story keys are indexed, so a page is a short index scan;
+# sorting by author sorts the whole listing, but still costs the same at any
+# depth.
+sorts = {
+    'updated': (story_sort_keys['updated'], True),
+    'words': (story_sort_keys['words'], True),
+    'title': (story_sort_keys['title'], False),
+    'author': (func.coalesce(Author.name, literal_column("''")), False),
+    'category': (story_sort_keys['category'], False),
+}
+
+class Page(NamedTuple):
+    rows: List[Any]
+    prev_cursor: Optional[str]
+    next_cursor: Optional[str]
+
+def encode_cursor(order: str, key: Key, sid: int, back: bool) -> str:
+    data = json.dumps([order, key, sid, back], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str, order: str) -> Tuple[Key, int, bool]:
+    """Decode a cursor made by encode_cursor() for the given sort order. Raises
+    ValueError if it's malformed or was made for another order."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        c_order, key, sid, back = json.loads(raw)
+    except Exception:
+        raise ValueError("Malformed cursor")
+    if (c_order != order or not isinstance(key, (str, int)) or
+        not isinstance(sid, int) or not isinstance(back, bool)):  # noqa: E129
+        raise ValueError("Cursor doesn't match this listing")
+    return key, sid, back
+
+def keyset_page(query: Query, order: str, cursor: Optional[str],
+                page_size: int) -> Page:
+    """Get a page of a story listing. query selects the listing's stories
+    (along with anything else, such as their authors), and must join Author
+    for the 'author' order. cursor is None for the first page, or one of the
+    cursors from a Page of the same listing for the page before or after it.
+    The rows are those of query.
+
+    """
+    key, desc = sorts[order]
+    back = False
+    q = query.add_columns(key, Story.id)
+    if cursor is not None:
+        ck, csid, back = decode_cursor(cursor, order)
+        # paging back runs the listing in reverse from the cursor. This is
+        # (key, id) < (ck, csid) (or >), but written so that SQLite can seek
+        # to ck in the key's index, which it doesn't for row values.
+        if desc != back:
+            q = q.filter(and_(key <= ck, or_(key < ck, Story.id < csid)))
+        else:
+            q = q.filter(and_(key >= ck, or_(key > ck, Story.id > csid)))
+    if desc != back:
+        q = q.order_by(key.desc(), Story.id.desc())
+    else:
+        q = q.order_by(key, Story.id)
+    rows = q.limit(page_size + 1).all()
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if back:
+        rows.reverse()
+    if not rows:
+        return Page([], None, None)
+    first = encode_cursor(order, rows[0][-2], rows[0][-1], True)
+    last = encode_cursor(order, rows[-1][-2], rows[-1][-1], False)
+    # there's a page in the direction we came from if there was a cursor
+    has_prev = more if back else cursor is not None
+    has_next = cursor is not None if back else more
+    return Page([r[:-2] for r in rows], first if has_prev else None,
+                last if has_next else None)
+
+_totals: Dict[Any, Tuple[float, int]] = {}
+
+def cached_count(name: Any, query: Query, ttl: float = 300.0) -> int:
+    """Count the rows of query, reusing the count from a previous call with the
+    same name if it was made in the last ttl seconds. So the count may be a
+    little out of date. Counts older than ttl are dropped as new ones are
+    added, so the cache only holds the listings viewed lately.
+
+    """
+    now = time.monotonic()
+    c = _totals.get(name)
+    if c is not None and c[0] > now - ttl:
+        return c[1]
+    n = query.count()
+    # list() since other request threads may add counts meanwhile
+    for k, (t, _) in list(_totals.items()):
+        if t <= now - ttl:
+            _totals.pop(k, None)
+    _totals[name] = (now, n)
+    return n
+
+class AuthorEntry(NamedTuple):
+    id: int
+    name: str
+    stories: int
+    page: int
+
+class AuthorPages(object):
+    """The division of the author index into pages. Authors are listed by name,
+    and each page holds whole authors, closing once it has at least
+    page_size stories. entries has every author in the index in order, with
+    their story count and page number.
+
+    """
+    def __init__(self, entries: List[AuthorEntry]) -> None:
+        self.entries = entries
+        self.page_of = {e.id: e.page for e in entries}
+        self.last_page = entries[-1].page if entries else 0
+        self.pages: List[List[int]] = [[] for i in range(self.last_page + 1)]
+        for e in entries:
+            self.pages[e.page].append(e.id)
+
+    def authors_on(self, page: int) -> List[int]:
+        return self.pages[page] if 0 <= page <= self.last_page else []
+
+def author_index_query(ds: Any) -> Query:
+    """The authors in the index, in order, with their story counts."""
+    return (ds.query(Author.id, Author.name, func.count(Story.id)).
+            join(Story, Story.author_id == Author.id).
+            filter(Author.in_mirror == True).  # noqa: E712
+            group_by(Author.id).
+            order_by(func.lower(Author.name), Author.id))
+
+def make_author_pages(rows: Any, page_size: int) -> AuthorPages:
+    entries = []
+    page = 0
+    count = 0
+    for aid, name, stories in rows:
+        entries.append(AuthorEntry(aid, name, stories, page))
+        count += stories
+        if count >= page_size:
+            page += 1
+            count = 0
+    return AuthorPages(entries)
+
+_author_pages: Dict[int, Tuple[Any, AuthorPages]] = {}
+
+def author_pages(ds: Any, page_size: int) -> AuthorPages:
+    """Get the pages of the author index, from the last call if the mirror
+    hasn't changed since. Authors are only added to the index, and their
+    stories only change, when they're synced, so that's checked by the
+    number of authors in the index and the last time one was synced, which
+    is much cheaper than counting their stories again.
+
+    """
+    key = (ds.query(func.count(Author.id), func.max(Author.md_synced)).
+           filter(Author.in_mirror == True).one())  # noqa: E712
+    c = _author_pages.get(page_size)
+    if c is not None and c[0] == tuple(key):
+        return c[1]
+    rv = make_author_pages(author_index_query(ds), page_size)
+    _author_pages[page_size] = (tuple(key), rv)
+    return rv
@@ -11,7 +11,8 @@ queue.conf.update(
 
 @queue.task
 def download_fav(sid, rfn, dbg):
-    mirror = metadb.DBMirror(app.config['FF_DIR'], debug=dbg)
+    mirror = metadb.DBMirror(app.config['FF_DIR'], debug=dbg,
+                             profile=app.config['DB_PROFILE'])
     mirror.connect()
     so = mirror.ds.query(metadb.Story).filter_by(id=sid).one()
     mirror.story_to_archive(so, rfn=rfn,
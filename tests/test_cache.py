@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+import unittest, tempfile, os, time, re
+
+from ffmirror.cache import HTTPCache, hour, day
+
+class TestHTTPCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = HTTPCache(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_roundtrip(self):
+        data = b'<html>\xff\xfe not utf-8</html>' * 100
+        self.assertIsNone(self.cache.get('https://a/1'))
+        self.cache.put('https://a/1', data)
+        self.assertEqual(self.cache.get('https://a/1'), data)
+        self.assertEqual(self.cache.stats.hits, 1)
+        self.assertEqual(self.cache.stats.misses, 1)
+        self.assertEqual(self.cache.stats.stores, 1)
+
+    def test_sharded_compressed(self):
+        data = b'x' * 10000
+        self.cache.put('https://a/1', data)
+        fn = self.cache.entry_path('https://a/1')
+        rel = os.path.relpath(fn, self.tmpdir.name).split(os.sep)
+        self.assertEqual(len(rel), 3)
+        self.assertTrue(rel[2].startswith(rel[0] + rel[1]))
+        self.assertLess(os.stat(fn).st_size, len(data) // 10)
+
+    def test_ttl_classes(self):
+        self.assertEqual(
+            self.cache.ttl_for('https://archiveofourown.org/works/1/'
+                               'chapters/2'), 7 * day)
+        self.assertEqual(
+            self.cache.ttl_for('https://archiveofourown.org/users/x/works'),
+            1 * hour)
+        self.assertEqual(
+            self.cache.ttl_for('https://www.fanfiction.net/s/1/1/'),
+            12 * hour)
+        self.assertEqual(
+            self.cache.ttl_for('https://www.fanfiction.net/s/1/3/'),
+            7 * day)
+
+    def test_expiry(self):
+        c = HTTPCache(self.tmpdir.name, default_ttl=0.0,
+                      ttl_rules=[(re.compile('keep'), 60.0)])
+        c.put('https://a/keep', b'1')
+        c.put('https://a/drop', b'2')
+        time.sleep(0.01)
+        self.assertIsNone(c.get('https://a/drop'))
+        self.assertEqual(c.get('https://a/keep'), b'1')
+        self.assertEqual(c.prune(), 1)
+        self.assertEqual(c.get('https://a/keep'), b'1')
+
+    def test_prune_keeps_validated(self):
+        c = HTTPCache(self.tmpdir.name, default_ttl=0.0)
+        c.put('https://a/etag', b'1', {'etag': '"x"'})
+        c.put('https://a/lm', b'2',
+              {'last_modified': 'Mon, 02 Jan 2023 00:00:00 GMT'})
+        c.put('https://a/plain', b'3')
+        time.sleep(0.01)
+        self.assertEqual(c.prune(), 1)
+        # the stale entries with validators can still be revalidated
+        self.assertEqual(c.conditional_headers('https://a/etag'),
+                         {'If-None-Match': '"x"'})
+        self.assertEqual(c.revalidated('https://a/lm'), b'2')
+        self.assertIsNone(c.read_entry('https://a/plain'))
+
+    def test_lru_eviction(self):
+        data = os.urandom(1000)
+        c = HTTPCache(self.tmpdir.name, max_size=3500, low_water=0.7)
+        for n in range(3):
+            c.put(f'https://a/{n}', data)
+            os.utime(c.entry_path(f'https://a/{n}'), (n, n))
+        # touch entry 0, making 1 the least recently used
+        c.get('https://a/0')
+        c.put('https://a/3', data)
+        self.assertLessEqual(c.size(), 2450)
+        self.assertEqual(c.stats.evictions, 2)
+        self.assertIsNotNone(c.get('https://a/0'))
+        self.assertIsNone(c.get('https://a/1'))
+        self.assertIsNotNone(c.get('https://a/3'))
@@ -0,0 +1,549 @@
+#!/usr/bin/python
+
+import unittest, tempfile, datetime, re, threading, time
+from pathlib import Path
+
+from ffmirror import metadb
+from ffmirror.core import DownloadModule, StoryInfo, AuthorInfo, ChapterInfo
+
+utc = datetime.timezone.utc
+
+class FakeSite(DownloadModule):
+    """A site module serving stories out of a dict, for testing the mirror
+    without network access."""
+    this_site = 'fakesite'
+    hostname = 'fake.example'
+    url_re = re.compile(r"^https://fake\.example/")
+    story_url_re = re.compile(r"https://fake\.example/s/(?P<sid>\d+)")
+    user_url_re = re.compile(r"https://fake\.example/u/(?P<aid>\d+)")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.stories = {}
+        self.lists = {}
+        self.fetched = []
+        self.fail_on = None
+        self.fetch_delay = 0.0
+        self.list_delay = 0.0
+        self.list_spans = []
+        self.lock = threading.Lock()
+
+    def get_user_url(self, auth):
+        return f"https://fake.example/u/{auth.id}"
+
+    def get_story_url(self, story):
+        return f"https://fake.example/s/{story.id}"
+
+    def download_metadata(self, sid):
+        md, chapters = self.stories[sid]
+        toc = [ChapterInfo(title=t, url=f"https://fake.example/s/{sid}/{n}")
+               for n, (t, text) in enumerate(chapters)]
+        return md, toc
+
+    def fetch_chapter(self, chapter):
+        time.sleep(self.fetch_delay)
+        with self.lock:
+            self.fetched.append(chapter.url)
+        if chapter.url == self.fail_on:
+            raise ValueError("fetch failed")
+        sid, n = chapter.url.rsplit('/', 2)[1:]
+        return "<page>" + self.stories[sid][1][int(n)][1] + "</page>"
+
+    def extract_chapter(self, page):
+        return page[len("<page>"):-len("</page>")]
+
+    def download_chapter(self, chapter):
+        return self.extract_chapter(self.fetch_chapter(chapter))
+
+    def download_list(self, aid):
+        start = time.monotonic()
+        time.sleep(self.list_delay)
+        with self.lock:
+            self.list_spans.append((start, time.monotonic()))
+        return self.lists[aid]
+
+class OtherSite(FakeSite):
+    """The fake site again, on another host and so another fetch queue."""
+    this_site = 'othersite'
+    hostname = 'other.example'
+    url_re = re.compile(r"^https://other\.example/")
+
+fake_site = metadb.site_modules['fakesite']
+other_site = metadb.site_modules['othersite']
+
+def make_story(sid, author, title=None, chapters=1, words=1000, tags=None,
+               updated=None):
+    when = updated or datetime.datetime(2020, 1, 1, tzinfo=utc)
+    return StoryInfo(
+        title=title or f"Story {sid}", summary='', category='cat', id=sid,
+        reviews=0, chapters=chapters, words=words, characters='',
+        source='authored', author=author, genre='', site='fakesite',
+        updated=when, published=when, complete=False, story_url='',
+        tags=set(tags or []))
+
+class MirrorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        fake_site.reset()
+        self.mirror = metadb.DBMirror(self.tmpdir.name)
+        self.mirror.connect()
+        self.mirror.create()
+        self.author = AuthorInfo(name='Writer', id='1', url='',
+                                 site='fakesite')
+
+    def tearDown(self):
+        self.mirror.close()
+        self.tmpdir.cleanup()
+
+    def count_statements(self, f):
+        from sqlalchemy import event
+        statements = []
+
+        def before(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.mirror.engine, 'before_cursor_execute', before)
+        try:
+            f()
+        finally:
+            event.remove(self.mirror.engine, 'before_cursor_execute', before)
+        return statements
+
+    def race(self, other, statement, f):
+        """Run f, then commit other's session, just before this mirror next
+        runs statement."""
+        from sqlalchemy import event
+
+        done = []
+
+        def before(conn, cursor, st, *args):
+            if st.startswith(statement) and not done:
+                done.append(st)
+                f()
+                other.ds.commit()
+        event.listen(self.mirror.engine, 'before_cursor_execute', before)
+
+    def other_mirror(self):
+        """Another mirror on the same database, with its own engine."""
+        other = metadb.DBMirror(self.tmpdir.name)
+        other.connect()
+        self.addCleanup(other.close)
+        return other
+
+    def add_story(self, sid, chapters, **kwargs):
+        md = make_story(sid, self.author, chapters=len(chapters), **kwargs)
+        fake_site.stories[sid] = (md, chapters)
+        ao = self.mirror.get_author('fakesite', '1')
+        if ao is None:
+            ao = metadb.Author(name='Writer', archive='fakesite', site_id='1')
+            self.mirror.ds.add(ao)
+        so = self.mirror._story_from_md(md, ao)
+        self.mirror.ds.commit()
+        return so
+
+class TestStoryToArchive(MirrorTestCase):
+    def chapter_files(self, so):
+        d = Path(self.mirror.mdir) / so.download_fn
+        return [p.read_text() for p in sorted(d.iterdir())]
+
+    def test_archive(self):
+        chapters = [(f"Ch {n}", f"text {n}") for n in range(5)]
+        so = self.add_story('10', chapters)
+        self.mirror.story_to_archive(so)
+        self.assertEqual(self.chapter_files(so), [t for c, t in chapters])
+        self.assertEqual([c.title for c in so.all_chapters],
+                         [c for c, t in chapters])
+        self.assertIsNotNone(so.download_time)
+
+    def test_inflight(self):
+        chapters = [(f"Ch {n}", f"text {n}") for n in range(8)]
+        so = self.add_story('11', chapters)
+        fake_site.fetch_delay = 0.05
+        start = time.time()
+        self.mirror.story_to_archive(so, max_inflight=4)
+        self.assertLess(time.time() - start, 0.3)
+        self.assertEqual(self.chapter_files(so), [t for c, t in chapters])
+
+    def test_failure(self):
+        chapters = [(f"Ch {n}", f"text {n}") for n in range(20)]
+        so = self.add_story('12', chapters)
+        fake_site.fetch_delay = 0.01
+        fake_site.fail_on = 'https://fake.example/s/12/2'
+        with self.assertRaises(ValueError):
+            self.mirror.story_to_archive(so)
+        self.mirror.ds.rollback()
+        self.assertIsNone(so.download_time)
+        # the chapters before the failure were kept, but the story isn't
+        # marked present until it's whole
+        self.assertIsNone(so.download_fn)
+        self.assertTrue(so.all_chapters[0].fetched_at)
+        # the remaining fetches were cancelled
+        self.assertLess(len(fake_site.fetched), 20)
+
+class TestIncrementalArchive(MirrorTestCase):
+    def chapter_dir(self, so):
+        return Path(self.mirror.mdir) / so.download_fn
+
+    def test_append(self):
+        chapters = [(f"Ch {n}", f"text {n}") for n in range(10)]
+        so = self.add_story('20', chapters)
+        self.mirror.story_to_archive(so)
+        fake_site.fetched.clear()
+        chapters.append(("Ch 10", "text 10"))
+        so = self.add_story('20', chapters)
+        self.mirror.story_to_archive(so)
+        self.assertEqual(fake_site.fetched, ['https://fake.example/s/20/10'])
+        self.assertEqual(len(so.all_chapters), 11)
+        self.assertTrue(all(c.hash is not None for c in so.all_chapters))
+
+    def test_resume(self):
+        chapters = [(f"Ch {n}", f"text {n}") for n in range(6)]
+        so = self.add_story('21', chapters)
+        fake_site.fail_on = 'https://fake.example/s/21/3'
+        with self.assertRaises(ValueError):
+            self.mirror.story_to_archive(so)
+        self.mirror.ds.rollback()
+        self.assertEqual([c.fetched_at is not None for c in so.all_chapters],
+                         [True] * 3 + [False] * 3)
+        fake_site.fail_on = None
+        fake_site.fetched.clear()
+        self.mirror.story_to_archive(so)
+        self.assertEqual(fake_site.fetched,
+                         [f'https://fake.example/s/21/{n}' for n in (3, 4, 5)])
+        self.assertIsNotNone(so.download_time)
+
+    def test_damaged(self):
+        chapters = [(f"Ch {n}", f"text {n}") for n in range(3)]
+        so = self.add_story('22', chapters)
+        self.mirror.story_to_archive(so)
+        (self.chapter_dir(so) / '0001.html').write_text('tex')
+        fake_site.fetched.clear()
+        self.mirror.story_to_archive(so)
+        self.assertEqual(fake_site.fetched, ['https://fake.example/s/22/1'])
+        self.assertEqual((self.chapter_dir(so) / '0001.html').read_text(),
+                         'text 1')
+
+    def test_edit(self):
+        # an update with no new chapters means one was edited; only the
+        # edited one is rewritten
+        chapters = [(f"Ch {n}", f"text {n}") for n in range(3)]
+        so = self.add_story('24', chapters)
+        self.mirror.story_to_archive(so)
+        mtime = (self.chapter_dir(so) / '0001.html').stat().st_mtime_ns
+        chapters[0] = ("Ch 0", "edited 0")
+        so = self.add_story('24', chapters,
+                            updated=datetime.datetime.now(tz=utc))
+        fake_site.fetched.clear()
+        self.mirror.story_to_archive(so)
+        self.assertEqual(len(fake_site.fetched), 3)
+        self.assertEqual((self.chapter_dir(so) / '0000.html').read_text(),
+                         'edited 0')
+        self.assertEqual(
+            (self.chapter_dir(so) / '0001.html').stat().st_mtime_ns, mtime)
+        # and once it's downloaded, it's up to date
+        fake_site.fetched.clear()
+        self.mirror.story_to_archive(so)
+        self.assertEqual(fake_site.fetched, [])
+
+    def test_append_updated(self):
+        chapters = [(f"Ch {n}", f"text {n}") for n in range(4)]
+        so = self.add_story('25', chapters)
+        self.mirror.story_to_archive(so)
+        chapters[3] = ("Ch 3", "text 3, with a note")
+        chapters.append(("Ch 4", "text 4"))
+        so = self.add_story('25', chapters,
+                            updated=datetime.datetime.now(tz=utc))
+        fake_site.fetched.clear()
+        self.mirror.story_to_archive(so)
+        self.assertEqual(fake_site.fetched,
+                         [f'https://fake.example/s/25/{n}' for n in (3, 4)])
+        self.assertEqual((self.chapter_dir(so) / '0003.html').read_text(),
+                         'text 3, with a note')
+
+    def test_shrink(self):
+        chapters = [(f"Ch {n}", f"text {n}") for n in range(4)]
+        so = self.add_story('23', chapters)
+        self.mirror.story_to_archive(so)
+        so = self.add_story('23', chapters[:2])
+        self.mirror.story_to_archive(so)
+        self.assertEqual(len(so.all_chapters), 2)
+        self.assertEqual(sorted(p.name for p in self.chapter_dir(so).iterdir()),
+                         ['0000.html', '0001.html'])
+        self.assertEqual(self.mirror.ds.query(metadb.Chapter).count(), 2)
+
+class TestSyncAuthor(MirrorTestCase):
+    def listing(self, n_auth, n_fav, words=1000):
+        other = AuthorInfo(name='Other', id='2', url='', site='fakesite')
+        auth = [make_story(str(100 + i), self.author, words=words)
+                for i in range(n_auth)]
+        fav = [make_story(str(200 + i), other, words=words)
+               for i in range(n_fav)]
+        for s in fav:
+            s.source = 'favorites'
+        return auth, fav, self.author
+
+    def test_sync(self):
+        fake_site.lists['1'] = self.listing(3, 5)
+        self.mirror.sync_author(('fakesite', '1'), batch_size=2)
+        ao = self.mirror.get_author('fakesite', '1')
+        self.assertIsNotNone(ao.md_synced)
+        self.assertEqual(len(ao.stories_written), 3)
+        self.assertEqual(sorted(s.site_id for s in ao.fav_stories),
+                         [str(200 + i) for i in range(5)])
+        self.assertEqual(self.mirror.get_author('fakesite', '2').name, 'Other')
+
+        fake_site.lists['1'] = self.listing(3, 6, words=2000)
+        self.mirror.sync_author(ao, batch_size=4)
+        self.assertEqual(len(ao.fav_stories), 6)
+        self.assertEqual(self.mirror.get_story('fakesite', '100').words, 2000)
+        self.assertEqual(self.mirror.ds.query(metadb.Story).count(), 9)
+
+    def test_statement_count(self):
+        def sync(aid, n):
+            author = AuthorInfo(name=f"Writer {aid}", id=aid, url='',
+                                site='fakesite')
+            auth = [make_story(f"{aid}-a{i}", author) for i in range(n)]
+            fav = []
+            for i in range(n):
+                fa = AuthorInfo(name=f"Fav {aid}-{i}", id=f"{aid}-{i}",
+                                url='', site='fakesite')
+                s = make_story(f"{aid}-f{i}", fa,
+                               tags={f"tag {aid}-{i}", 'common'})
+                s.source = 'favorites'
+                fav.append(s)
+            fake_site.lists[aid] = (auth, fav, author)
+            return len(self.count_statements(
+                lambda: self.mirror.sync_author(('fakesite', aid))))
+        # a sync takes the same number of statements however long the
+        # listing, as long as it fits in one batch
+        self.assertEqual(sync('5', 5), sync('6', 50))
+        ao = self.mirror.get_author('fakesite', '6')
+        self.assertEqual(len(ao.fav_stories), 50)
+        self.assertEqual(len(ao.stories_written), 50)
+        self.assertEqual(self.mirror.ds.query(metadb.Author).count(), 57)
+        self.assertEqual(
+            sorted(t.name for t in self.mirror.get_story('fakesite',
+                                                         '6-f7').tags),
+            ['common', 'tag 6-7'])
+
+    def test_is_known(self):
+        auth, fav, info = self.listing(5, 0)
+        checks = []
+
+        def iter_list(aid, is_known=None):
+            checks.append(is_known)
+            return info, iter(auth)
+        fake_site.iter_list = iter_list
+        try:
+            self.mirror.sync_author(('fakesite', '1'))
+        finally:
+            del fake_site.iter_list
+        is_known, = checks
+        # a page of stories is checked with one query
+        rv = []
+        self.assertEqual(len(self.count_statements(
+            lambda: rv.append(is_known(auth)))), 1)
+        self.assertEqual(rv, [True])
+        changed = make_story('102', self.author, words=2000)
+        self.assertFalse(is_known(auth[:2] + [changed]))
+        self.assertFalse(is_known(auth + [make_story('999', self.author)]))
+
+    def test_partial(self):
+        auth, fav, info = self.listing(2, 5)
+
+        def entries():
+            yield from auth + fav
+            raise ValueError("listing failed")
+        fake_site.iter_list = lambda aid, is_known=None: (info, entries())
+        try:
+            with self.assertRaises(ValueError):
+                self.mirror.sync_author(('fakesite', '1'), batch_size=3)
+        finally:
+            del fake_site.iter_list
+        # the complete batches were kept, but the author isn't marked synced
+        ao = self.mirror.get_author('fakesite', '1')
+        self.assertIsNone(ao.md_synced)
+        self.assertEqual(self.mirror.ds.query(metadb.Story).count(), 6)
+
+    def test_author_race(self):
+        # another session adds the author of a new favorite between this
+        # one's lookup and its insert
+        self.mirror.ds.add(
+            metadb.Author(name='Writer', archive='fakesite', site_id='1'))
+        self.mirror.ds.commit()
+        other = self.other_mirror()
+        self.race(other, 'INSERT OR IGNORE INTO author', lambda: other.ds.add(
+            metadb.Author(name='Other', archive='fakesite', site_id='2')))
+        fake_site.lists['1'] = self.listing(1, 2)
+        self.mirror.sync_author(('fakesite', '1'))
+        ao = self.mirror.get_author('fakesite', '2')
+        self.assertEqual(len(ao.stories_written), 2)
+        self.assertEqual(self.mirror.ds.query(metadb.Author).count(), 2)
+
+class TestTags(MirrorTestCase):
+    def tag_names(self, so):
+        return sorted(t.name for t in so.tags)
+
+    def test_tags(self):
+        so = self.add_story('30', [('Ch', 'text')], tags=['a', 'b'])
+        self.assertEqual(self.tag_names(so), ['a', 'b'])
+        md = make_story('30', self.author, tags=['b', 'c', 'd'])
+        self.mirror._handle_tags_for(md, so)
+        self.mirror.ds.commit()
+        # tags are only ever added
+        self.assertEqual(self.tag_names(so), ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.mirror.ds.query(metadb.Tag).count(), 4)
+        self.assertEqual(self.mirror.ds.query(metadb.story_tags_table).count(),
+                         4)
+
+    def test_statement_count(self):
+        # a popular tag with many stories costs no more than a new one
+        for i in range(50):
+            self.add_story(str(300 + i), [('Ch', 'text')], tags=['popular'])
+        so = self.add_story('400', [('Ch', 'text')])
+        md = make_story('400', self.author,
+                        tags=['popular'] + [f"t{i}" for i in range(20)])
+        so.id  # load the story, which commit expired
+        stmts = self.count_statements(
+            lambda: self.mirror._handle_tags_for(md, so))
+        self.assertLessEqual(len(stmts), 4)
+        self.mirror.ds.commit()
+        self.assertEqual(len(so.tags), 21)
+        self.assertEqual(len(self.mirror.ds.query(metadb.Tag).
+                             filter_by(name='popular').one().stories), 51)
+
+    def test_tag_race(self):
+        # another session creates a tag between this one's lookup and its
+        # insert, as when two update queues sync stories with a new tag
+        self.add_story('30', [('Ch', 'text')])
+        other = self.other_mirror()
+        so = other.ds.query(metadb.Story).one()
+        self.race(other, 'INSERT OR IGNORE INTO tag',
+                  lambda: other._link_tags({so.id: {'new'}}))
+        so = self.mirror.get_story('fakesite', '30')
+        self.mirror._link_tags({so.id: {'new', 'newer'}})
+        self.mirror.ds.commit()
+        self.assertEqual(self.tag_names(so), ['new', 'newer'])
+
+class TestRunUpdate(MirrorTestCase):
+    def setUp(self):
+        super().setUp()
+        other_site.reset()
+        for n, site in enumerate((fake_site, other_site)):
+            author = AuthorInfo(name=f"Writer {site.this_site}", id='1',
+                                url='', site=site.this_site)
+            md = make_story('100', author, tags=['shared'])
+            md.site = site.this_site
+            site.stories['100'] = (md, [('Ch', 'text')])
+            site.lists['1'] = ([md], [], author)
+            site.list_delay = 0.3
+            # fakesite's queue is the least recently synced, so it runs on
+            # the calling thread and othersite's in a worker
+            self.mirror.ds.add(metadb.Author(
+                name=author.name, archive=site.this_site, site_id='1',
+                in_mirror=True,
+                md_synced=datetime.datetime(2020 + n, 1, 1, tzinfo=utc)))
+        self.mirror.ds.commit()
+
+    def test_concurrent(self):
+        calls = []
+        active = []
+        overlaps = []
+
+        def progress(st):
+            if active:
+                overlaps.append(st)
+            active.append(st)
+            time.sleep(0.01)
+            active.remove(st)
+            calls.append(st)
+        self.mirror.run_update(progress=progress)
+        self.assertEqual(overlaps, [])
+        self.assertEqual({st.queue for st in calls},
+                         {'fake.example', 'other.example'})
+        (s1, e1), = fake_site.list_spans
+        (s2, e2), = other_site.list_spans
+        self.assertLess(max(s1, s2), min(e1, e2))
+        for site in ('fakesite', 'othersite'):
+            so = self.mirror.get_story(site, '100')
+            self.assertIsNotNone(so.download_time)
+            self.assertEqual([t.name for t in so.tags], ['shared'])
+        self.assertEqual(self.mirror.ds.query(metadb.Tag).count(), 1)
+
+    def test_worker_exception(self):
+        def progress(st):
+            if st.type == 'author' and st.name == 'Writer othersite':
+                raise RuntimeError("progress failed")
+        with self.assertRaisesRegex(RuntimeError, "progress failed"):
+            self.mirror.run_update(progress=progress)
+        # the other queue still ran to the end
+        self.assertGreater(
+            self.mirror.get_author('fakesite', '1').md_synced.year, 2020)
+        self.assertEqual(other_site.list_spans, [])
+
+class TestSchema(MirrorTestCase):
+    def test_unique_keys(self):
+        from sqlalchemy.exc import IntegrityError
+        self.add_story('40', [('Ch', 'text')])
+        ds = self.mirror.ds
+        ao = self.mirror.get_author('fakesite', '1')
+        for o in [metadb.Story(title='Dup', archive='fakesite', site_id='40',
+                               author=ao),
+                  metadb.Author(name='Dup', archive='fakesite', site_id='1')]:
+            ds.add(o)
+            with self.assertRaises(IntegrityError):
+                ds.flush()
+            ds.rollback()
+        # the same site ID on another archive is a different story
+        ds.add(metadb.Story(title='Other', archive='othersite', site_id='40',
+                            author=ao))
+        ds.commit()
+
+    def test_lookups_use_indexes(self):
+        from sqlalchemy import text
+        plan = self.mirror.ds.execute(text(
+            "explain query plan select id from story "
+            "where archive = 'fakesite' and site_id = '40'")).fetchall()
+        self.assertIn('ix_story_archive_site_id', str(plan))
+
+class TestProfiles(MirrorTestCase):
+    def pragma(self, m, name):
+        return m.ds.execute(metadb.text(f"pragma {name}")).scalar()
+
+    def test_profiles(self):
+        self.assertEqual(self.pragma(self.mirror, 'journal_mode'), 'wal')
+        self.mirror.close()
+        m = metadb.DBMirror(self.tmpdir.name, profile='compat')
+        m.connect()
+        self.assertEqual(self.pragma(m, 'journal_mode'), 'delete')
+        self.assertEqual(self.pragma(m, 'mmap_size'), 0)
+        m.close()
+        with self.assertRaises(ValueError):
+            metadb.DBMirror(self.tmpdir.name, profile='fast')
+        with self.assertRaises(ValueError):
+            metadb.set_db_profile('fast')
+
+    def test_read_during_write(self):
+        import sqlite3
+        from sqlalchemy.exc import OperationalError
+        self.add_story('50', [('Ch', 'text')])
+        self.mirror.close()
+        for profile, blocked in [('wal', False), ('compat', True)]:
+            reader = metadb.DBMirror(self.tmpdir.name, profile=profile)
+            reader.connect()
+            reader.ds.execute(metadb.text("pragma busy_timeout = 0"))
+            writer = sqlite3.connect(reader.db_file, isolation_level=None)
+            writer.execute("begin exclusive")
+            writer.execute("update story set title = 'Changed'")
+            # while the writer's transaction is open, a reader sees the last
+            # committed state in WAL mode, but is locked out otherwise
+            if blocked:
+                with self.assertRaises(OperationalError):
+                    reader.get_story('fakesite', '50')
+            else:
+                self.assertEqual(reader.get_story('fakesite', '50').title,
+                                 'Story 50')
+            writer.execute("rollback")
+            writer.close()
+            reader.close()
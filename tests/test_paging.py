@@ -0,0 +1,158 @@
+import unittest, tempfile, datetime, random, time
+
+from ffmirror import metadb
+from ffmirror.webview import paging
+
+utc = datetime.timezone.utc
+
+class TestKeysetPaging(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.mirror = metadb.DBMirror(self.tmpdir.name)
+        self.mirror.connect()
+        self.mirror.create()
+        ds = self.mirror.ds
+        r = random.Random(1)
+        authors = [metadb.Author(name=f"Author {i % 4}", archive='ffnet',
+                                 site_id=str(i), in_mirror=i != 5)
+                   for i in range(8)]
+        ds.add_all(authors)
+        base = datetime.datetime(2020, 1, 1, tzinfo=utc)
+        for i in range(95):
+            # plenty of ties and some NULLs in every sort key
+            ds.add(metadb.Story(
+                title=None if i % 17 == 0 else f"Story {r.randrange(30)}",
+                archive='ffnet', site_id=str(i), author=authors[i % 8],
+                words=None if i % 13 == 0 else r.randrange(10) * 1000,
+                category=None if i % 11 == 0 else f"Cat {r.randrange(3)}",
+                updated=(None if i % 19 == 0 else
+                         base + datetime.timedelta(days=r.randrange(20)))))
+        ds.commit()
+        self.query = (ds.query(metadb.Story, metadb.Author).
+                      filter(metadb.Story.author_id == metadb.Author.id).
+                      filter(metadb.Author.in_mirror == True))  # noqa: E712
+
+    def tearDown(self):
+        self.mirror.close()
+        self.tmpdir.cleanup()
+
+    def expected(self, order):
+        key, desc = paging.sorts[order]
+        rows = self.query.add_columns(key).all()
+        return [r[0].id for r in
+                sorted(rows, key=lambda r: (r[2], r[0].id), reverse=desc)]
+
+    def test_walk(self):
+        for order in paging.sorts:
+            with self.subTest(order=order):
+                pages = []
+                cursor = None
+                while True:
+                    p = paging.keyset_page(self.query, order, cursor, 10)
+                    pages.append([s.id for s, a in p.rows])
+                    self.assertEqual(p.prev_cursor is None, cursor is None)
+                    if p.next_cursor is None:
+                        break
+                    cursor = p.next_cursor
+                self.assertEqual(sum(pages, []), self.expected(order))
+                self.assertEqual(len(pages), 9)
+                if order == 'words':
+                    # unknown word counts come last
+                    ids = sum(pages, [])
+                    so = self.mirror.ds.query(metadb.Story).get(ids[-1])
+                    self.assertIsNone(so.words)
+                # and back again
+                cursor = p.prev_cursor
+                for expected in reversed(pages[:-1]):
+                    p = paging.keyset_page(self.query, order, cursor, 10)
+                    self.assertEqual([s.id for s, a in p.rows], expected)
+                    self.assertIsNotNone(p.next_cursor)
+                    cursor = p.prev_cursor
+                self.assertIsNone(cursor)
+
+    def test_bad_cursor(self):
+        p = paging.keyset_page(self.query, 'words', None, 10)
+        with self.assertRaises(ValueError):
+            paging.keyset_page(self.query, 'title', p.next_cursor, 10)
+        with self.assertRaises(ValueError):
+            paging.keyset_page(self.query, 'words', 'garbage', 10)
+
+    def test_cached_count(self):
+        self.assertEqual(paging.cached_count('test', self.query), 83)
+        self.mirror.ds.query(metadb.Story).filter_by(site_id='0').delete()
+        self.assertEqual(paging.cached_count('test', self.query), 83)
+        self.assertEqual(paging.cached_count('test', self.query, ttl=0), 82)
+
+    def test_cached_count_expiry(self):
+        paging.cached_count('old', self.query)
+        paging._totals['old'] = (time.monotonic() - 600, 83)
+        paging.cached_count('new', self.query)
+        self.assertNotIn('old', paging._totals)
+        self.assertIn('new', paging._totals)
+
+    def test_sort_indexes(self):
+        for order in metadb.story_sort_keys:
+            key, desc = paging.sorts[order]
+            q = (self.query.add_columns(key).order_by(key, metadb.Story.id).
+                 limit(10))
+            sql = str(q.statement.compile(
+                compile_kwargs={'literal_binds': True}))
+            plan = self.mirror.ds.execute(
+                metadb.text("explain query plan " + sql)).fetchall()
+            with self.subTest(order=order):
+                self.assertIn(f"ix_story_{order}_key", str(plan))
+                self.assertNotIn("TEMP B-TREE", str(plan))
+
+class TestAuthorPages(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.mirror = metadb.DBMirror(self.tmpdir.name)
+        self.mirror.connect()
+        self.mirror.create()
+        self.counts = [3, 1, 4, 1, 5, 9, 2, 6, 5, 3]
+        for i, n in enumerate(self.counts):
+            self.add_author(f"{'ab'[i % 2]}uthor {i}", i, n)
+        # not in the index
+        self.add_author('Other', 99, 3, in_mirror=False)
+        self.mirror.ds.commit()
+
+    def tearDown(self):
+        self.mirror.close()
+        self.tmpdir.cleanup()
+
+    def add_author(self, name, aid, n, in_mirror=True):
+        ao = metadb.Author(name=name, archive='ffnet', site_id=str(aid),
+                           in_mirror=in_mirror,
+                           md_synced=datetime.datetime.now(tz=utc))
+        for j in range(n):
+            ao.stories_written.append(metadb.Story(
+                title='Story', archive='ffnet', site_id=f"{aid}-{j}"))
+        self.mirror.ds.add(ao)
+        return ao
+
+    def test_pages(self):
+        ap = paging.author_pages(self.mirror.ds, 8)
+        names = [e.name for e in ap.entries]
+        self.assertEqual(names, sorted(names, key=str.lower))
+        self.assertNotIn('Other', names)
+        # every page but the last has at least 8 stories, and would have
+        # had fewer than 8 without its last author
+        for p in range(ap.last_page + 1):
+            counts = [e.stories for e in ap.entries if e.page == p]
+            self.assertEqual(len(ap.authors_on(p)), len(counts))
+            if p < ap.last_page:
+                self.assertGreaterEqual(sum(counts), 8)
+                self.assertLess(sum(counts[:-1]), 8)
+        self.assertEqual(sum(e.stories for e in ap.entries),
+                         sum(self.counts))
+        self.assertEqual(ap.authors_on(ap.last_page + 1), [])
+        for e in ap.entries:
+            self.assertEqual(ap.page_of[e.id], e.page)
+
+    def test_cache(self):
+        ap = paging.author_pages(self.mirror.ds, 5)
+        self.assertIs(paging.author_pages(self.mirror.ds, 5), ap)
+        self.add_author('New', 50, 2)
+        self.mirror.ds.commit()
+        ap2 = paging.author_pages(self.mirror.ds, 5)
+        self.assertEqual(len(ap2.entries), len(ap.entries) + 1)
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+# Regression corpus for the HTML parser backends: every site module parser must
+# extract the same metadata from the pages in tests/data whichever backend
+# parses them.
+
+import unittest, unittest.mock
+from pathlib import Path
+
+from ffmirror import util
+from ffmirror.handlers.ffnet import FFNet
+from ffmirror.handlers.ao3 import AO3
+
+data_dir = Path(__file__).parent / 'data'
+
+def read_page(name):
+    return (data_dir / name).read_text()
+
+class FakePageFetcher:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def get_html(self, url):
+        return read_page(self.pages[url])
+
+def parse_ffnet():
+    mod = FFNet()
+    mod._fetcher = FakePageFetcher({
+        'https://www.fanfiction.net/s/11280068/1/': 'ffnet_story.html',
+        'https://www.fanfiction.net/s/6800000/1/': 'ffnet_oneshot.html',
+        'https://www.fanfiction.net/u/5244847/': 'ffnet_user.html',
+    })
+    return (mod.download_metadata('11280068'),
+            mod.download_metadata('6800000'),
+            mod.download_list('5244847'))
+
+ao3_pages = {
+    'https://archiveofourown.org/users/someone/works': 'ao3_works.html',
+    'https://archiveofourown.org/users/someone/works?page=2':
+    'ao3_works_2.html',
+    'https://archiveofourown.org/users/someone/bookmarks':
+    'ao3_works_2.html',
+}
+
+def fake_urlopen_many(fetched):
+    def urlopen_many(urls, fetcher=None):
+        fetched.extend(urls)
+        return [util.FakeRequest(read_page(ao3_pages[u]).encode())
+                for u in urls]
+    return urlopen_many
+
+def parse_ao3(is_known=None, fetched=None):
+    fetched = fetched if fetched is not None else []
+    with unittest.mock.patch('ffmirror.handlers.ao3.urlopen_many',
+                             fake_urlopen_many(fetched)):
+        return AO3().download_list('someone', is_known)
+
+class TestParserBackends(unittest.TestCase):
+    def setUp(self):
+        self.saved_parser = util.html_parser
+
+    def tearDown(self):
+        util.html_parser = self.saved_parser
+
+    def parse_all(self, fn):
+        rv = {}
+        for p in util.available_parsers():
+            util.set_html_parser(p)
+            rv[p] = fn()
+        return rv
+
+    def check_same(self, results):
+        ref_name, ref = next(iter(results.items()))
+        for name, r in results.items():
+            with self.subTest(parser=name):
+                self.assertEqual(r, ref, f"{name} differs from {ref_name}")
+
+    def test_ffnet(self):
+        results = self.parse_all(parse_ffnet)
+        self.check_same(results)
+        (md, toc), (omd, otoc), (auth, fav, info) = next(
+            iter(results.values()))
+        self.assertEqual(md.title, 'The Brightest Witch & the Darkest House')
+        self.assertEqual(md.author.id, '5244847')
+        self.assertEqual((md.chapters, md.words, md.reviews), (3, 12345, 1234))
+        self.assertEqual(md.characters, 'Harry P., Hermione G.')
+        self.assertTrue(md.complete)
+        self.assertEqual([c.title for c in toc],
+                         ['Beginnings', 'Knives & Forks', 'The End'])
+        self.assertEqual((omd.chapters, omd.words), (1, 1024))
+        self.assertEqual(len(otoc), 1)
+        self.assertEqual(info.name, 'Belial666')
+        self.assertEqual([s.id for s in auth], ['11280068', '12000000'])
+        self.assertEqual(auth[1].title, "Ninja Wizard's Gambit")
+        self.assertEqual(auth[1].tags, {'harry potter', 'naruto'})
+        self.assertEqual([(s.id, s.author.id) for s in fav],
+                         [('9000001', '777')])
+
+    def test_ao3(self):
+        results = self.parse_all(parse_ao3)
+        self.check_same(results)
+        auth, fav, info = next(iter(results.values()))
+        self.assertEqual(info.name, 'someone')
+        self.assertEqual([i.id for i in auth], ['12345', '67890', '24680'])
+        self.assertEqual([i.id for i in fav], ['24680'])
+        first = auth[0]
+        self.assertEqual(first.words, 45678)
+        self.assertEqual(first.reviews, 300)
+        self.assertIn('rating: teen and up audiences', first.tags)
+        self.assertIn('Alternate Universe', first.tags)
+        self.assertFalse(auth[1].complete)
+
+    def test_ao3_known(self):
+        fetched = []
+        auth, fav, info = parse_ao3(lambda page: True, fetched)
+        # the works listing stopped after its first page
+        self.assertEqual([i.id for i in auth], ['12345', '67890'])
+        self.assertEqual([i.id for i in fav], ['24680'])
+        self.assertNotIn(
+            'https://archiveofourown.org/users/someone/works?page=2', fetched)
+
+    def test_ao3_fetcher_closed(self):
+        closed = []
+
+        class Fetcher(util.AsyncFetcher):
+            def close(self):
+                closed.append(self)
+                super().close()
+        with unittest.mock.patch('ffmirror.handlers.ao3.AsyncFetcher',
+                                 Fetcher):
+            parse_ao3()
+            self.assertEqual(len(closed), 1)
+            # a listing abandoned partway also lets its threads go
+            with unittest.mock.patch('ffmirror.handlers.ao3.urlopen_many',
+                                     fake_urlopen_many([])):
+                info, entries = AO3().iter_list('someone')
+                next(entries)
+                entries.close()
+            self.assertEqual(len(closed), 2)
+        self.assertTrue(all(f.executor._shutdown for f in closed))
+
+    def test_set_parser(self):
+        with self.assertRaises(ValueError):
+            util.set_html_parser('no-such-parser')
+
+class TestStorytext(unittest.TestCase):
+    def test_extract(self):
+        mod = FFNet()
+        self.assertEqual(mod._get_storytext(read_page('ffnet_story.html')),
+                         "<p>It was a dark and stormy night.</p>"
+                         "<p>The end.</p>\n")
+        self.assertEqual(mod._get_storytext(
+            "<div id=\"storytext\" class='x'>text</div><div>more</div>"),
+            "text")
+        with self.assertRaises(Exception):
+            mod._get_storytext("<div id='other'>text</div>")
+        with self.assertRaises(Exception):
+            mod._get_storytext("<div id='storytext'>text")
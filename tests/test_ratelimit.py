@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+import unittest, tempfile, os, datetime, email.utils
+
+from ffmirror import ratelimit
+from ffmirror.ratelimit import (RateLimiter, TokenBucketLimiter,
+                                AdaptiveController, parse_retry_after)
+
+class TestRateLimiter(unittest.TestCase):
+    def test_reserve_spacing(self):
+        rl = RateLimiter(delay=10.0)
+        self.assertLessEqual(rl.reserve('a'), 0.0)
+        self.assertAlmostEqual(rl.reserve('a'), 10.0, places=1)
+        self.assertAlmostEqual(rl.reserve('a'), 20.0, places=1)
+
+    def test_hosts_independent(self):
+        rl = RateLimiter(delay=10.0)
+        rl.reserve('a')
+        self.assertLessEqual(rl.reserve('b'), 0.0)
+
+class TestTokenBucketLimiter(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'rl.sqlite')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_burst(self):
+        rl = TokenBucketLimiter(self.path, rate=0.1, burst=3)
+        for i in range(3):
+            self.assertEqual(rl.reserve('a'), 0.0)
+        self.assertAlmostEqual(rl.reserve('a'), 10.0, places=1)
+        self.assertAlmostEqual(rl.reserve('a'), 20.0, places=1)
+        rl.close()
+
+    def test_per_host_limit(self):
+        rl = TokenBucketLimiter(self.path, rate=0.1, burst=1)
+        rl.set_limit('b', 1.0, 2)
+        rl.reserve('a')
+        self.assertAlmostEqual(rl.reserve('a'), 10.0, places=1)
+        rl.reserve('b')
+        rl.reserve('b')
+        self.assertAlmostEqual(rl.reserve('b'), 1.0, places=1)
+        rl.close()
+
+    def test_shared_between_instances(self):
+        # two limiters on the same file stand in for two processes
+        a = TokenBucketLimiter(self.path, rate=0.1, burst=1)
+        b = TokenBucketLimiter(self.path, rate=0.1, burst=1)
+        self.assertEqual(a.reserve('host'), 0.0)
+        self.assertAlmostEqual(b.reserve('host'), 10.0, places=1)
+        self.assertAlmostEqual(a.reserve('host'), 20.0, places=1)
+        a.close()
+        b.close()
+
+class TestAdaptiveController(unittest.TestCase):
+    def setUp(self):
+        self.rl = RateLimiter(delay=2.0)
+        self.ac = AdaptiveController(self.rl, min_delay=1.0, max_delay=30.0,
+                                     healthy_after=3)
+
+    def delay(self, host='a'):
+        return 1.0 / self.rl.get_limit(host)[0]
+
+    def test_backoff(self):
+        self.ac.record('a', 429, 0.1)
+        self.assertAlmostEqual(self.delay(), 4.0)
+        self.ac.record('a', 503, 0.1)
+        self.assertAlmostEqual(self.delay(), 8.0)
+        self.ac.record('a', None, 0.1)
+        self.assertAlmostEqual(self.delay(), 16.0)
+        self.ac.record('a', 429, 0.1)
+        self.assertAlmostEqual(self.delay(), 30.0)
+        self.assertAlmostEqual(self.delay('b'), 2.0)
+
+    def test_retry_after_defers(self):
+        self.ac.record('a', 429, 0.1, retry_after=20.0)
+        self.assertAlmostEqual(self.rl.reserve('a'), 20.0, places=1)
+
+    def test_speedup(self):
+        for i in range(3):
+            self.ac.record('a', 200, 0.1)
+        self.assertAlmostEqual(self.delay(), 1.8)
+        for i in range(100):
+            self.ac.record('a', 200, 0.1)
+        self.assertAlmostEqual(self.delay(), 1.0)
+
+    def test_slow_response(self):
+        self.ac.record('a', 200, 15.0)
+        self.assertAlmostEqual(self.delay(), 2.5)
+
+    def test_configured_limit(self):
+        # a configured host is never sped up past its limit, and keeps its
+        # burst through backoff and recovery
+        self.rl.configure('a', 0.25, 3)
+        self.ac.record('a', 429, 0.1)
+        self.assertEqual(self.rl.get_limit('a'), (0.125, 3))
+        for i in range(100):
+            self.ac.record('a', 200, 0.1)
+        self.assertEqual(self.rl.get_limit('a'), (0.25, 3))
+
+    def test_retry_delay(self):
+        for attempt in range(4):
+            d = self.ac.retry_delay(attempt, 1.0)
+            self.assertGreaterEqual(d, 2 ** attempt / 2)
+            self.assertLessEqual(d, 2 ** attempt)
+        self.assertEqual(self.ac.retry_delay(0, 1.0, retry_after=7.0), 7.0)
+        self.assertLessEqual(self.ac.retry_delay(10, 1.0), 30.0)
+
+class TestHostLimits(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(
+            ratelimit.parse_host_limits("a.example=0.5/4, b.example=2,"),
+            {'a.example': (0.5, 4), 'b.example': (2.0, 1)})
+        for bad in ["a.example", "a.example=x", "a.example=1/0",
+                    "a.example=0", "=1"]:
+            with self.subTest(spec=bad):
+                with self.assertRaises(ValueError):
+                    ratelimit.parse_host_limits(bad)
+
+    @unittest.skipIf(os.environ.get('FFMIRROR_HOST_LIMITS'),
+                     "host limits overridden")
+    def test_defaults(self):
+        rate, burst = ratelimit.shared_limiter.get_limit('archiveofourown.org')
+        self.assertGreater(burst, 1)
+        self.assertEqual(ratelimit.shared_limiter.configured,
+                         ratelimit.default_host_limits)
+
+class TestParseRetryAfter(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after('120'), 120.0)
+
+    def test_date(self):
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'),
+                         0.0)
+        when = (datetime.datetime.now(tz=datetime.timezone.utc) +
+                datetime.timedelta(seconds=60))
+        d = parse_retry_after(email.utils.format_datetime(when))
+        self.assertAlmostEqual(d, 60.0, delta=2.0)
+
+    def test_bad(self):
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
@@ -0,0 +1,383 @@
+#!/usr/bin/python
+
+import unittest, time, tempfile, os, threading
+import requests
+
+from ffmirror import util, ratelimit
+from ffmirror.cache import HTTPCache
+
+class TestNetworkFetcher(unittest.TestCase):
+    def setUp(self):
+        self.fetcher = util.NetworkFetcher(pool_connections=2,
+                                           pool_maxsize=5)
+
+    def tearDown(self):
+        self.fetcher.close()
+
+    def test_session_per_host(self):
+        a = self.fetcher.get_session('archiveofourown.org')
+        b = self.fetcher.get_session('archiveofourown.org')
+        c = self.fetcher.get_session('www.fictionpress.com')
+        self.assertIs(a, b)
+        self.assertIsNot(a, c)
+        self.assertEqual(a.headers['User-Agent'], util.user_agent)
+
+    def test_pool_size(self):
+        s = self.fetcher.get_session('archiveofourown.org')
+        adapter = s.get_adapter('https://archiveofourown.org/')
+        self.assertEqual(adapter._pool_maxsize, 5)
+        self.assertEqual(adapter._pool_connections, 2)
+
+    def test_close(self):
+        self.fetcher.get_session('archiveofourown.org')
+        self.fetcher.close()
+        self.assertEqual(self.fetcher.sessions, {})
+
+def make_response(url, status=200, content=b'', headers=None):
+    r = requests.Response()
+    r.status_code = status
+    r.url = url
+    r._content = content
+    r.headers.update(headers or {})
+    return r
+
+class SlotLimiter(ratelimit.RateLimiter):
+    """A RateLimiter that records the time of every slot it hands out."""
+    def __init__(self, delay):
+        super().__init__(delay)
+        self.slots = []
+
+    def reserve(self, host):
+        delay = super().reserve(host)
+        self.slots.append((host, time.time() + delay))
+        return delay
+
+class FakeNetworkFetcher(util.NetworkFetcher):
+    def __init__(self, delay):
+        super().__init__(time_delay=delay, limiter=SlotLimiter(delay))
+        self.fetched = []
+
+    def request_now(self, url, timeout=30, use_cloudscraper=False,
+                    headers=None):
+        self.fetched.append((time.time(), url))
+        return make_response(url, content=url.encode())
+
+class TestAsyncFetcher(unittest.TestCase):
+    def test_hosts_concurrent(self):
+        nf = FakeNetworkFetcher(0.2)
+        af = util.AsyncFetcher(nf)
+        urls = [f"https://{h}/{n}" for n in range(3) for h in 'abc']
+        start = time.time()
+        rv = util.urlopen_many(urls, fetcher=af, cache=None)
+        elapsed = time.time() - start
+        af.close()
+        self.assertEqual([r.read().decode() for r in rv], urls)
+        # three fetches per host at 0.2s apart, hosts running side by side
+        self.assertLess(elapsed, 0.9)
+        self.assertGreaterEqual(elapsed, 0.4)
+        # slot times rather than fetch times, which also include the time
+        # taken to hand the fetch to a worker thread
+        for h in 'abc':
+            ts = [t for host, t in nf.limiter.slots if host == h]
+            self.assertEqual(len(ts), 3)
+            for i, j in zip(ts, ts[1:]):
+                self.assertGreaterEqual(j - i, 0.19)
+
+class FlakyNetworkFetcher(util.NetworkFetcher):
+    def __init__(self, statuses):
+        super().__init__(time_delay=0.01)
+        self.controller.max_delay = 0.05
+        self.statuses = list(statuses)
+
+    def request_now(self, url, timeout=30, use_cloudscraper=False,
+                    headers=None):
+        r = make_response(url, self.statuses.pop(0), b'ok')
+        r.raise_for_status()
+        return r
+
+class TestRetry(unittest.TestCase):
+    def test_retry_on_throttle(self):
+        f = FlakyNetworkFetcher([429, 503, 200])
+        r = util.urlopen_retry('https://a/', fetcher=f, cache=None,
+                               delay=0.01)
+        self.assertEqual(r.read(), b'ok')
+        self.assertEqual(f.statuses, [])
+
+    def test_no_retry_on_404(self):
+        f = FlakyNetworkFetcher([404, 200])
+        with self.assertRaises(requests.exceptions.HTTPError):
+            util.urlopen_retry('https://a/', fetcher=f, cache=None,
+                               delay=0.01)
+        self.assertEqual(f.statuses, [200])
+
+    def test_gives_up(self):
+        f = FlakyNetworkFetcher([429, 429])
+        with self.assertRaises(requests.exceptions.HTTPError):
+            util.urlopen_retry('https://a/', fetcher=f, cache=None,
+                               tries=2, delay=0.01)
+
+class ConditionalNetworkFetcher(util.NetworkFetcher):
+    """Serves a page with an ETag, answering 304 to a matching If-None-Match."""
+    def __init__(self):
+        super().__init__(time_delay=0.001)
+        self.body = b'page one'
+        self.etag = '"v1"'
+        self.requests = []
+
+    def request_now(self, url, timeout=30, use_cloudscraper=False,
+                    headers=None):
+        headers = headers or {}
+        self.requests.append(headers)
+        if headers.get('If-None-Match') == self.etag:
+            return make_response(url, 304)
+        return make_response(url, 200, self.body, {
+            'ETag': self.etag,
+            'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+
+class TestConditionalRequests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        # everything is stale at once, so every get goes to the network
+        self.cache = HTTPCache(self.tmpdir.name, default_ttl=0.0,
+                               ttl_rules=[])
+        self.fetcher = ConditionalNetworkFetcher()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def fetch(self):
+        return util.urlopen_retry('https://a/x', fetcher=self.fetcher,
+                                  cache=self.cache).read()
+
+    def test_not_modified(self):
+        self.assertEqual(self.fetch(), b'page one')
+        self.assertEqual(self.fetcher.requests[-1], {})
+        self.assertEqual(self.fetch(), b'page one')
+        self.assertEqual(self.fetcher.requests[-1], {
+            'If-None-Match': '"v1"',
+            'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        self.assertEqual(self.cache.stats.revalidations, 1)
+        self.assertEqual(self.cache.stats.stores, 1)
+
+    def test_modified(self):
+        self.fetch()
+        self.fetcher.body = b'page two'
+        self.fetcher.etag = '"v2"'
+        self.assertEqual(self.fetch(), b'page two')
+        self.assertEqual(self.cache.stats.revalidations, 0)
+        self.assertEqual(self.cache.conditional_headers('https://a/x')
+                         ['If-None-Match'], '"v2"')
+
+    def test_entry_lost(self):
+        self.fetch()
+        headers = self.cache.conditional_headers('https://a/x')
+        os.unlink(self.cache.entry_path('https://a/x'))
+        # simulate the entry vanishing between the lookup and the 304
+        self.cache.conditional_headers = lambda url: headers
+        self.assertEqual(self.fetch(), b'page one')
+        self.assertEqual(self.fetcher.requests[-1], {})
+
+class FakeDriver:
+    started = 0
+
+    def __init__(self):
+        FakeDriver.started += 1
+        self.quit_called = False
+
+    def quit(self):
+        self.quit_called = True
+
+class FakeBrowserPool(util.BrowserPool):
+    def start_driver(self):
+        return FakeDriver()
+
+class TestBrowserPool(unittest.TestCase):
+    def test_lazy_start_and_reuse(self):
+        pool = FakeBrowserPool(size=2)
+        FakeDriver.started = 0
+        with pool.worker() as w:
+            d = w.driver
+        with pool.worker() as w:
+            self.assertIs(w.driver, d)
+        self.assertEqual(FakeDriver.started, 1)
+
+    def test_bounded(self):
+        pool = FakeBrowserPool(size=2)
+        in_use = []
+        peak = []
+        lock = threading.Lock()
+
+        def job():
+            with pool.worker() as w:
+                with lock:
+                    in_use.append(w)
+                    peak.append(len(in_use))
+                time.sleep(0.05)
+                with lock:
+                    in_use.remove(w)
+
+        threads = [threading.Thread(target=job) for i in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(max(peak), 2)
+
+    def test_restart_one_worker(self):
+        pool = FakeBrowserPool(size=2)
+        with pool.worker() as a, pool.worker() as b:
+            da, db = a.driver, b.driver
+            nd = a.restart()
+        self.assertTrue(da.quit_called)
+        self.assertFalse(db.quit_called)
+        self.assertIsNot(nd, da)
+        pool.close()
+        self.assertTrue(nd.quit_called)
+        self.assertTrue(db.quit_called)
+
+class TestWatchdog(unittest.TestCase):
+    def test_fires_from_thread(self):
+        released = threading.Event()
+        result = []
+
+        def job():
+            with util.Watchdog(0.05, released.set) as wd:
+                released.wait(5)
+            result.append(wd.fired)
+
+        t = threading.Thread(target=job)
+        t.start()
+        t.join()
+        self.assertEqual(result, [True])
+
+    def test_disarmed(self):
+        fired = []
+        with util.Watchdog(0.05, lambda: fired.append(True)) as wd:
+            pass
+        time.sleep(0.1)
+        self.assertFalse(wd.fired)
+        self.assertEqual(fired, [])
+
+class FakeBrowserFetcher:
+    pool = object()
+
+    def __init__(self):
+        self.fetched = []
+
+    def get_clearance(self, url, tries=3):
+        self.fetched.append(url)
+        return ('<html>browser name_login</html>',
+                [{'name': 'cf_clearance', 'value': 'tok',
+                  'domain': '.a.example', 'path': '/'}],
+                'Browser UA')
+
+class ChallengingNetworkFetcher(util.NetworkFetcher):
+    def __init__(self):
+        super().__init__(time_delay=0.001)
+        self.challenge = False
+        self.failures = []
+        self.fetched = []
+
+    def request_now(self, url, timeout=30, use_cloudscraper=False,
+                    headers=None):
+        s = self.get_session('a.example')
+        self.fetched.append((url, s.headers['User-Agent'],
+                             s.cookies.get('cf_clearance')))
+        if self.failures:
+            r = make_response(url, self.failures.pop(0), b'busy')
+        elif self.challenge:
+            r = make_response(url, 403, b'Just a moment...',
+                              {'cf-mitigated': 'challenge'})
+        else:
+            r = make_response(url, 200, 'plain name_login ’'.encode())
+        r.raise_for_status()
+        return r
+
+class TestHybridFetcher(unittest.TestCase):
+    def setUp(self):
+        self.network = ChallengingNetworkFetcher()
+        self.browser = FakeBrowserFetcher()
+        self.fetcher = util.HybridFetcher(
+            page_ok=lambda s: 'name_login' in s, network=self.network,
+            browser=self.browser, delay=0.001)
+
+    def test_clearance_reused(self):
+        self.assertIn('browser', self.fetcher.get_html('https://a.example/1'))
+        self.assertEqual(
+            self.fetcher.get_html('https://a.example/2'),
+            'plain name_login ’')
+        self.assertEqual(self.browser.fetched, ['https://a.example/1'])
+        self.assertEqual(self.network.fetched,
+                         [('https://a.example/2', 'Browser UA', 'tok')])
+
+    def test_rechallenged(self):
+        self.fetcher.get_html('https://a.example/1')
+        self.network.challenge = True
+        self.assertIn('browser', self.fetcher.get_html('https://a.example/2'))
+        self.assertEqual(self.browser.fetched,
+                         ['https://a.example/1', 'https://a.example/2'])
+        self.network.challenge = False
+        self.assertIn('plain', self.fetcher.get_html('https://a.example/3'))
+
+    def test_retry(self):
+        self.fetcher.get_html('https://a.example/1')
+        self.network.failures = [429, 502]
+        self.assertIn('plain', self.fetcher.get_html('https://a.example/2'))
+        self.assertEqual([u for u, ua, c in self.network.fetched],
+                         ['https://a.example/2'] * 3)
+        self.assertEqual(self.browser.fetched, ['https://a.example/1'])
+
+    def test_retries_exhausted(self):
+        self.fetcher.get_html('https://a.example/1')
+        self.network.failures = [504] * 3
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.fetcher.get_html('https://a.example/2', tries=3)
+        self.assertEqual(len(self.network.fetched), 3)
+        # a status that isn't worth retrying fails at once
+        self.network.failures = [404]
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.fetcher.get_html('https://a.example/3')
+        self.assertEqual(len(self.network.fetched), 4)
+        self.assertEqual(self.browser.fetched, ['https://a.example/1'])
+
+    def test_page_rejected(self):
+        self.fetcher.page_ok = lambda s: 'browser' in s
+        self.fetcher.get_html('https://a.example/1')
+        self.assertIn('browser', self.fetcher.get_html('https://a.example/2'))
+        self.assertEqual(len(self.browser.fetched), 2)
+
+# The original string-concatenating fold, kept as an oracle for the rewrite.
+def reference_fold(s, n=80):
+    rv = ""
+    cl = 0
+    for i in s.split():
+        if cl + len(i) + 1 < n:
+            rv += ' ' + i
+            cl += len(i) + 1
+        else:
+            rv += ' \n' + i
+            cl = len(i)
+    return rv[1:]
+
+class TestFold(unittest.TestCase):
+    def test_indiscriminate(self):
+        self.assertEqual(util.fold_string_indiscriminately(
+            "aaa bbb\n ccc  ddd", 9), "aaa bbb \nccc ddd")
+        self.assertEqual(util.fold_string_indiscriminately(""), "")
+        # an overlong first word is kept, after a line break as before
+        self.assertEqual(util.fold_string_indiscriminately("x" * 10, 5),
+                         "\n" + "x" * 10)
+
+    def test_discriminate(self):
+        self.assertEqual(util.fold_string_discriminately(
+            "short\n\nlong line here", 11), "short\n\nlong line \nhere\n")
+
+    def test_matches_reference(self):
+        import random
+        rng = random.Random(1)
+        words = ["<p>", "a", "word", "longer-word", "x" * 90, "</p>\n"]
+        for _ in range(50):
+            s = ' '.join(rng.choice(words) for _ in range(rng.randrange(300)))
+            for n in (10, 80):
+                self.assertEqual(util.fold_string_indiscriminately(s, n),
+                                 reference_fold(s, n))